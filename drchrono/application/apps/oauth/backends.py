@@ -1,4 +1,16 @@
+import requests
 from social_core.backends.oauth import BaseOAuth2
+from social_core.exceptions import AuthException, AuthUnreachableProvider
+
+from application.apps.oauth.ratelimit import ProviderRateLimiter, RateLimitExceeded
+from application.apps.oauth.transport import get_transport
+
+
+class AuthRateLimited(AuthException):
+    """drchrono API calls budget is exhausted (see ProviderRateLimiter)"""
+
+    def __str__(self):
+        return 'Too many sign-ins at the moment, please try again in a minute'
 
 
 class DrchronoOAuth2(BaseOAuth2):
@@ -13,6 +25,12 @@ class DrchronoOAuth2(BaseOAuth2):
     REDIRECT_STATE = False
     STATE_PARAMETER = False
     USER_DATA_URL = 'https://drchrono.com/api/users/current'
+    EXTRA_DATA = [
+        ('refresh_token', 'refresh_token', True),
+        ('expires_in', 'expires'),
+        ('practice_group', 'practice_group'),
+        ('doctor', 'doctor'),
+    ]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -27,4 +45,23 @@ class DrchronoOAuth2(BaseOAuth2):
     def user_data(self, access_token, *args, **kwargs):
         """Loads user data from service"""
         headers = {'Authorization': f'Bearer {access_token}'}
-        return self.get_json(self.USER_DATA_URL, headers=headers)
+        try:
+            response = get_transport().get(
+                self.USER_DATA_URL,
+                headers=headers,
+                rate_limiter=ProviderRateLimiter(access_token, interactive=True),
+            )
+            response.raise_for_status()
+        except RateLimitExceeded as exc:
+            raise AuthRateLimited(self) from exc
+        except requests.RequestException as exc:
+            raise AuthUnreachableProvider(self) from exc
+        return response.json()
+
+    def request(self, url, method='GET', **kwargs):
+        """Token exchange and refresh calls draw from the application budget"""
+        try:
+            ProviderRateLimiter(interactive=True).acquire()
+        except RateLimitExceeded as exc:
+            raise AuthRateLimited(self) from exc
+        return super().request(url, method=method, **kwargs)
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_APP_KEY = 'drchrono_rate_limit:app:{client_id}'
+RATE_LIMIT_TOKEN_KEY = 'drchrono_rate_limit:token:{token_hash}'
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def get_clock(redis) -> float:
+    '''
+    Buckets are refilled by workers of many hosts, so the time is taken
+    from Redis server and skewed host clocks don't skew the budget
+    '''
+    if settings.DRCHRONO_RATE_LIMIT_CLOCK == 'local':
+        return time.time()
+    seconds, microseconds = redis.time()
+    return seconds + microseconds / 1000000
+
+
+class TokenBucket:
+    '''
+    Token bucket state kept in Redis hash: tokens left and time of the update.
+    Bucket refills by `rate` tokens per second up to `capacity`.
+    '''
+
+    def __init__(self, key: str, rate: float, capacity: float):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def level(self, state: list, now: float) -> float:
+        tokens, updated = state
+        if tokens is None or updated is None:
+            return self.capacity
+        elapsed = max(now - float(updated), 0)
+        return min(self.capacity, float(tokens) + elapsed * self.rate)
+
+    @property
+    def ttl(self) -> int:
+        '''
+        Full bucket is the same as missing one
+        '''
+        return int(self.capacity / self.rate) + 1
+
+
+class ProviderRateLimiter:
+    '''
+    Budget of drchrono API calls shared by all workers and hosts through Redis.
+    Every call takes a token from the bucket of the OAuth application
+    (DRCHRONO_RATE_LIMIT_APP) and from the bucket of the access token
+    (DRCHRONO_RATE_LIMIT_TOKEN), both at once with WATCH/MULTI.
+    Background calls leave DRCHRONO_RATE_LIMIT_INTERACTIVE_RESERVE part of
+    each bucket to interactive ones (syncs somebody is waiting for).
+    '''
+
+    def __init__(self, access_token: str = None, interactive: bool = False):
+        self.interactive = interactive
+        app_rate, app_capacity = settings.DRCHRONO_RATE_LIMIT_APP
+        self.buckets = [TokenBucket(
+            RATE_LIMIT_APP_KEY.format(client_id=settings.SOCIAL_AUTH_DRCHRONO_KEY),
+            app_rate,
+            app_capacity,
+        )]
+        if access_token:
+            token_rate, token_capacity = settings.DRCHRONO_RATE_LIMIT_TOKEN
+            token_hash = hashlib.sha1(access_token.encode()).hexdigest()
+            self.buckets.append(TokenBucket(
+                RATE_LIMIT_TOKEN_KEY.format(token_hash=token_hash),
+                token_rate,
+                token_capacity,
+            ))
+
+    def acquire(self, timeout: float = None):
+        '''
+        Waits for a call budget, raises RateLimitExceeded after `timeout` seconds
+        '''
+        if not settings.DRCHRONO_RATE_LIMIT_ENABLED:
+            return
+        timeout = settings.DRCHRONO_RATE_LIMIT_MAX_WAIT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            if time.monotonic() + delay > deadline:
+                raise RateLimitExceeded('drchrono API calls budget is exhausted')
+            time.sleep(delay)
+
+    def try_acquire(self) -> float:
+        '''
+        Takes a token from every bucket.
+        Returns 0 on success or seconds until the budget is expected to be enough.
+        '''
+        reserve = (
+            0 if self.interactive else settings.DRCHRONO_RATE_LIMIT_INTERACTIVE_RESERVE
+        )
+        keys = [bucket.key for bucket in self.buckets]
+        with get_redis_connection('default').pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(*keys)
+                    now = get_clock(pipe)
+                    levels = [
+                        bucket.level(pipe.hmget(bucket.key, 'tokens', 'updated'), now)
+                        for bucket in self.buckets
+                    ]
+                    delay = max(
+                        (1 + reserve * bucket.capacity - level) / bucket.rate
+                        for bucket, level in zip(self.buckets, levels)
+                    )
+                    if delay > 0:
+                        pipe.unwatch()
+                        return delay
+
+                    pipe.multi()
+                    for bucket, level in zip(self.buckets, levels):
+                        pipe.hset(bucket.key, 'tokens', level - 1)
+                        pipe.hset(bucket.key, 'updated', now)
+                        pipe.expire(bucket.key, bucket.ttl)
+                    pipe.execute()
+                    return 0
+                except WatchError:
+                    continue
@@ -1,8 +1,12 @@
 import json
+from unittest.mock import patch
 
+import requests
+from social_core.exceptions import AuthUnreachableProvider
 from social_core.tests.backends.oauth import OAuth2Test
 
-from application.apps.oauth.backends import DrchronoOAuth2
+from application.apps.oauth.backends import AuthRateLimited, DrchronoOAuth2
+from application.apps.oauth.ratelimit import ProviderRateLimiter, RateLimitExceeded
 
 
 class DrchronoOAuth2Test(OAuth2Test):
@@ -27,3 +31,15 @@ class DrchronoOAuth2Test(OAuth2Test):
 
     def test_partial_pipeline(self):
         self.do_partial_pipeline()
+
+    def test_unreachable_user_data_fail(self):
+        with patch('application.apps.oauth.backends.get_transport') as get_transport:
+            get_transport.return_value.get.side_effect = requests.ConnectionError
+
+            with self.assertRaises(AuthUnreachableProvider):
+                self.backend.user_data('foobar')
+
+    def test_rate_limited_token_exchange_fail(self):
+        with patch.object(ProviderRateLimiter, 'acquire', side_effect=RateLimitExceeded):
+            with self.assertRaises(AuthRateLimited):
+                self.backend.request(DrchronoOAuth2.ACCESS_TOKEN_URL, method='POST')
@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+import fakeredis
+from django.test import TestCase, override_settings
+
+from application.apps.oauth.ratelimit import ProviderRateLimiter, RateLimitExceeded
+
+
+@override_settings(
+    DRCHRONO_RATE_LIMIT_APP=(1, 8),
+    DRCHRONO_RATE_LIMIT_TOKEN=(1, 4),
+    DRCHRONO_RATE_LIMIT_INTERACTIVE_RESERVE=0.5,
+)
+class ProviderRateLimiterTest(TestCase):
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def test_token_budget_success(self):
+        limiter = ProviderRateLimiter('token', interactive=True)
+        for _ in range(4):
+            self.assertEqual(limiter.try_acquire(), 0)
+
+        self.assertGreater(limiter.try_acquire(), 0)
+        # other token still has budget of the application
+        other_limiter = ProviderRateLimiter('other_token', interactive=True)
+        self.assertEqual(other_limiter.try_acquire(), 0)
+
+    def test_application_budget_is_shared_success(self):
+        for number in range(8):
+            limiter = ProviderRateLimiter(f'token_{number}', interactive=True)
+            self.assertEqual(limiter.try_acquire(), 0)
+
+        limiter = ProviderRateLimiter('token_8', interactive=True)
+        self.assertGreater(limiter.try_acquire(), 0)
+
+    def test_reserve_is_left_to_interactive_calls_success(self):
+        background = ProviderRateLimiter('token')
+        interactive = ProviderRateLimiter('token', interactive=True)
+        # background calls stop when half of the token bucket is left
+        self.assertEqual(background.try_acquire(), 0)
+        self.assertEqual(background.try_acquire(), 0)
+        self.assertGreater(background.try_acquire(), 0)
+
+        self.assertEqual(interactive.try_acquire(), 0)
+        self.assertEqual(interactive.try_acquire(), 0)
+
+    def test_acquire_timeout_fail(self):
+        limiter = ProviderRateLimiter('token', interactive=True)
+        for _ in range(4):
+            limiter.acquire(timeout=0)
+
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(timeout=0)
+
+    @override_settings(DRCHRONO_RATE_LIMIT_CLOCK='redis')
+    def test_buckets_use_redis_clock_success(self):
+        limiter = ProviderRateLimiter('token', interactive=True)
+
+        redis_time = patch.object(
+            fakeredis.FakeStrictRedis, 'time', return_value=(1000, 500000), create=True
+        )
+        with redis_time:
+            self.assertEqual(limiter.try_acquire(), 0)
+
+        redis = fakeredis.FakeStrictRedis()
+        self.assertEqual(
+            [float(redis.hget(bucket.key, 'updated')) for bucket in limiter.buckets],
+            [1000.5, 1000.5],
+        )
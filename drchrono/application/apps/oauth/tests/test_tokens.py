@@ -0,0 +1,91 @@
+import json
+import time
+
+import fakeredis
+import httpretty
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from social_django.models import UserSocialAuth
+
+from application.apps.oauth.backends import DrchronoOAuth2
+from application.apps.oauth.tokens import TokenManager
+from application.apps.oauth.transport import get_transport
+
+User = get_user_model()
+
+
+class TokenManagerTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='testuser', email='admin@acme.test')
+        cls.api_url = 'https://drchrono.com/api/patients'
+
+    def setUp(self):
+        self.auth = UserSocialAuth.objects.create(
+            user=self.user,
+            uid='1111',
+            provider='drchrono',
+            extra_data={
+                'auth_time': int(time.time()),
+                'expires': 172800,
+                'token_type': 'Bearer',
+                'access_token': 'old_token',
+                'refresh_token': 'refresh_token',
+            }
+        )
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def register_refresh(self):
+        httpretty.register_uri(
+            httpretty.POST,
+            DrchronoOAuth2.ACCESS_TOKEN_URL,
+            body=json.dumps({
+                'access_token': 'new_token',
+                'refresh_token': 'new_refresh_token',
+                'expires_in': 172800,
+                'token_type': 'Bearer',
+            }),
+        )
+
+    def test_token_is_cached_success(self):
+        self.assertEqual(TokenManager(self.user.pk).get_access_token(), 'old_token')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(TokenManager(self.user.pk).get_access_token(), 'old_token')
+
+    def test_no_session_fail(self):
+        self.auth.delete()
+        self.assertIsNone(TokenManager(self.user.pk).get_access_token())
+
+    @httpretty.activate
+    def test_expiring_token_is_refreshed_ahead_success(self):
+        self.register_refresh()
+        self.auth.extra_data['auth_time'] = int(time.time()) - 172800 + 60
+        self.auth.save()
+
+        self.assertEqual(TokenManager(self.user.pk).get_access_token(), 'new_token')
+
+        self.auth.refresh_from_db()
+        self.assertEqual(self.auth.extra_data['access_token'], 'new_token')
+        self.assertEqual(self.auth.extra_data['refresh_token'], 'new_refresh_token')
+        with self.assertNumQueries(0):
+            self.assertEqual(TokenManager(self.user.pk).get_access_token(), 'new_token')
+
+    @httpretty.activate
+    def test_unauthorized_request_is_retried_with_refreshed_token_success(self):
+        self.register_refresh()
+
+        def request_callback(request, uri, response_headers):
+            if request.headers['Authorization'] == 'Bearer new_token':
+                return [200, response_headers, '{}']
+            return [401, response_headers, 'Token expired']
+
+        httpretty.register_uri(httpretty.GET, self.api_url, body=request_callback)
+
+        response = TokenManager(self.user.pk).get(get_transport(), self.api_url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TokenManager(self.user.pk).get_access_token(), 'new_token')
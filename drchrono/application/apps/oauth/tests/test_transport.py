@@ -0,0 +1,77 @@
+from unittest.mock import patch
+
+import httpretty
+from django.test import SimpleTestCase
+
+from application.apps.oauth.transport import DrchronoTransport
+
+
+class DrchronoTransportTest(SimpleTestCase):
+    url = 'https://drchrono.com/api/patients'
+
+    def setUp(self):
+        self.transport = DrchronoTransport(
+            pool_connections=1,
+            pool_maxsize=1,
+            timeout=1,
+            max_retries=2,
+            backoff_factor=0.5,
+            backoff_max=10,
+            retry_after_max=5,
+        )
+
+    @httpretty.activate
+    @patch('application.apps.oauth.transport.time.sleep')
+    def test_get_retries_server_errors_success(self, sleep):
+        httpretty.register_uri(
+            httpretty.GET,
+            self.url,
+            responses=[
+                httpretty.Response(body='Bad gateway', status=502),
+                httpretty.Response(body='{}', status=200),
+            ]
+        )
+
+        response = self.transport.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertLessEqual(sleep.call_args[0][0], 0.5)
+
+    @httpretty.activate
+    @patch('application.apps.oauth.transport.time.sleep')
+    def test_get_honors_retry_after_success(self, sleep):
+        httpretty.register_uri(
+            httpretty.GET,
+            self.url,
+            responses=[
+                httpretty.Response(
+                    body='Over limit', status=429, adding_headers={'Retry-After': '3'}
+                ),
+                httpretty.Response(
+                    body='Over limit', status=429, adding_headers={'Retry-After': '30'}
+                ),
+                httpretty.Response(body='{}', status=200),
+            ]
+        )
+
+        response = self.transport.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [3, 5])
+
+    @httpretty.activate
+    @patch('application.apps.oauth.transport.time.sleep')
+    def test_get_returns_last_response_when_retries_exhausted(self, sleep):
+        httpretty.register_uri(
+            httpretty.GET,
+            self.url,
+            status=503,
+            body='Unavailable',
+        )
+
+        response = self.transport.get(self.url)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.text, 'Unavailable')
+        self.assertEqual(sleep.call_count, 2)
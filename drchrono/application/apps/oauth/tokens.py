@@ -0,0 +1,158 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from social_django.models import UserSocialAuth
+from social_django.utils import load_strategy
+
+from application.apps.oauth.ratelimit import ProviderRateLimiter
+from application.locks import CacheLock
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_KEY = 'drchrono_access_token:{user_id}'
+TOKEN_REFRESH_LOCK_KEY = 'drchrono_token_refresh_lock:{user_id}'
+
+
+def get_token_expiry(extra_data: dict):
+    '''
+    Returns unix time of access token expiry or None when it is unknown
+    '''
+    auth_time = extra_data.get('auth_time')
+    expires = extra_data.get('expires')
+    if not auth_time or not expires:
+        return None
+    return int(auth_time) + int(expires)
+
+
+class TokenManager:
+    '''
+    Access tokens of drchrono users (see DrchronoOAuth2).
+    Decoded tokens are kept in the cache with their expiry, so requests
+    don't read social auth record on every sync. Tokens which expire within
+    DRCHRONO_TOKEN_REFRESH_MARGIN are refreshed ahead with refresh token,
+    only one worker refreshes user's token at a time.
+    '''
+
+    def __init__(self, user_id: int, interactive: bool = False):
+        self.user_id = user_id
+        self.interactive = interactive
+        self.cache_key = TOKEN_CACHE_KEY.format(user_id=user_id)
+
+    def get_access_token(self):
+        '''
+        Returns valid access token or None when user has no drchrono session
+        '''
+        token = cache.get(self.cache_key)
+        if token is None:
+            token = self._load()
+            if token is None:
+                return None
+        if self._is_expiring(token):
+            return self.refresh(stale_token=token['access_token'])
+        return token['access_token']
+
+    def refresh(self, stale_token: str = None):
+        '''
+        Refreshes access token unless other worker has already replaced `stale_token`.
+        Returns the latest known access token.
+        '''
+        lock = CacheLock(
+            TOKEN_REFRESH_LOCK_KEY.format(user_id=self.user_id),
+            lease=settings.DRCHRONO_TOKEN_REFRESH_LOCK_TTL,
+        )
+        if not lock.acquire():
+            lock.wait(timeout=settings.DRCHRONO_TOKEN_REFRESH_LOCK_TTL)
+            token = self._load()
+            return token and token['access_token']
+
+        try:
+            auth = self._get_auth()
+            if auth is None:
+                return None
+            token = self._cache(auth)
+            if token['access_token'] != stale_token and not self._is_expiring(token):
+                return token['access_token']
+
+            try:
+                auth.refresh_token(load_strategy())
+            except Exception:
+                logger.warning(
+                    f'Failed to refresh access token of user {self.user_id}',
+                    exc_info=True,
+                )
+                return token['access_token']
+            return self._cache(auth)['access_token']
+        finally:
+            lock.release()
+
+    def request(self, transport, method: str, url: str, **kwargs):
+        '''
+        Makes authorized request within the token's rate limit,
+        401 response is retried once with refreshed token
+        '''
+        token = self.get_access_token()
+        response = self.send(transport, method, url, token, **kwargs)
+        if response.status_code == 401:
+            fresh_token = self.refresh(stale_token=token)
+            if fresh_token and fresh_token != token:
+                response = self.send(transport, method, url, fresh_token, **kwargs)
+        return response
+
+    def send(self, transport, method: str, url: str, token: str, **kwargs):
+        '''
+        Makes request with given token within its rate limit. Neither the database
+        nor the token cache is touched, so it is safe in worker threads; 401 response
+        is returned to the caller, which refreshes the token on its own thread.
+        '''
+        return transport.request(method, url, **self._auth_kwargs(token), **kwargs)
+
+    def get(self, transport, url: str, **kwargs):
+        return self.request(transport, 'GET', url, **kwargs)
+
+    def invalidate(self):
+        cache.delete(self.cache_key)
+
+    def _auth_kwargs(self, token: str) -> dict:
+        return {
+            'headers': {'Authorization': f'Bearer {token}'},
+            'rate_limiter': ProviderRateLimiter(token, interactive=self.interactive),
+        }
+
+    def _is_expiring(self, token: dict) -> bool:
+        expires_at = token.get('expires_at')
+        if expires_at is None:
+            return False
+        return expires_at - time.time() <= settings.DRCHRONO_TOKEN_REFRESH_MARGIN
+
+    def _get_auth(self):
+        return UserSocialAuth.objects.filter(
+            user_id=self.user_id, provider='drchrono'
+        ).first()
+
+    def _load(self):
+        auth = self._get_auth()
+        if auth is None:
+            return None
+        return self._cache(auth)
+
+    def _cache(self, auth) -> dict:
+        token = {
+            'access_token': auth.extra_data.get('access_token'),
+            'expires_at': get_token_expiry(auth.extra_data),
+        }
+        if token['expires_at'] is None:
+            timeout = settings.DRCHRONO_TOKEN_CACHE_TTL
+        else:
+            timeout = max(int(token['expires_at'] - time.time()), 1)
+        cache.set(self.cache_key, token, timeout=timeout)
+        return token
+
+
+@receiver(post_save, sender=UserSocialAuth)
+def invalidate_cached_token(sender, instance, **kwargs):
+    if instance.provider == 'drchrono':
+        TokenManager(instance.user_id).invalidate()
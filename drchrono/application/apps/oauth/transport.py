@@ -0,0 +1,143 @@
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+class DrchronoTransport:
+    '''
+    HTTP transport for drchrono API.
+    Keeps a pooled keep-alive session and retries connection errors,
+    5xx and 429 responses with exponential backoff and full jitter.
+    429 responses are retried after `Retry-After` when provider sends it.
+    '''
+
+    def __init__(self, pool_connections: int, pool_maxsize: int, timeout,
+                 max_retries: int, backoff_factor: float, backoff_max: float,
+                 retry_after_max: float):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            pool_connections=settings.DRCHRONO_HTTP_POOL_CONNECTIONS,
+            pool_maxsize=settings.DRCHRONO_HTTP_POOL_MAXSIZE,
+            timeout=settings.DRCHRONO_HTTP_TIMEOUT,
+            max_retries=settings.DRCHRONO_HTTP_MAX_RETRIES,
+            backoff_factor=settings.DRCHRONO_HTTP_BACKOFF_FACTOR,
+            backoff_max=settings.DRCHRONO_HTTP_BACKOFF_MAX,
+            retry_after_max=settings.DRCHRONO_HTTP_RETRY_AFTER_MAX,
+        )
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method: str, url: str, on_retry=None, rate_limiter=None,
+                **kwargs) -> requests.Response:
+        '''
+        Returns the last response when retries are exhausted,
+        raises the last connection error when no response was received.
+        `on_retry` is called with attempt number before each retry.
+        Every attempt waits for `rate_limiter` budget when it is given.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                logger.info(f'Connection to {url} failed, retrying', exc_info=True)
+                delay = self.backoff(attempt)
+            else:
+                if (
+                    response.status_code not in RETRY_STATUS_CODES
+                    or attempt >= self.max_retries
+                ):
+                    return response
+                logger.info(f'{url} responded with {response.status_code}, retrying')
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                response.close()
+
+            attempt += 1
+            if on_retry is not None:
+                on_retry(attempt)
+            time.sleep(delay)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_factor * 2 ** attempt)
+        )
+
+    def retry_after(self, response: requests.Response):
+        '''
+        Parses `Retry-After` header given in seconds or as HTTP date
+        '''
+        value = response.headers.get('Retry-After')
+        if response.status_code != 429 or not value:
+            return None
+
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+
+        return min(max(delay, 0), self.retry_after_max)
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport() -> DrchronoTransport:
+    '''
+    Returns transport of the current worker process.
+    Transports are created lazily, so forked uWSGI workers never share sockets.
+    '''
+    pid = os.getpid()
+    transport = _transports.get(pid)
+    if transport is None:
+        with _transports_lock:
+            transport = _transports.get(pid)
+            if transport is None:
+                _transports.clear()
+                transport = _transports[pid] = DrchronoTransport.from_settings()
+    return transport
+
+
+@receiver(setting_changed)
+def reset_transport(setting, **kwargs):
+    if setting.startswith('DRCHRONO_HTTP_'):
+        _transports.clear()
@@ -0,0 +1,406 @@
+import csv
+import hashlib
+import io
+import json
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from application.apps.patients.models import Patient, PatientUser
+from application.apps.patients.telemetry import SyncTelemetry
+from application.apps.patients.versions import bump_sync_version_on_commit
+
+COPY_NULL = r'\N'
+PHONE_FORMATTING_RE = re.compile(r'\D')
+
+
+def parse_provider_datetime(value):
+    '''
+    Provider sends naive timestamps, they are stored as UTC
+    '''
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+
+def format_provider_datetime(value) -> str:
+    return timezone.make_naive(value, timezone.utc).isoformat()
+
+
+def patient_fields(patient: dict) -> dict:
+    '''
+    Maps drchrono patient record to Patient model fields
+    '''
+    fields = {
+        'first_name': patient.get('first_name', ''),
+        'last_name': patient.get('last_name', ''),
+        'birth_date': patient.get('date_of_birth'),
+        'phone_number': (
+            patient.get('home_phone', '')
+            or patient.get('cell_phone', '')
+            or patient.get('office_phone', '')
+        ),
+        'photo': patient.get('patient_photo'),
+        'internal_updated_at': parse_provider_datetime(patient.get('updated_at')),
+    }
+    fields['phone_digits'] = normalize_phone(fields['phone_number'])
+    fields['content_hash'] = content_hash(fields)
+    return fields
+
+
+def normalize_phone(value) -> str:
+    '''
+    Digits of phone number, so "(555) 123-4567" and "555.123.4567" are the same
+    '''
+    return PHONE_FORMATTING_RE.sub('', value or '')
+
+
+def content_hash(fields: dict) -> str:
+    '''
+    Fingerprint of the stored patient data. Provider bumps `updated_at` on changes
+    of fields we don't keep, so only the fingerprint tells whether a row must be written.
+    '''
+    content = [str(fields[name]) for name in PatientBulkWriter.hashed_fields]
+    return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+
+
+def get_linked_users(patient_ids: list) -> list:
+    return list(
+        PatientUser.objects
+        .filter(patient_id__in=patient_ids)
+        .values_list('user_id', flat=True)
+        .distinct()
+    )
+
+
+def chunked(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class PatientBulkWriter:
+    '''
+    Writes provider patients of one user with set-based statements:
+    one diff query, then chunked upserts and through-table inserts
+    inside a single transaction.
+
+    Links are stamped with sync `generation`. During full sync (`mark_seen`)
+    links of every fetched patient are stamped, so links which were not seen
+    by the finished full sync are removed with `unlink_unseen`.
+    '''
+    hashed_fields = ('first_name', 'last_name', 'birth_date', 'phone_number', 'photo')
+    upsert_fields = hashed_fields + (
+        'phone_digits', 'internal_updated_at', 'content_hash'
+    )
+
+    def __init__(self, user, chunk_size: int = None, generation: int = 0,
+                 mark_seen: bool = False, telemetry: SyncTelemetry = None):
+        self.user = user
+        self.chunk_size = chunk_size or settings.DRCHRONO_PATIENTS_WRITE_CHUNK_SIZE
+        self.generation = generation
+        self.mark_seen = mark_seen
+        self.telemetry = telemetry or SyncTelemetry()
+
+    def write(self, patients_from_provider: list) -> Counter:
+        '''
+        Returns counters: inserted, updated, linked and skipped (content is not changed).
+        Bumps sync version of every user whose patients were changed.
+        '''
+        with self.telemetry.phase('diff'):
+            changed, new_links, skipped = self.diff(patients_from_provider)
+        stats = Counter(skipped=skipped)
+        with self.telemetry.phase('write'):
+            if self.mark_seen:
+                self._mark_seen([
+                    int(patient['id']) for patient in patients_from_provider
+                ])
+            if not changed:
+                return stats
+
+            changed_users = set()
+            with transaction.atomic():
+                for chunk in chunked(list(changed.items()), self.chunk_size):
+                    chunk_stats, updated_ids = self._upsert(chunk)
+                    stats.update(chunk_stats)
+                    if updated_ids:
+                        changed_users.update(get_linked_users(updated_ids))
+                for chunk in chunked(new_links, self.chunk_size):
+                    stats['linked'] += self._link(chunk)
+
+        if stats['linked']:
+            changed_users.add(self.user.pk)
+        bump_sync_version_on_commit(*changed_users)
+
+        return stats
+
+    def diff(self, patients_from_provider: list):
+        '''
+        Returns mapped fields of patients which must be upserted by provider ID,
+        provider IDs which are not linked to the user yet and number of
+        user's patients with unchanged content.
+        Only rows of the given batch are loaded from the database.
+        '''
+        internal_ids = list({int(patient['id']) for patient in patients_from_provider})
+        exist_patients_info = dict(
+            self.user.patients
+            .filter(internal_id__in=internal_ids)
+            .values_list('internal_id', 'content_hash')
+        )
+
+        changed = {}
+        new_links = []
+        for patient in patients_from_provider:
+            internal_id = int(patient['id'])
+            fields = patient_fields(patient)
+            if internal_id not in exist_patients_info:
+                if internal_id not in changed:
+                    new_links.append(internal_id)
+                changed[internal_id] = fields
+            elif fields['content_hash'] != exist_patients_info[internal_id]:
+                changed[internal_id] = fields
+
+        return changed, new_links, len(internal_ids) - len(changed)
+
+    def _upsert(self, patients: list):
+        table = Patient._meta.db_table
+        columns = ('created', 'modified', 'internal_id') + self.upsert_fields
+        now = timezone.now()
+        params = []
+        for internal_id, fields in patients:
+            params.extend((now, now, internal_id))
+            params.extend(fields[name] for name in self.upsert_fields)
+
+        placeholder = f'({", ".join(["%s"] * len(columns))})'
+        values = ', '.join([placeholder] * len(patients))
+
+        updates = ', '.join(
+            f'{name} = EXCLUDED.{name}' for name in ('modified',) + self.upsert_fields
+        )
+        sql = (
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES {values} '
+            f'ON CONFLICT (internal_id) DO UPDATE SET {updates} '
+            f'WHERE {table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash '
+            f'RETURNING id, (xmax = 0)'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
+
+        updated_ids = [
+            patient_id for patient_id, is_inserted in result if not is_inserted
+        ]
+        stats = Counter(
+            inserted=len(result) - len(updated_ids),
+            updated=len(updated_ids),
+            skipped=len(patients) - len(result),  # shared patients with the same content
+        )
+        return stats, updated_ids
+
+    def flush(self) -> Counter:
+        '''
+        Everything is written by `write` already
+        '''
+        return Counter()
+
+    def _link(self, internal_ids: list) -> int:
+        through_table = PatientUser._meta.db_table
+        sql = (
+            f'INSERT INTO {through_table} (patient_id, user_id, sync_generation) '
+            f'SELECT id, %s, %s FROM {Patient._meta.db_table} '
+            f'WHERE internal_id = ANY(%s) '
+            f'ON CONFLICT (patient_id, user_id) DO NOTHING'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.user.pk, self.generation, internal_ids])
+            return cursor.rowcount
+
+    def _mark_seen(self, internal_ids: list):
+        through_table = PatientUser._meta.db_table
+        sql = (
+            f'UPDATE {through_table} SET sync_generation = %s '
+            f'WHERE user_id = %s AND sync_generation <> %s AND patient_id IN ('
+            f'SELECT id FROM {Patient._meta.db_table} WHERE internal_id = ANY(%s))'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql, [self.generation, self.user.pk, self.generation, internal_ids]
+            )
+
+    def unlink_unseen(self) -> Counter:
+        '''
+        Removes in chunks user's links which were not seen by the full sync
+        of current generation (patients deleted or unshared on provider)
+        and patients which are left without users.
+        Returns counters: unlinked, deleted
+        '''
+        through_table = PatientUser._meta.db_table
+        unlink_sql = (
+            f'DELETE FROM {through_table} WHERE id IN ('
+            f'SELECT id FROM {through_table} '
+            f'WHERE user_id = %s AND sync_generation < %s LIMIT %s'
+            f') RETURNING patient_id'
+        )
+        delete_sql = (
+            f'DELETE FROM {Patient._meta.db_table} AS patient WHERE patient.id = ANY(%s) '
+            f'AND NOT EXISTS ('
+            f'SELECT 1 FROM {through_table} WHERE patient_id = patient.id'
+            f')'
+        )
+
+        stats = Counter()
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    unlink_sql, [self.user.pk, self.generation, self.chunk_size]
+                )
+                patient_ids = [patient_id for patient_id, in cursor.fetchall()]
+                if not patient_ids:
+                    break
+                stats['unlinked'] += len(patient_ids)
+
+                cursor.execute(delete_sql, [patient_ids])
+                stats['deleted'] += cursor.rowcount
+
+        if stats['unlinked']:
+            bump_sync_version_on_commit(self.user.pk)
+        return stats
+
+
+class PatientCopyLoader:
+    '''
+    Initial load of user's patients: provider pages are streamed with COPY
+    into a session temporary staging table, which is merged into patients
+    and links with two set-based statements on `flush`.
+    Has the same `write` interface as PatientBulkWriter.
+    '''
+    staging_table = 'patients_staging'
+    staging_fields = ('internal_id',) + PatientBulkWriter.upsert_fields
+
+    def __init__(self, user, generation: int = 0, telemetry: SyncTelemetry = None):
+        self.user = user
+        self.generation = generation
+        self.telemetry = telemetry or SyncTelemetry()
+        self.is_staging_created = False
+
+    def write(self, patients_from_provider: list) -> Counter:
+        with self.telemetry.phase('write'):
+            return self._copy(patients_from_provider)
+
+    def flush(self) -> Counter:
+        '''
+        Merges staged patients, returns counters: inserted, updated, linked, skipped
+        '''
+        with self.telemetry.phase('flush'):
+            return self._merge()
+
+    def _copy(self, patients_from_provider: list) -> Counter:
+        if not self.is_staging_created:
+            self._create_staging()
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for patient in patients_from_provider:
+            fields = dict(patient_fields(patient), internal_id=int(patient['id']))
+            writer.writerow([
+                COPY_NULL if fields[name] is None else fields[name]
+                for name in self.staging_fields
+            ])
+        buffer.seek(0)
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {self.staging_table} ({", ".join(self.staging_fields)}) '
+                f"FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+                buffer,
+            )
+        return Counter()
+
+    def _merge(self) -> Counter:
+        if not self.is_staging_created:
+            return Counter()
+
+        table = Patient._meta.db_table
+        through_table = PatientUser._meta.db_table
+        columns = ('created', 'modified') + self.staging_fields
+        updates = ', '.join(
+            f'{name} = EXCLUDED.{name}'
+            for name in ('modified',) + PatientBulkWriter.upsert_fields
+        )
+        upsert_sql = (
+            f'INSERT INTO {table} ({", ".join(columns)}) '
+            f'SELECT DISTINCT ON (internal_id) %s, %s, {", ".join(self.staging_fields)} '
+            f'FROM {self.staging_table} ORDER BY internal_id, position DESC '
+            f'ON CONFLICT (internal_id) DO UPDATE SET {updates} '
+            f'WHERE {table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash '
+            f'RETURNING id, (xmax = 0)'
+        )
+        link_sql = (
+            f'INSERT INTO {through_table} (patient_id, user_id, sync_generation) '
+            f'SELECT patient.id, %s, %s FROM {table} AS patient '
+            f'WHERE patient.internal_id IN ('
+            f'SELECT internal_id FROM {self.staging_table}'
+            f') '
+            f'ON CONFLICT (patient_id, user_id) DO NOTHING'
+        )
+
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT COUNT(DISTINCT internal_id) FROM {self.staging_table}'
+            )
+            staged, = cursor.fetchone()
+
+            cursor.execute(upsert_sql, [now, now])
+            result = cursor.fetchall()
+            updated_ids = [
+                patient_id for patient_id, is_inserted in result if not is_inserted
+            ]
+
+            cursor.execute(link_sql, [self.user.pk, self.generation])
+            linked = cursor.rowcount
+
+            cursor.execute(f'DROP TABLE {self.staging_table}')
+        self.is_staging_created = False
+
+        changed_users = get_linked_users(updated_ids) if updated_ids else []
+        if linked:
+            changed_users.append(self.user.pk)
+        bump_sync_version_on_commit(*changed_users)
+
+        return Counter(
+            inserted=len(result) - len(updated_ids),
+            updated=len(updated_ids),
+            linked=linked,
+            skipped=staged - len(result),
+        )
+
+    def unlink_unseen(self) -> Counter:
+        '''
+        Initial load has nothing to unlink
+        '''
+        return Counter()
+
+    def _create_staging(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.staging_table}')
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE {self.staging_table} ('
+                f'position serial, '
+                f'internal_id bigint NOT NULL, '
+                f'first_name varchar(250), '
+                f'last_name varchar(250), '
+                f'birth_date date, '
+                f'phone_number varchar(250), '
+                f'phone_digits varchar(250), '
+                f'photo varchar(500), '
+                f'internal_updated_at timestamp with time zone, '
+                f'content_hash varchar(40))'
+            )
+        self.is_staging_created = True
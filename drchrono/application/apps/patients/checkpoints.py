@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.cache import cache
+
+SYNC_CHECKPOINT_KEY = 'drchrono_patients_sync_checkpoint:{user_id}'
+
+
+class SyncCheckpoint:
+    '''
+    Progress of user's provider crawl: `next` cursor after the latest
+    committed page with the crawl state needed to finish it
+    (full or incremental, start time, updated_at watermark, members the crawl
+    is written for and counters).
+
+    Checkpoint is valid only for the same users at the same sync generations
+    (in any order), so a crawl is never finished over a full sync completed
+    in the meantime.
+    Stale checkpoints expire after DRCHRONO_PATIENTS_CHECKPOINT_TTL,
+    provider cursors are not kept forever.
+    '''
+
+    def __init__(self, user_id: int, sync_states: list):
+        self.key = SYNC_CHECKPOINT_KEY.format(user_id=user_id)
+        self.fingerprint = sorted(
+            (sync_state.user_id, sync_state.generation) for sync_state in sync_states
+        )
+
+    def load(self):
+        '''
+        Returns state of interrupted crawl or None
+        '''
+        state = cache.get(self.key)
+        if state is None or state['fingerprint'] != self.fingerprint:
+            return None
+        return state
+
+    def save(self, url: str, is_full_sync: bool, started_at, updated_since, member_ids,
+             stats, members_stats):
+        cache.set(self.key, {
+            'fingerprint': self.fingerprint,
+            'url': url,
+            'is_full_sync': is_full_sync,
+            'started_at': started_at,
+            'updated_since': updated_since,
+            'member_ids': set(member_ids),
+            'stats': dict(stats),
+            'members_stats': dict(members_stats),
+        }, timeout=settings.DRCHRONO_PATIENTS_CHECKPOINT_TTL)
+
+    def delete(self):
+        cache.delete(self.key)
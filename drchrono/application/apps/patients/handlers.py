@@ -1,7 +1,26 @@
-import requests
 import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlencode
 
-from application.apps.patients.models import Patient
+from django.conf import settings
+from django.utils import timezone
+
+from application.apps.oauth.ratelimit import RateLimitExceeded
+from application.apps.oauth.tokens import TokenManager
+from application.apps.oauth.transport import get_transport
+from application.apps.patients.bulk import (
+    PatientBulkWriter, PatientCopyLoader, format_provider_datetime,
+    parse_provider_datetime, patient_fields,
+)
+from application.apps.patients.checkpoints import SyncCheckpoint
+from application.apps.patients.models import Patient, PatientSync, PatientUser
+from application.apps.patients.pipeline import prefetch
+from application.apps.patients.provider import predict_page_urls, same_url
+from application.apps.patients.telemetry import SyncTelemetry
+from application.apps.patients.versions import bump_sync_version_on_commit
 
 logger = logging.getLogger(__name__)
 
@@ -10,31 +29,246 @@ class PatientMigrator:
     '''
     This class sync patient data from drchrono
     '''
-    patients_data_url = 'https://drchrono.com/api/patients'
+    patients_data_url = settings.DRCHRONO_PATIENTS_API_URL
 
-    def __init__(self, user):
+    def __init__(self, user, members=(), interactive: bool = False):
         self.user = user
+        # users with the same provider visibility (see practice.get_crawl_group),
+        # the crawl is written for them too, but only the token owner is unlinked
+        # from unseen patients
+        self.members = [member for member in members if member.pk != user.pk]
+        self.stats = Counter()
+        self.members_stats = Counter()
+        # counters of interrupted attempts, already recorded
+        self.resumed_stats = Counter()
+        self.error_message = ''
+        self.is_full_sync = True
+        self.is_complete = False
+        # interactive syncs take priority in provider rate limits
+        self.tokens = TokenManager(user.pk, interactive=interactive)
+        # resolved and refreshed on the caller's thread only,
+        # fetch threads don't touch the ORM
+        self.access_token = None
+        self.is_token_rejected = False
+        self.telemetry = SyncTelemetry()
 
     def sync_patients(self):
         '''
         Main interface.
         Returns data and status message.
         status_message - is string with some possibly text (response warning for example)
+
+        Pages are written as soon as they are fetched, while the next page is
+        being downloaded, so memory is bounded by the page size. On provider
+        failure already fetched pages stay written and an error is returned
+        only when nothing was fetched.
+
+        Only patients updated since the latest seen `updated_at` are requested,
+        unless full sync is due (see DRCHRONO_PATIENTS_FULL_SYNC_INTERVAL).
+
+        Timings and counters of the sync are kept in `telemetry`
+        and added to aggregated metrics.
+
+        Every written page is checkpointed (see SyncCheckpoint), a crawl interrupted
+        by provider failure, worker death or DRCHRONO_PATIENTS_SYNC_TIME_BUDGET
+        is resumed by the next sync from the latest committed page.
+        Such crawl leaves `is_complete` unset.
         '''
+        with self.telemetry.measure():
+            is_ok, status_message = self._sync_patients()
+
+        telemetry = self.telemetry.as_dict(self.stats)
+        logger.info(f'Synced patients of user {self.user.pk}: {telemetry}')
+        self.telemetry.record(is_ok, self.stats + self.members_stats - self.resumed_stats)
+        return is_ok, status_message
+
+    def _sync_patients(self):
         is_ok = True
         status_message = ''
 
-        patients_from_provider, error_message = self._get_patients_list_from_provider()
-        if error_message:
-            return False, error_message
+        self.access_token = self.tokens.get_access_token()
+        if self.access_token is None:
+            return False, "Didn't found social auth session record"
+
+        sync_state = PatientSync.objects.get_or_create(user=self.user)[0]
+        member_states = [
+            PatientSync.objects.get_or_create(user=member)[0] for member in self.members
+        ]
+        checkpoint = SyncCheckpoint(self.user.pk, [sync_state] + member_states)
+        resumed = checkpoint.load()
+        if resumed is not None:
+            logger.info(
+                f'Resuming patients sync of user {self.user.pk} from {resumed["url"]}'
+            )
+            started_at = resumed['started_at']
+            self.is_full_sync = resumed['is_full_sync']
+            start_url = resumed['url']
+            updated_since = resumed['updated_since']
+            member_ids = resumed['member_ids']
+            self.stats.update(resumed['stats'])
+            self.members_stats.update(resumed['members_stats'])
+            self.resumed_stats = self.stats + self.members_stats
+        else:
+            started_at = timezone.now()
+            self.is_full_sync = self._is_full_sync_due(sync_state, started_at)
+            start_url = self.patients_data_url
+            if not self.is_full_sync:
+                since = format_provider_datetime(sync_state.updated_since)
+                start_url = f'{start_url}?{urlencode({"since": since})}'
+            updated_since = None
+            member_ids = self._get_caught_up_members(sync_state, member_states)
+
+        # members who missed changes before the crawl's `since` sync with their own token
+        self.members = [member for member in self.members if member.pk in member_ids]
+        member_states = [state for state in member_states if state.user_id in member_ids]
 
-        self._match_user_patients(patients_from_provider)
+        def save_checkpoint(url):
+            checkpoint.save(
+                url, self.is_full_sync, started_at, updated_since, member_ids,
+                self.stats, self.members_stats,
+            )
+
+        generation = sync_state.generation
+        if self.is_full_sync:
+            generation += 1
+        writers = [PatientBulkWriter(
+            self.user,
+            generation=generation,
+            mark_seen=self.is_full_sync,
+            telemetry=self.telemetry,
+        )]
+        writers.extend(
+            PatientBulkWriter(
+                member, generation=state.generation, telemetry=self.telemetry
+            )
+            for member, state in zip(self.members, member_states)
+        )
+        # interrupted COPY load is finished with streamed writes,
+        # so its pages get checkpoints
+        is_staged = resumed is None and self._is_initial_load(sync_state)
+        if is_staged:
+            writers[0] = PatientCopyLoader(
+                self.user, generation=generation, telemetry=self.telemetry
+            )
+            save_checkpoint(start_url)
+
+        deadline = time.monotonic() + settings.DRCHRONO_PATIENTS_SYNC_TIME_BUDGET
+        self.is_complete = True
+        url = start_url
+        fetched = 0  # by this attempt, `stats` include resumed counters
+        for page, url in self._iter_prefetched_pages(start_url):
+            fetched += len(page)
+            self.stats['fetched'] += len(page)
+            self.stats.update(self._match_user_patients(page, writers[0]))
+            for writer in writers[1:]:
+                self.members_stats.update(self._match_user_patients(page, writer))
+            updated_since = max(filter(None, [updated_since] + [
+                parse_provider_datetime(patient.get('updated_at')) for patient in page
+            ]), default=None)
+            if not is_staged:
+                save_checkpoint(url)
+            if url and time.monotonic() > deadline:
+                logger.info(
+                    f'Patients sync of user {self.user.pk} is out of time budget, '
+                    f'stopped at {url}'
+                )
+                self.is_complete = False
+                break
+
+        # staged pages are merged even after provider failure, as streamed ones are
+        self.stats.update(writers[0].flush())
+        for writer in writers[1:]:
+            self.members_stats.update(writer.flush())
+
+        if self.error_message or not self.is_complete:
+            self.is_complete = False
+            save_checkpoint(url)
+            # pages are not ordered by updated_at,
+            # so the watermark moves only after complete crawl
+            if not fetched:
+                return False, self.error_message
+            return is_ok, status_message
+
+        if self.is_full_sync:
+            with self.telemetry.phase('unlink'):
+                self.stats.update(writers[0].unlink_unseen())
+            sync_state.generation = generation
+            sync_state.full_synced_at = started_at
+        # patients changed on provider while the crawl was running may be missed by it,
+        # so the watermark never passes the crawl start (minus clock skew)
+        # and they are asked again
+        if updated_since is not None:
+            skew = timedelta(seconds=settings.DRCHRONO_PATIENTS_WATERMARK_SKEW)
+            updated_since = min(updated_since, started_at - skew)
+        # members got every change the token owner got since the crawl's `since`
+        for state in [sync_state] + member_states:
+            state.updated_since = max(
+                filter(None, [state.updated_since, updated_since]), default=None
+            )
+            state.save()
+        checkpoint.delete()
 
         return is_ok, status_message
 
-    def _get_patients_list_from_provider(self):
+    def _is_initial_load(self, sync_state) -> bool:
+        '''
+        First sync of a user without shared practice crawl and without patients
+        is loaded through COPY, there is nothing to diff against
+        '''
+        return (
+            settings.DRCHRONO_PATIENTS_INITIAL_LOAD_COPY
+            and not self.members
+            and sync_state.full_synced_at is None
+            and not self.user.patients.exists()
+        )
+
+    def _get_caught_up_members(self, sync_state, member_states: list) -> set:
+        '''
+        Full crawl is written for every member, incremental one only for members
+        who have seen changes up to its `since`
+        '''
+        return {
+            state.user_id for state in member_states
+            if self.is_full_sync or (
+                state.updated_since is not None
+                and state.updated_since >= sync_state.updated_since
+            )
+        }
+
+    def _is_full_sync_due(self, sync_state, now) -> bool:
+        if not sync_state.updated_since or sync_state.full_synced_at is None:
+            return True
+        interval = timedelta(seconds=settings.DRCHRONO_PATIENTS_FULL_SYNC_INTERVAL)
+        return sync_state.full_synced_at + interval <= now
+
+    def _iter_prefetched_pages(self, start_url: str):
+        '''
+        Yields pages of `_iter_patients_pages_from_provider` fetched ahead
+        in a background thread. Access token rejected by provider is refreshed
+        here, on the caller's thread, once per sync and the crawl goes on
+        from the rejected page.
         '''
-        drchrono paitents endpoint response example:
+        url = start_url
+        is_refreshed = False
+        while url:
+            self.is_token_rejected = False
+            pages = self._iter_patients_pages_from_provider(url)
+            depth = settings.DRCHRONO_PATIENTS_PREFETCH_PAGES
+            for page, url in prefetch(pages, depth=depth):
+                yield page, url
+            if not self.is_token_rejected or is_refreshed:
+                return
+            is_refreshed = True
+            fresh_token = self.tokens.refresh(stale_token=self.access_token)
+            if not fresh_token or fresh_token == self.access_token:
+                return
+            self.access_token = fresh_token
+
+    def _iter_patients_pages_from_provider(self, start_url: str):
+        '''
+        Yields `results` of drchrono paitents endpoint page by page
+        with URL of the next page (None after the last one).
+        Response example:
         {
             "next": null,
             "previous": null,
@@ -51,78 +285,122 @@ class PatientMigrator:
                 }
             ]
         }
+        On failure stops and keeps provider message in `error_message`.
+
+        With DRCHRONO_PATIENTS_FETCH_CONCURRENCY > 1 pages with predictable
+        (page/offset based) URLs are fetched concurrently and yielded in order,
+        cursor based pages are followed one by one.
         '''
-        patients = []
-        error_message = ''
+        self.error_message = ''
 
-        auth = self.user.social_auth.filter(provider='drchrono').first()
+        transport = get_transport()
+        concurrency = settings.DRCHRONO_PATIENTS_FETCH_CONCURRENCY
+        executor = None
+        if concurrency > 1:
+            executor = ThreadPoolExecutor(max_workers=concurrency)
 
-        if auth is None:
-            return patients, "Didn't found social auth session record"
+        try:
+            url = start_url
+            while url:
+                response, self.error_message = self._fetch_page(transport, url)
+                if response is None:
+                    return
 
-        headers = {'Authorization': f'Bearer {auth.access_token}'}
+                next_url = self._get_next_url(url, response)
 
-        next_url = self.patients_data_url
-        while next_url:
-            try:
-                raw_response = requests.get(next_url, headers=headers)
-            except Exception as exc:
-                logger.warning('Issues with connection to data provider', exc_info=True)
-                break
+                if 'results' in response:
+                    yield response['results'], next_url
+
+                predict_url = next_url and executor and predict_page_urls(url, next_url)
+                if predict_url:
+                    next_url = yield from self._iter_predicted_pages(
+                        executor, transport, predict_url, concurrency
+                    )
 
-            if raw_response.status_code != 200:
-                response_message = raw_response.text or raw_response.reason
-                logger.info(f'Issues with geting data from provider: {response_message}')
+                url = next_url
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _iter_predicted_pages(self, executor, transport, predict_url, concurrency: int):
+        '''
+        Fetches windows of `concurrency` predicted pages at once.
+        Returns URL to continue serially from when provider `next` link
+        does not match the prediction, otherwise None.
+        '''
+        index = 0
+        while True:
+            urls = [predict_url(index + offset) for offset in range(concurrency)]
+            futures = [executor.submit(self._fetch_page, transport, url) for url in urls]
+            try:
+                for offset, (url, future) in enumerate(zip(urls, futures)):
+                    response, self.error_message = future.result()
+                    if response is None:
+                        return None
 
-                if not patients:
-                    error_message = response_message
+                    next_url = self._get_next_url(url, response)
 
-                return patients, error_message
+                    if 'results' in response:
+                        yield response['results'], next_url
+                    predicted_next_url = predict_url(index + offset + 1)
+                    if next_url is None or not same_url(next_url, predicted_next_url):
+                        return next_url
+            finally:
+                for future in futures:
+                    future.cancel()
 
-            response = raw_response.json()
+            index += concurrency
 
-            if next_url is not None and response['next'] == next_url:
-                next_url = None
-            else:
-                next_url = response['next']
+    def _fetch_page(self, transport, url: str):
+        '''
+        Returns decoded page and error message
+        '''
+        started = time.monotonic()
+        try:
+            with self.telemetry.phase('fetch'):
+                raw_response = self.tokens.send(
+                    transport, 'GET', url, self.access_token,
+                    on_retry=self.telemetry.count_retry,
+                )
+        except RateLimitExceeded as exc:
+            logger.warning(f'Provider rate limit of user {self.user.pk} is exhausted')
+            return None, str(exc)
+        except Exception as exc:
+            logger.warning('Issues with connection to data provider', exc_info=True)
+            return None, 'Issues with connection to data provider'
+        self.telemetry.add_request(time.monotonic() - started, len(raw_response.content))
 
-            if 'results' in response:
-                patients.extend(response['results'])
+        if raw_response.status_code != 200:
+            self.is_token_rejected = raw_response.status_code == 401
+            response_message = raw_response.text or raw_response.reason
+            logger.info(f'Issues with geting data from provider: {response_message}')
+            return None, response_message
 
-        return patients, error_message
+        with self.telemetry.phase('decode'):
+            return raw_response.json(), ''
 
-    def _match_user_patients(self, patients_from_provider: list):
-        exist_patients = self.user.patients.values_list('internal_id', 'internal_updated_at')
-        exist_patients_info = {
-            patient_id: patient_updated_at for patient_id, patient_updated_at in exist_patients
-            }
+    def _get_next_url(self, url: str, response: dict):
+        if response['next'] == url:
+            return None
+        return response['next']
 
-        for patient in patients_from_provider:
-            if str(patient['id']) not in exist_patients_info:
-                self.add_new_patient(patient)
-            elif patient['updated_at'] != exist_patients_info[str(patient['id'])]:
-                self.update_patient_info(patient)
+    def _match_user_patients(self, patients_from_provider: list, writer=None):
+        writer = writer or PatientBulkWriter(self.user)
+        return writer.write(patients_from_provider)
 
     def add_new_patient(self, patient: dict):
         new_patient, _ = Patient.objects.get_or_create(
-            internal_id=str(patient['id']),
-            defaults={
-                'first_name': patient.get('first_name', ''),
-                'last_name': patient.get('last_name', ''),
-                'birth_date': patient.get('date_of_birth'),
-                'phone_number': patient.get('home_phone', '') or patient.get('cell_phone', '') or patient.get('office_phone', ''),
-                'photo': patient.get('patient_photo'),
-                'internal_updated_at': patient.get('updated_at', ''),
-            }
+            internal_id=int(patient['id']),
+            defaults=patient_fields(patient),
         )
-        self.user.patients.add(new_patient)
+        PatientUser.objects.get_or_create(patient=new_patient, user=self.user)
+        bump_sync_version_on_commit(self.user.pk)
 
     def update_patient_info(self, patient: dict):
-        self.user.patients.filter(internal_id=str(patient['id'])).update(
-            first_name=patient.get('first_name', ''),
-            last_name=patient.get('last_name', ''),
-            birth_date=patient.get('date_of_birth'),
-            phone_number=patient.get('home_phone', '') or patient.get('cell_phone', '') or patient.get('office_phone', ''),
-            photo=patient.get('patient_photo'),
-            internal_updated_at=patient.get('updated_at', ''),
-        )
+        internal_id = int(patient['id'])
+        self.user.patients.filter(
+            internal_id=internal_id
+        ).update(**patient_fields(patient))
+        bump_sync_version_on_commit(*PatientUser.objects.filter(
+            patient__internal_id=internal_id
+        ).values_list('user_id', flat=True))
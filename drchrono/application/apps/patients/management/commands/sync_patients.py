@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from application.apps.patients.scheduler import FleetSyncScheduler
+from application.apps.patients.tasks import process_sync_queue, run_patients_sync
+from application.apps.patients.webhooks import process_patient_events
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Syncs patients of given users or runs background sync, events or fleet worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Users to sync right now')
+        parser.add_argument(
+            '--worker',
+            action='store_true',
+            help='Process sync requests queued by patients page',
+        )
+        parser.add_argument(
+            '--events',
+            action='store_true',
+            help='Apply patient events queued by drchrono webhooks',
+        )
+        parser.add_argument(
+            '--fleet',
+            action='store_true',
+            help='Keep patients of all active users fresh',
+        )
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            self.stdout.write('Waiting for sync requests...')
+            while True:
+                close_old_connections()
+                user_id = process_sync_queue()
+                if user_id is not None:
+                    self.stdout.write(f'Synced user {user_id}')
+
+        if options['events']:
+            self.stdout.write('Waiting for patient events...')
+            while True:
+                close_old_connections()
+                stats = process_patient_events()
+                self.stdout.write(f'Applied patient events: {dict(stats)}')
+
+        if options['fleet']:
+            self.stdout.write('Syncing stale users...')
+            FleetSyncScheduler().run_forever()
+
+        for user in User.objects.filter(username__in=options['usernames']):
+            status = run_patients_sync(user, force=True, wait=True, interactive=True)
+            if not status['is_synced']:
+                message = 'not synced, other sync of the user is running'
+            elif status['status_message']:
+                message = status['status_message']
+            else:
+                message = 'ok' if status['is_complete'] else 'not complete, queued again'
+            self.stdout.write(f'{user.username}: {message}')
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+
+class QueryCountMiddleware:
+    '''
+    Adds number of database queries issued by the request in X-Query-Count header.
+    Enabled with DRCHRONO_QUERY_COUNT_HEADER, used by load tests.
+    '''
+
+    def __init__(self, get_response):
+        if not settings.DRCHRONO_QUERY_COUNT_HEADER:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        response['X-Query-Count'] = str(queries)
+        return response
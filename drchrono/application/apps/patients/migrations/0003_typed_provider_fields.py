@@ -0,0 +1,97 @@
+# Generated by Django 2.1.2 on 2026-10-18 10:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('patients', '0002_patientsync'),
+    ]
+
+    operations = [
+        # existing auto-created M2M table becomes explicit through model
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='PatientUser',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='patients.Patient')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'patients_patient_user',
+                    },
+                ),
+                migrations.AlterUniqueTogether(
+                    name='patientuser',
+                    unique_together={('patient', 'user')},
+                ),
+                migrations.AlterField(
+                    model_name='patient',
+                    name='user',
+                    field=models.ManyToManyField(related_name='patients', through='patients.PatientUser', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='internal_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+        # provider timestamps are stored as UTC, empty strings become NULL
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql=(
+                        "ALTER TABLE patients_patient ALTER COLUMN internal_updated_at DROP NOT NULL, "
+                        "ALTER COLUMN internal_updated_at TYPE timestamp with time zone "
+                        "USING NULLIF(internal_updated_at, '')::timestamp AT TIME ZONE 'UTC'"
+                    ),
+                    reverse_sql=(
+                        "ALTER TABLE patients_patient ALTER COLUMN internal_updated_at TYPE varchar(100) "
+                        "USING COALESCE(to_char(internal_updated_at AT TIME ZONE 'UTC', "
+                        "'YYYY-MM-DD\"T\"HH24:MI:SS'), ''), "
+                        "ALTER COLUMN internal_updated_at SET NOT NULL"
+                    ),
+                ),
+                migrations.RunSQL(
+                    sql=(
+                        "ALTER TABLE patients_patientsync ALTER COLUMN updated_since DROP NOT NULL, "
+                        "ALTER COLUMN updated_since TYPE timestamp with time zone "
+                        "USING NULLIF(updated_since, '')::timestamp AT TIME ZONE 'UTC'"
+                    ),
+                    reverse_sql=(
+                        "ALTER TABLE patients_patientsync ALTER COLUMN updated_since TYPE varchar(100) "
+                        "USING COALESCE(to_char(updated_since AT TIME ZONE 'UTC', "
+                        "'YYYY-MM-DD\"T\"HH24:MI:SS'), ''), "
+                        "ALTER COLUMN updated_since SET NOT NULL"
+                    ),
+                ),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='patient',
+                    name='internal_updated_at',
+                    field=models.DateTimeField(null=True),
+                ),
+                migrations.AlterField(
+                    model_name='patientsync',
+                    name='updated_since',
+                    field=models.DateTimeField(null=True),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['internal_id', 'internal_updated_at'], name='patient_internal_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientuser',
+            index=models.Index(fields=['user', 'patient'], name='patient_user_user_patient_idx'),
+        ),
+    ]
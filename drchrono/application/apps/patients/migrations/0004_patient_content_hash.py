@@ -0,0 +1,26 @@
+# Generated by Django 2.1.2 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0003_typed_provider_fields'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patient_internal_updated_idx',
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['internal_id', 'content_hash'], name='patient_internal_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.2 on 2026-10-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0004_patient_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientsync',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='patientuser',
+            name='sync_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
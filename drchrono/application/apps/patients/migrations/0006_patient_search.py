@@ -0,0 +1,89 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+TRIGRAM_INDEXES = (
+    ('patient_first_name_trgm_idx', 'UPPER(first_name) gin_trgm_ops'),
+    ('patient_last_name_trgm_idx', 'UPPER(last_name) gin_trgm_ops'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    '''
+    Fuzzy name search needs pg_trgm, databases without the extension
+    are left with prefix search only (see search.is_fuzzy_search_available)
+    '''
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, expression in TRIGRAM_INDEXES:
+            cursor.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                f'ON patients_patient USING gin ({expression})'
+            )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name, _ in TRIGRAM_INDEXES:
+            cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+    # indexes are built CONCURRENTLY, patients table stays writable
+    atomic = False
+
+    dependencies = [
+        ('patients', '0005_sync_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='phone_digits',
+            field=models.CharField(blank=True, max_length=250),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE patients_patient SET phone_digits = regexp_replace(phone_number, '\\D', '', 'g')",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='patient',
+                    index=models.Index(fields=['birth_date'], name='patient_birth_date_idx'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql='CREATE INDEX CONCURRENTLY patient_birth_date_idx ON patients_patient (birth_date)',
+                    reverse_sql='DROP INDEX CONCURRENTLY patient_birth_date_idx',
+                ),
+            ],
+        ),
+        # prefix searches are UPPER(column) LIKE 'PREFIX%', pattern ops serve them in any collation
+        migrations.RunSQL(
+            sql=(
+                'CREATE INDEX CONCURRENTLY patient_first_name_prefix_idx '
+                'ON patients_patient (UPPER(first_name) text_pattern_ops)'
+            ),
+            reverse_sql='DROP INDEX CONCURRENTLY patient_first_name_prefix_idx',
+        ),
+        migrations.RunSQL(
+            sql=(
+                'CREATE INDEX CONCURRENTLY patient_last_name_prefix_idx '
+                'ON patients_patient (UPPER(last_name) text_pattern_ops)'
+            ),
+            reverse_sql='DROP INDEX CONCURRENTLY patient_last_name_prefix_idx',
+        ),
+        migrations.RunSQL(
+            sql=(
+                'CREATE INDEX CONCURRENTLY patient_phone_digits_prefix_idx '
+                'ON patients_patient (phone_digits varchar_pattern_ops)'
+            ),
+            reverse_sql='DROP INDEX CONCURRENTLY patient_phone_digits_prefix_idx',
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.1.2 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+KEYSET_INDEXES = (
+    ('patient_last_name_id_idx', ['last_name', 'id']),
+    ('patient_first_name_id_idx', ['first_name', 'id']),
+)
+
+
+class Migration(migrations.Migration):
+    # indexes are built CONCURRENTLY, patients table stays writable
+    atomic = False
+
+    dependencies = [
+        ('patients', '0006_patient_search'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='patient',
+                    index=models.Index(fields=fields, name=name),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql=(
+                        f'CREATE INDEX CONCURRENTLY {name} '
+                        f'ON patients_patient ({", ".join(fields)})'
+                    ),
+                    reverse_sql=f'DROP INDEX CONCURRENTLY {name}',
+                ),
+            ],
+        )
+        for name, fields in KEYSET_INDEXES
+    ]
@@ -3,14 +3,71 @@ from model_utils.models import TimeStampedModel
 
 
 class Patient(TimeStampedModel):
-    user = models.ManyToManyField('auth.User', related_name='patients')
+    user = models.ManyToManyField(
+        'auth.User', related_name='patients', through='PatientUser'
+    )
     first_name = models.CharField(max_length=250)
     last_name = models.CharField(max_length=250)
     birth_date = models.DateField(null=True)
     phone_number = models.CharField(max_length=250, blank=True)
+    # phone_number without formatting, for search
+    phone_digits = models.CharField(max_length=250, blank=True)
     photo = models.CharField(max_length=500, null=True)
-    internal_id = models.CharField(max_length=100, unique=True)  # patient's ID on provider
-    internal_updated_at = models.CharField(max_length=100)  # patient's updated_at on provider
+    internal_id = models.BigIntegerField(unique=True)  # patient's ID on provider
+    # patient's updated_at on provider
+    internal_updated_at = models.DateTimeField(null=True)
+    # fingerprint of stored fields
+    content_hash = models.CharField(max_length=40, blank=True)
+
+    class Meta:
+        indexes = [
+            # covers sync diff: provider ID lookup with fingerprint comparison
+            models.Index(
+                fields=['internal_id', 'content_hash'], name='patient_internal_hash_idx'
+            ),
+            models.Index(fields=['birth_date'], name='patient_birth_date_idx'),
+            # keyset pages ordered by name seek (name, id) in index order
+            models.Index(fields=['last_name', 'id'], name='patient_last_name_id_idx'),
+            models.Index(fields=['first_name', 'id'], name='patient_first_name_id_idx'),
+            # name prefix, fuzzy name and phone search indexes are expression
+            # and opclass ones, they are created by 0006_patient_search migration
+        ]
+
+    def __str__(self):
+        return str(self.internal_id)
+
+
+class PatientUser(models.Model):
+    '''
+    Link of patient to user who has access to him on provider
+    '''
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    # latest full sync which has seen the link
+    sync_generation = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'patients_patient_user'
+        unique_together = ('patient', 'user')
+        indexes = [
+            # covers user's list ordered by patient and user's side of sync diff join
+            models.Index(
+                fields=['user', 'patient'], name='patient_user_user_patient_idx'
+            ),
+        ]
+
+
+class PatientSync(TimeStampedModel):
+    '''
+    Per-user state of patients synchronization with provider
+    '''
+    user = models.OneToOneField(
+        'auth.User', related_name='patient_sync', on_delete=models.CASCADE
+    )
+    # latest patient's updated_at on provider
+    updated_since = models.DateTimeField(null=True)
+    full_synced_at = models.DateTimeField(null=True)
+    generation = models.PositiveIntegerField(default=0)  # number of the latest full sync
 
     def __str__(self):
-        return self.internal_id
+        return f'{self.user_id}: {self.updated_since}'
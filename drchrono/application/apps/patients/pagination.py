@@ -0,0 +1,150 @@
+import base64
+import binascii
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    '''
+    Page of keyset paginator, mimics django.core.paginator.Page iteration
+    '''
+
+    def __init__(self, object_list: list, next_cursor: str, previous_cursor: str,
+                 count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    '''
+    Seek pagination over (sort field, id) of model instances, `values()` rows
+    or `values_list()` rows of given `fields`.
+    Cursor encodes the boundary row of the page, so every page is one
+    index range scan without COUNT(*) or OFFSET.
+    Total count is optional and cached under `count_cache_key`.
+    '''
+
+    def __init__(self, queryset, page_size: int, sort_field: str = 'id',
+                 count_cache_key: str = None, count_cache_ttl: int = None,
+                 fields: tuple = None):
+        self.queryset = queryset
+        self.fields = fields
+        self.page_size = page_size
+        self.sort_field = sort_field
+        self.count_cache_key = count_cache_key
+        self.count_cache_ttl = count_cache_ttl
+
+    def get_page(self, cursor: str = None) -> KeysetPage:
+        try:
+            position = self.decode_cursor(cursor) if cursor else None
+        except InvalidCursor:
+            position = None
+
+        backwards = position is not None and position['direction'] == 'previous'
+        queryset = self.queryset.order_by(*self._ordering(reverse=backwards))
+        if position is not None:
+            queryset = queryset.filter(
+                self._seek(position['key'], position['id'], backwards)
+            )
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if backwards:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or backwards:
+                next_cursor = self.encode_cursor(rows[-1], 'next')
+            if position is not None and (has_more or not backwards):
+                previous_cursor = self.encode_cursor(rows[0], 'previous')
+
+        return KeysetPage(rows, next_cursor, previous_cursor, count=self.count())
+
+    def get_cursor_key(self, cursor: str = None) -> str:
+        '''
+        Digest of the position the cursor points at, for cache keys.
+        Empty for the first page and for invalid cursors, which are served
+        the first page too, so junk cursors never make new cache entries.
+        '''
+        try:
+            position = self.decode_cursor(cursor) if cursor else None
+        except InvalidCursor:
+            position = None
+        if position is None:
+            return ''
+        boundary = [position['direction'], position['key'], position['id']]
+        return hashlib.sha1(json.dumps(boundary).encode()).hexdigest()
+
+    def count(self):
+        if self.count_cache_key is None:
+            return None
+        return cache.get_or_set(
+            self.count_cache_key, self.queryset.count, self.count_cache_ttl
+        )
+
+    def encode_cursor(self, row, direction: str) -> str:
+        if isinstance(row, dict):
+            key, row_id = row[self.sort_field], row['id']
+        elif isinstance(row, tuple):
+            key = row[self.fields.index(self.sort_field)]
+            row_id = row[self.fields.index('id')]
+        else:
+            key, row_id = getattr(row, self.sort_field), row.pk
+        position = {'key': key, 'id': row_id, 'direction': direction}
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def decode_cursor(self, cursor: str) -> dict:
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (binascii.Error, UnicodeError, ValueError):
+            raise InvalidCursor(cursor)
+
+        if not isinstance(position, dict) or {'key', 'id', 'direction'} - set(position):
+            raise InvalidCursor(cursor)
+        # values go to the seek filter, so only scalars of expected types are taken
+        if (
+            type(position['id']) is not int
+            or position['direction'] not in ('next', 'previous')
+            or isinstance(position['key'], (dict, list, bool))
+            or (self.sort_field == 'id' and type(position['key']) is not int)
+        ):
+            raise InvalidCursor(cursor)
+        return position
+
+    def _ordering(self, reverse: bool) -> list:
+        prefix = '-' if reverse else ''
+        if self.sort_field == 'id':
+            return [f'{prefix}id']
+        return [f'{prefix}{self.sort_field}', f'{prefix}id']
+
+    def _seek(self, key, row_id, backwards: bool) -> Q:
+        lookup = 'lt' if backwards else 'gt'
+        if self.sort_field == 'id':
+            return Q(**{f'id__{lookup}': row_id})
+        return (
+            Q(**{f'{self.sort_field}__{lookup}': key})
+            | Q(**{self.sort_field: key, f'id__{lookup}': row_id})
+        )
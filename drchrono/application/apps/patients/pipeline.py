@@ -0,0 +1,47 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def prefetch(iterable, depth: int = 1):
+    '''
+    Iterates over `iterable` in a background thread, keeping at most `depth`
+    items ahead of the consumer, so producing item N+1 overlaps with
+    consuming item N. Exceptions of the producer are re-raised in the consumer.
+    '''
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item, exc=None):
+        while not stop.is_set():
+            try:
+                items.put((item, exc), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as exc:
+            put(_DONE, exc)
+        else:
+            put(_DONE)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
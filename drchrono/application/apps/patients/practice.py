@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from application.apps.patients.handlers import PatientMigrator
+from application.locks import CacheLock
+
+User = get_user_model()
+
+PRACTICE_CRAWL_KEY = 'drchrono_practice_crawl:{practice_group}:{doctor}'
+PRACTICE_LOCK_KEY = 'drchrono_practice_sync_lock:{practice_group}:{doctor}'
+
+
+def get_crawl_group(extra_data: dict):
+    '''
+    Users acting for the same doctor of the same practice group see the same
+    provider patients, so they can share a crawl. Returns (practice group, doctor)
+    or None when user's visibility is not known to match anybody else's.
+    '''
+    practice_group = (extra_data or {}).get('practice_group')
+    doctor = (extra_data or {}).get('doctor')
+    if practice_group is None or doctor is None:
+        return None
+    return practice_group, doctor
+
+
+def get_user_crawl_group(user):
+    auth = user.social_auth.filter(provider='drchrono').first()
+    if auth is None:
+        return None
+    return get_crawl_group(auth.extra_data)
+
+
+class PracticeSyncCoordinator:
+    '''
+    Coalesces patients crawls of users with the same provider visibility
+    (see get_crawl_group): the list is fetched once with token of the requesting
+    user and written for other members of the group. Other users are synced
+    with their own token. Successful crawl of the group is reused by its members
+    during DRCHRONO_PRACTICE_CRAWL_TTL.
+    '''
+
+    def __init__(self, user, interactive: bool = False):
+        self.user = user
+        self.interactive = interactive
+        self.group = get_user_crawl_group(user)
+
+    def get_members(self) -> list:
+        practice_group, doctor = self.group
+        return list(
+            User.objects
+            .filter(
+                social_auth__provider='drchrono',
+                social_auth__extra_data__practice_group=practice_group,
+                social_auth__extra_data__doctor=doctor,
+            )
+            .exclude(pk=self.user.pk)
+            .distinct()
+            .order_by('pk')
+        )
+
+    def sync(self, wait: bool = False, force: bool = False):
+        '''
+        Returns is_ok, status_message, is_complete (see PatientMigrator.is_complete)
+        and users whose patients were written, or None when nothing was synced:
+        recent crawl of the group was reused (unless `force` is set) or the group
+        is being crawled by other worker
+        '''
+        if self.group is None:
+            migrator = PatientMigrator(self.user, interactive=self.interactive)
+            is_ok, status_message = migrator.sync_patients()
+            return is_ok, status_message, migrator.is_complete, [self.user]
+
+        practice_group, doctor = self.group
+        crawl_key = PRACTICE_CRAWL_KEY.format(
+            practice_group=practice_group, doctor=doctor
+        )
+        if not force and cache.get(crawl_key) is not None:
+            return None
+
+        lock = CacheLock(
+            PRACTICE_LOCK_KEY.format(practice_group=practice_group, doctor=doctor),
+            lease=settings.DRCHRONO_PATIENTS_SYNC_LOCK_TTL,
+        )
+        if not lock.acquire():
+            if wait:
+                lock.wait(timeout=settings.DRCHRONO_PATIENTS_SYNC_WAIT_TIMEOUT)
+            return None
+
+        try:
+            members = self.get_members()
+            migrator = PatientMigrator(
+                self.user, members=members, interactive=self.interactive
+            )
+            is_ok, status_message = migrator.sync_patients()
+            if is_ok and migrator.is_complete:
+                cache.set(crawl_key, True, timeout=settings.DRCHRONO_PRACTICE_CRAWL_TTL)
+            # members left out of the crawl (see PatientMigrator) are not synced
+            synced_users = [self.user] + migrator.members
+            return is_ok, status_message, migrator.is_complete, synced_users
+        finally:
+            lock.release()
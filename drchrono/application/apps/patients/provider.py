@@ -0,0 +1,44 @@
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+PAGE_PARAMS = {
+    'page': 1,  # param: value when it is missing in the URL
+    'offset': 0,
+}
+
+
+def predict_page_urls(url: str, next_url: str):
+    '''
+    Returns function which builds URL of the page `index` positions after `next_url`
+    when pagination is page or offset based, otherwise None (cursor pagination).
+    '''
+    query = parse_qs(urlsplit(url).query)
+    next_parts = urlsplit(next_url)
+    next_query = parse_qs(next_parts.query)
+
+    for param, default in PAGE_PARAMS.items():
+        try:
+            current = int(query[param][0]) if param in query else default
+            following = int(next_query[param][0])
+        except (KeyError, ValueError):
+            continue
+
+        step = following - current
+        if step <= 0:
+            return None
+
+        def build(index: int, param=param, following=following, step=step) -> str:
+            page_query = dict(next_query, **{param: [str(following + index * step)]})
+            query = urlencode(page_query, doseq=True)
+            return urlunsplit(next_parts._replace(query=query))
+
+        return build
+
+    return None
+
+
+def same_url(first: str, second: str) -> bool:
+    first_parts, second_parts = urlsplit(first), urlsplit(second)
+    return (
+        first_parts._replace(query='') == second_parts._replace(query='')
+        and parse_qs(first_parts.query) == parse_qs(second_parts.query)
+    )
@@ -0,0 +1,138 @@
+import logging
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from application.apps.patients.practice import get_crawl_group
+from application.apps.patients.tasks import is_sync_fresh, run_patients_sync
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+
+class FleetSyncScheduler:
+    '''
+    Keeps patients of all active drchrono users fresh without page views.
+
+    Every round stale users (see `is_sync_fresh`) are planned by staleness:
+    never synced first, then the longest ago synced, recently logged in users first
+    among equally stale ones. Users who didn't log in for DRCHRONO_FLEET_INACTIVE_DAYS
+    are left to page views.
+
+    A round runs at most `concurrency` syncs at once in a thread pool, so at most
+    that many DB connections are used. Users of one account (users sharing
+    a provider crawl, see get_crawl_group, share one account) are split into
+    `per_user_concurrency` chains synced one after another, so an account
+    never has more syncs running and waiting ones don't hold pool threads.
+    '''
+
+    def __init__(self, concurrency: int = None, per_user_concurrency: int = None,
+                 batch_size: int = None):
+        self.concurrency = concurrency or settings.DRCHRONO_FLEET_CONCURRENCY
+        self.per_user_concurrency = (
+            per_user_concurrency or settings.DRCHRONO_FLEET_PER_USER_CONCURRENCY
+        )
+        self.batch_size = batch_size or settings.DRCHRONO_FLEET_BATCH_SIZE
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def plan(self) -> list:
+        '''
+        Returns (user ID, account key) of stale active users in sync order,
+        users sharing provider crawls share account key
+        '''
+        active_since = timezone.now() - timedelta(
+            days=settings.DRCHRONO_FLEET_INACTIVE_DAYS
+        )
+        users = (
+            User.objects
+            .filter(social_auth__provider='drchrono', is_active=True)
+            .filter(Q(last_login__gte=active_since) | Q(last_login__isnull=True))
+            .order_by(
+                F('patient_sync__modified').asc(nulls_first=True),
+                F('last_login').desc(nulls_last=True),
+                'pk',
+            )
+            .values_list('pk', 'social_auth__extra_data')
+        )
+        planned = {}
+        for user_id, extra_data in users.iterator():
+            if user_id in planned or is_sync_fresh(user_id):
+                continue
+            group = get_crawl_group(extra_data)
+            if group:
+                planned[user_id] = f'group:{group[0]}:{group[1]}'
+            else:
+                planned[user_id] = f'user:{user_id}'
+            if len(planned) >= self.batch_size:
+                break
+        return list(planned.items())
+
+    def run_once(self) -> Counter:
+        planned = self._plan()
+        # users are assigned to account's chains in turn, chains keep the plan order
+        chains = defaultdict(list)
+        account_users = Counter()
+        for user_id, account_key in planned:
+            slot = account_users[account_key] % self.per_user_concurrency
+            chains[(account_key, slot)].append(user_id)
+            account_users[account_key] += 1
+
+        futures = [
+            self.executor.submit(self._sync_chain, user_ids)
+            for user_ids in chains.values()
+        ]
+        stats = Counter()
+        for future in futures:
+            stats.update(future.result())
+        return stats
+
+    def run_forever(self, interval: float = None):
+        '''
+        Runs rounds every `interval` seconds, a failed round is logged
+        and the next one runs as usual
+        '''
+        interval = settings.DRCHRONO_FLEET_INTERVAL if interval is None else interval
+        while True:
+            started = time.monotonic()
+            try:
+                stats = self.run_once()
+            except Exception:
+                logger.exception('Fleet sync round failed')
+            else:
+                logger.info(f'Fleet sync round: {dict(stats)}')
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+    def _sync_chain(self, user_ids: list) -> Counter:
+        return Counter(self._sync_user(user_id) for user_id in user_ids)
+
+    def _plan(self) -> list:
+        close_old_connections()
+        try:
+            return self.plan()
+        finally:
+            close_old_connections()
+
+    def _sync_user(self, user_id: int) -> str:
+        # pool threads are treated as requests: connections are reused up to CONN_MAX_AGE
+        close_old_connections()
+        try:
+            user = User.objects.filter(pk=user_id).first()
+            if user is None:
+                return 'skipped'
+            status = run_patients_sync(user)
+        except Exception:
+            logger.exception(f'Fleet sync of user {user_id} failed')
+            return 'failed'
+        finally:
+            close_old_connections()
+        if not status['is_synced']:
+            return 'skipped'
+        return 'failed' if status.get('status_message') else 'synced'
@@ -0,0 +1,105 @@
+import logging
+from urllib.parse import urlencode
+
+from django import forms
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Upper
+
+from application.apps.patients.bulk import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+MAX_NAME_TERMS = 3
+
+_fuzzy_search_available = None
+
+
+def is_fuzzy_search_available() -> bool:
+    '''
+    Fuzzy search needs pg_trgm, which is installed by 0006_patient_search
+    migration where the database has it
+    '''
+    global _fuzzy_search_available
+    if _fuzzy_search_available is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _fuzzy_search_available = cursor.fetchone() is not None
+        if not _fuzzy_search_available:
+            logger.warning(
+                'pg_trgm is not installed, '
+                'fuzzy patient search falls back to prefix search'
+            )
+    return _fuzzy_search_available
+
+
+class PatientSearchForm(forms.Form):
+    '''
+    Search of user's patients by name prefix (or fuzzy name), date of birth
+    and phone digits prefix. Every condition is served by an index of patients
+    table (see 0006_patient_search), user's links are joined to the matches only.
+    '''
+    name = forms.CharField(required=False, max_length=250)
+    fuzzy = forms.BooleanField(required=False)
+    birth_date = forms.DateField(required=False)
+    phone = forms.CharField(required=False, max_length=250)
+
+    def clean_name(self):
+        return ' '.join(self.cleaned_data['name'].split()[:MAX_NAME_TERMS])
+
+    def clean_phone(self):
+        phone = self.cleaned_data['phone']
+        digits = normalize_phone(phone)
+        if phone and not digits:
+            raise forms.ValidationError('Phone number must contain digits')
+        return digits
+
+    def has_filters(self) -> bool:
+        return self.is_valid() and any(
+            self.cleaned_data[name] for name in ('name', 'birth_date', 'phone')
+        )
+
+    def filter(self, queryset):
+        if not self.has_filters():
+            return queryset
+
+        name = self.cleaned_data['name']
+        if name:
+            fuzzy = self.cleaned_data['fuzzy'] and is_fuzzy_search_available()
+            if fuzzy:
+                queryset = queryset.annotate(
+                    first_name_upper=Upper('first_name'),
+                    last_name_upper=Upper('last_name'),
+                )
+            for term in name.split():
+                condition = (
+                    Q(first_name__istartswith=term) | Q(last_name__istartswith=term)
+                )
+                if fuzzy:
+                    condition |= (
+                        Q(first_name_upper__trigram_similar=term)
+                        | Q(last_name_upper__trigram_similar=term)
+                    )
+                queryset = queryset.filter(condition)
+
+        if self.cleaned_data['birth_date']:
+            queryset = queryset.filter(birth_date=self.cleaned_data['birth_date'])
+        if self.cleaned_data['phone']:
+            queryset = queryset.filter(
+                phone_digits__startswith=self.cleaned_data['phone']
+            )
+        return queryset
+
+    @property
+    def query_string(self) -> str:
+        '''
+        Normalized search parameters for pagination links and cache keys
+        '''
+        if not self.has_filters():
+            return ''
+        params = {
+            name: value.isoformat() if name == 'birth_date' else value
+            for name, value in self.cleaned_data.items()
+            if value
+        }
+        return urlencode(sorted(params.items()))
@@ -0,0 +1,155 @@
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from application.apps.patients.practice import PracticeSyncCoordinator
+from application.locks import CacheLock
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+SYNC_QUEUE_KEY = 'drchrono_patients_sync_queue'
+SYNC_PENDING_KEY = 'drchrono_patients_sync_pending:{user_id}'
+SYNC_STATUS_KEY = 'drchrono_patients_sync_status:{user_id}'
+SYNC_LOCK_KEY = 'drchrono_patients_sync_lock:{user_id}'
+
+
+def run_patients_sync(user, force: bool = False, wait: bool = False,
+                      interactive: bool = False) -> dict:
+    '''
+    Syncs user patients and stores the result as user's sync status:
+    {"synced_at": "<iso datetime>", "status_message": "..."}
+    Returned status also tells whether this call has synced the user and finished
+    the crawl: {..., "is_synced": true, "is_complete": true}
+
+    Complete syncs keep user's data fresh for `get_sync_ttl()`. Crawl interrupted
+    after some pages (see PatientMigrator.is_complete) doesn't make data fresh
+    and is queued again right away to be resumed from its checkpoint,
+    failed sync is retried after DRCHRONO_PATIENTS_CACHE_TTL.
+
+    Users with the same provider visibility share one crawl (see PracticeSyncCoordinator).
+    Only one sync per user runs at a time across all workers. When another
+    sync is running the latest status is returned right away, or after that
+    sync has finished if `wait` is set. Sync is skipped when user's data is
+    fresh unless `force` is set. `interactive` syncs (somebody waits for them)
+    take priority over background ones in provider rate limits.
+    '''
+    lock = CacheLock(
+        SYNC_LOCK_KEY.format(user_id=user.pk),
+        lease=settings.DRCHRONO_PATIENTS_SYNC_LOCK_TTL,
+    )
+    if not lock.acquire():
+        if wait:
+            lock.wait(timeout=settings.DRCHRONO_PATIENTS_SYNC_WAIT_TIMEOUT)
+        return dict(get_sync_status(user.pk), is_synced=False)
+
+    is_requeued = False
+    try:
+        if not force and is_sync_fresh(user.pk):
+            return dict(get_sync_status(user.pk), is_synced=False)
+
+        coordinator = PracticeSyncCoordinator(user, interactive=interactive)
+        result = coordinator.sync(wait=wait, force=force)
+        if result is None:
+            return dict(get_sync_status(user.pk), is_synced=False)
+        is_ok, status_message, is_complete, synced_users = result
+
+        synced_at = datetime.utcnow().isoformat()
+        status = {
+            'synced_at': synced_at,
+            'status_message': '' if is_ok else status_message,
+        }
+        if is_complete:
+            fresh_ttl = get_sync_ttl()
+        else:
+            fresh_ttl = settings.DRCHRONO_PATIENTS_CACHE_TTL
+        for synced_user in synced_users:
+            if is_complete or not is_ok:
+                cache.set(
+                    settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=synced_user.pk),
+                    synced_at,
+                    timeout=fresh_ttl
+                    )
+            cache.set(
+                SYNC_STATUS_KEY.format(user_id=synced_user.pk), status, timeout=None
+            )
+        is_requeued = is_ok and not is_complete
+        return dict(status, is_synced=True, is_complete=is_complete)
+    finally:
+        lock.release()
+        # queued after the lock is released, so the next worker can take the crawl
+        if is_requeued:
+            logger.info(f'Patients sync of user {user.pk} is not complete, queued again')
+            enqueue_patients_sync(user.pk)
+
+
+def is_sync_fresh(user_id: int) -> bool:
+    fresh_key = settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=user_id)
+    return cache.get(fresh_key) is not None
+
+
+def get_sync_ttl() -> int:
+    '''
+    With webhooks changes are pushed, polling only reconciles missed events
+    '''
+    if settings.DRCHRONO_WEBHOOK_SECRET:
+        return settings.DRCHRONO_WEBHOOK_RECONCILE_TTL
+    return settings.DRCHRONO_PATIENTS_CACHE_TTL
+
+
+def get_sync_status(user_id: int) -> dict:
+    return cache.get(SYNC_STATUS_KEY.format(user_id=user_id)) or {}
+
+
+def enqueue_patients_sync(user_id: int) -> bool:
+    '''
+    Puts user to the sync queue unless his sync is already queued or running
+    '''
+    pending_key = SYNC_PENDING_KEY.format(user_id=user_id)
+    pending_ttl = settings.DRCHRONO_PATIENTS_SYNC_PENDING_TTL
+    if not cache.add(pending_key, True, timeout=pending_ttl):
+        return False
+
+    get_redis_connection('default').rpush(SYNC_QUEUE_KEY, user_id)
+    return True
+
+
+def is_sync_pending(user_id: int) -> bool:
+    '''
+    Tells whether user's sync is queued or running
+    '''
+    lock = CacheLock(
+        SYNC_LOCK_KEY.format(user_id=user_id),
+        lease=settings.DRCHRONO_PATIENTS_SYNC_LOCK_TTL,
+    )
+    return bool(cache.get(SYNC_PENDING_KEY.format(user_id=user_id))) or lock.is_locked()
+
+
+def process_sync_queue(timeout: int = 0):
+    '''
+    Waits for one queued user (up to `timeout` seconds, 0 - forever) and syncs him.
+    Returns processed user ID or None when the queue was empty.
+    '''
+    item = get_redis_connection('default').blpop(SYNC_QUEUE_KEY, timeout=timeout)
+    if item is None:
+        return None
+
+    user_id = int(item[1])
+    # cleared before the sync, so the sync can queue its unfinished crawl again
+    cache.delete(SYNC_PENDING_KEY.format(user_id=user_id))
+    try:
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            logger.info(f'Skip sync of removed user {user_id}')
+        else:
+            # queued by page views
+            run_patients_sync(user, interactive=True)
+    except Exception:
+        logger.exception(f'Patients sync of user {user_id} failed')
+
+    return user_id
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.db import connection
+
+from application.metrics import MetricsBatch
+
+ROW_RESULTS = ('inserted', 'updated', 'skipped', 'unlinked')
+
+
+class SyncTelemetry:
+    '''
+    Measurements of one patients sync: time spent in each phase
+    (fetch, decode, diff, write, flush, unlink), provider pages, bytes,
+    retries and database queries.
+    Phases are measured from fetching threads too, so phase times
+    are summed up and may exceed the sync duration.
+    '''
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.counters = Counter()
+        self.request_durations = []
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.phases[name] += elapsed
+
+    @contextmanager
+    def measure(self):
+        '''
+        Measures the whole sync and counts queries issued by the current thread
+        '''
+        def count_query(execute, sql, params, many, context):
+            self.counters['queries'] += 1
+            return execute(sql, params, many, context)
+
+        started = time.monotonic()
+        try:
+            with connection.execute_wrapper(count_query):
+                yield
+        finally:
+            self.duration = time.monotonic() - started
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def count_retry(self, *args, **kwargs):
+        self.count('retries')
+
+    def add_request(self, duration: float, size: int):
+        with self._lock:
+            self.request_durations.append(duration)
+            self.counters['pages'] += 1
+            self.counters['bytes'] += size
+
+    def as_dict(self, stats: Counter) -> dict:
+        return {
+            'duration': round(self.duration, 3),
+            'phases': {name: round(value, 3) for name, value in self.phases.items()},
+            'pages': self.counters['pages'],
+            'bytes': self.counters['bytes'],
+            'retries': self.counters['retries'],
+            'queries': self.counters['queries'],
+            'fetched': stats['fetched'],
+            'rows': {result: stats[result] for result in ROW_RESULTS},
+        }
+
+    def record(self, is_ok: bool, stats: Counter):
+        '''
+        Adds the sync to aggregated metrics (see application.metrics)
+        '''
+        metrics = MetricsBatch()
+        metrics.inc('drchrono_sync_total', status='ok' if is_ok else 'error')
+        metrics.inc('drchrono_sync_pages_total', self.counters['pages'])
+        metrics.inc('drchrono_sync_bytes_total', self.counters['bytes'])
+        metrics.inc('drchrono_sync_retries_total', self.counters['retries'])
+        metrics.inc('drchrono_sync_queries_total', self.counters['queries'])
+        for result in ROW_RESULTS:
+            metrics.inc('drchrono_sync_rows_total', stats[result], result=result)
+        metrics.observe('drchrono_sync_duration_seconds', self.duration)
+        for name, value in self.phases.items():
+            metrics.observe('drchrono_sync_phase_seconds', value, phase=name)
+        for duration in self.request_durations:
+            metrics.observe('drchrono_provider_request_seconds', duration)
+        metrics.commit()
@@ -0,0 +1,15 @@
+def make_raw_patient(patient_id, **kwargs):
+    '''
+    Patient as drchrono patients endpoint returns it, `kwargs` override its fields
+    '''
+    raw_patient = {
+        'id': patient_id,
+        'first_name': 'Mark',
+        'last_name': 'Adams',
+        'date_of_birth': '1958-09-02',
+        'home_phone': '',
+        'photo': None,
+        'updated_at': '2018-03-19T12:25:32',
+    }
+    raw_patient.update(kwargs)
+    return raw_patient
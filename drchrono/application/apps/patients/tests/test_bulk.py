@@ -0,0 +1,96 @@
+from unittest.mock import patch
+
+import fakeredis
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from application.apps.patients.bulk import PatientBulkWriter
+from application.apps.patients.models import Patient
+from application.apps.patients.tests.factories import make_raw_patient
+from application.apps.patients.versions import get_sync_version
+
+User = get_user_model()
+
+
+class PatientBulkWriterTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='testuser', email='admin@acme.test')
+        cls.other_user = User.objects.create(
+            username='otheruser', email='other@acme.test'
+        )
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def test_write_new_patients_success(self):
+        patients = [make_raw_patient(patient_id) for patient_id in range(1, 6)]
+        writer = PatientBulkWriter(self.user, chunk_size=2)
+
+        # diff + savepoint + 3 upsert chunks + 3 link chunks + release savepoint
+        with self.assertNumQueries(9):
+            stats = writer.write(patients)
+
+        self.assertEqual(stats['inserted'], 5)
+        self.assertEqual(stats['updated'], 0)
+        self.assertEqual(stats['linked'], 5)
+        self.assertEqual(self.user.patients.count(), 5)
+
+    def test_write_updates_and_links_shared_patient_success(self):
+        PatientBulkWriter(self.other_user).write([
+            make_raw_patient(1), make_raw_patient(2),
+        ])
+
+        stats = PatientBulkWriter(self.user).write([
+            make_raw_patient(1),
+            make_raw_patient(2, first_name='Markus', updated_at='2018-05-19T12:25:32'),
+        ])
+
+        self.assertEqual(stats['inserted'], 0)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['linked'], 2)
+        self.assertEqual(Patient.objects.count(), 2)
+        self.assertEqual(self.user.patients.count(), 2)
+        self.assertEqual(Patient.objects.get(internal_id=2).first_name, 'Markus')
+
+    def test_write_bumps_versions_after_commit_success(self):
+        version = get_sync_version(self.user.pk)
+
+        with patch('django.db.transaction.on_commit') as on_commit:
+            PatientBulkWriter(self.user).write([make_raw_patient(1)])
+
+        self.assertEqual(get_sync_version(self.user.pk), version)
+        on_commit.call_args[0][0]()
+        self.assertNotEqual(get_sync_version(self.user.pk), version)
+
+    def test_write_without_changes_success(self):
+        patients = [make_raw_patient(1), make_raw_patient(2)]
+        PatientBulkWriter(self.user).write(patients)
+
+        with self.assertNumQueries(1):
+            stats = PatientBulkWriter(self.user).write(patients)
+
+        self.assertEqual(stats, {'skipped': 2})
+
+    def test_write_skips_patients_with_same_content_success(self):
+        PatientBulkWriter(self.user).write([make_raw_patient(1), make_raw_patient(2)])
+        PatientBulkWriter(self.other_user).write([make_raw_patient(3)])
+
+        with self.assertNumQueries(1):
+            stats = PatientBulkWriter(self.user).write([
+                make_raw_patient(1, updated_at='2018-05-19T12:25:32', insurances=[]),
+                make_raw_patient(2, updated_at='2018-05-19T12:25:32', notes='Allergic'),
+            ])
+        self.assertEqual(stats, {'skipped': 2})
+
+        stats = PatientBulkWriter(self.user).write([
+            make_raw_patient(
+                2, home_phone='999-999-999', updated_at='2018-06-19T12:25:32'
+            ),
+            make_raw_patient(3),
+        ])
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['linked'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(Patient.objects.get(internal_id=2).phone_number, '999-999-999')
@@ -0,0 +1,523 @@
+import json
+from datetime import datetime, timedelta
+
+import fakeredis
+import httpretty
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from social_django.models import UserSocialAuth
+
+from application.apps.oauth.backends import DrchronoOAuth2
+from application.apps.patients.bulk import PatientBulkWriter
+from application.apps.patients.checkpoints import SyncCheckpoint
+from application.apps.patients.handlers import PatientMigrator
+from application.apps.patients.models import Patient, PatientSync
+from application.apps.patients.tasks import (
+    is_sync_fresh, is_sync_pending, process_sync_queue, run_patients_sync
+)
+from application.apps.patients.tests.factories import make_raw_patient
+
+User = get_user_model()
+
+
+class PatientMigratorTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='testuser', email='admin@acme.test')
+        UserSocialAuth.objects.create(
+            user=cls.user,
+            uid='1111',
+            provider='drchrono',
+            extra_data={
+                "auth_time": 1541322623,
+                "token_type": "Bearer",
+                "access_token": "HPcpYLicAHxiqhKPsQs6dmNPp8QmTR"
+                }
+            )
+        cls.patient_data_url = PatientMigrator.patients_data_url
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def register_pages(self, pages: dict):
+        def request_callback(request, uri, response_headers):
+            status, body = pages[uri]
+            return [status, response_headers, body if status != 200 else json.dumps(body)]
+
+        for url in pages:
+            httpretty.register_uri(
+                httpretty.GET,
+                url,
+                match_querystring=True,
+                body=request_callback,
+            )
+
+    @httpretty.activate
+    def test_sync_writes_fetched_pages_on_provider_failure_success(self):
+        next_url = f'{self.patient_data_url}?page=2'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': next_url,
+                'previous': None,
+                'results': [make_raw_patient(1), make_raw_patient(2)],
+            }),
+            next_url: (429, 'Over limit'),
+        })
+
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertTrue(is_ok)
+        self.assertEqual(status_message, '')
+        self.assertEqual(migrator.stats['fetched'], 2)
+        self.assertEqual(migrator.stats['inserted'], 2)
+        self.assertEqual(self.user.patients.count(), 2)
+
+    @httpretty.activate
+    def test_sync_telemetry_success(self):
+        fakeredis.FakeStrictRedis().flushall()
+        next_url = f'{self.patient_data_url}?page=2'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': next_url,
+                'previous': None,
+                'results': [make_raw_patient(1), make_raw_patient(2)],
+            }),
+            next_url: (429, 'Over limit'),
+        })
+
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+
+        telemetry = migrator.telemetry.as_dict(migrator.stats)
+        self.assertEqual(telemetry['pages'], 2)
+        self.assertEqual(telemetry['retries'], settings.DRCHRONO_HTTP_MAX_RETRIES)
+        self.assertGreater(telemetry['bytes'], 0)
+        self.assertGreater(telemetry['queries'], 0)
+        self.assertEqual(telemetry['rows']['inserted'], 2)
+        self.assertTrue({'fetch', 'decode', 'write', 'flush'} <= set(telemetry['phases']))
+
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with override_settings(DRCHRONO_METRICS_TOKEN='metrics_token'):
+            response = self.client.get(
+                reverse('metrics'), HTTP_AUTHORIZATION='Bearer metrics_token'
+            )
+        metrics = response.content.decode().splitlines()
+        self.assertIn('# TYPE drchrono_sync_duration_seconds histogram', metrics)
+        self.assertIn('drchrono_sync_duration_seconds_count 1', metrics)
+        self.assertIn('drchrono_sync_total{status="ok"} 1', metrics)
+        self.assertIn('drchrono_sync_rows_total{result="inserted"} 2', metrics)
+        self.assertIn(
+            'drchrono_sync_phase_seconds_bucket{phase="fetch",le="+Inf"} 1', metrics
+        )
+        self.assertIn('drchrono_provider_request_seconds_count 2', metrics)
+
+    @httpretty.activate
+    def test_sync_without_fetched_patients_failed(self):
+        self.register_pages({
+            self.patient_data_url: (429, 'Over limit'),
+        })
+
+        is_ok, status_message = PatientMigrator(self.user).sync_patients()
+
+        self.assertFalse(is_ok)
+        self.assertEqual(status_message, 'Over limit')
+
+    @httpretty.activate
+    @override_settings(DRCHRONO_PATIENTS_FETCH_CONCURRENCY=3)
+    def test_sync_fetches_predictable_pages_concurrently_success(self):
+        pages = {}
+        for page in range(1, 6):
+            url = self.patient_data_url
+            if page > 1:
+                url = f'{self.patient_data_url}?page={page}'
+            pages[url] = (200, {
+                'next': f'{self.patient_data_url}?page={page + 1}' if page < 5 else None,
+                'previous': None,
+                'results': [make_raw_patient(page)],
+            })
+        for page in range(6, 9):
+            pages[f'{self.patient_data_url}?page={page}'] = (404, 'Invalid page.')
+        self.register_pages(pages)
+
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertTrue(is_ok)
+        self.assertEqual(migrator.stats['fetched'], 5)
+        self.assertEqual(
+            list(self.user.patients.order_by('id').values_list('internal_id', flat=True)),
+            [1, 2, 3, 4, 5],
+        )
+
+    @httpretty.activate
+    @override_settings(DRCHRONO_PATIENTS_FETCH_CONCURRENCY=3)
+    def test_sync_refreshes_rejected_token_success(self):
+        auth = UserSocialAuth.objects.get(user=self.user)
+        auth.extra_data['refresh_token'] = 'refresh_token'
+        auth.save()
+        httpretty.register_uri(
+            httpretty.POST,
+            DrchronoOAuth2.ACCESS_TOKEN_URL,
+            body=json.dumps({
+                'access_token': 'new_token',
+                'refresh_token': 'new_refresh_token',
+                'expires_in': 172800,
+                'token_type': 'Bearer',
+            }),
+        )
+
+        def request_callback(request, uri, response_headers):
+            page = int(request.querystring.get('page', ['1'])[0])
+            # the token expires during the crawl
+            if page > 1 and request.headers['Authorization'] != 'Bearer new_token':
+                return [401, response_headers, 'Token expired']
+            return [200, response_headers, json.dumps({
+                'next': f'{self.patient_data_url}?page={page + 1}' if page < 4 else None,
+                'previous': None,
+                'results': [make_raw_patient(page)],
+            })]
+
+        httpretty.register_uri(
+            httpretty.GET, self.patient_data_url, body=request_callback
+        )
+
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertEqual((is_ok, status_message), (True, ''))
+        self.assertTrue(migrator.is_complete)
+        self.assertEqual(migrator.stats['fetched'], 4)
+        self.assertEqual(self.user.patients.count(), 4)
+        auth.refresh_from_db()
+        self.assertEqual(auth.extra_data['access_token'], 'new_token')
+
+    @httpretty.activate
+    @override_settings(DRCHRONO_PATIENTS_FETCH_CONCURRENCY=3)
+    def test_sync_follows_cursor_pages_serially_success(self):
+        next_url = f'{self.patient_data_url}?cursor=cD0yMDE4'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': next_url,
+                'previous': None,
+                'results': [make_raw_patient(1)],
+            }),
+            next_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [make_raw_patient(2)],
+            }),
+        })
+
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertTrue(is_ok)
+        self.assertEqual(migrator.stats['fetched'], 2)
+        self.assertEqual(len(httpretty.httpretty.latest_requests), 2)
+
+    @httpretty.activate
+    def test_sync_requests_patients_updated_since_watermark_success(self):
+        since_url = f'{self.patient_data_url}?since=2018-05-19T12%3A25%3A32'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [
+                    make_raw_patient(1),
+                    make_raw_patient(2, updated_at='2018-05-19T12:25:32'),
+                ],
+            }),
+            since_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [
+                    make_raw_patient(
+                        2, first_name='Markus', updated_at='2018-06-19T12:25:32'
+                    ),
+                ],
+            }),
+        })
+
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+        self.assertTrue(migrator.is_full_sync)
+        sync_state = PatientSync.objects.get(user=self.user)
+        self.assertEqual(
+            sync_state.updated_since,
+            datetime(2018, 5, 19, 12, 25, 32, tzinfo=timezone.utc)
+        )
+        self.assertIsNotNone(sync_state.full_synced_at)
+
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertTrue(is_ok)
+        self.assertFalse(migrator.is_full_sync)
+        self.assertEqual(migrator.stats['fetched'], 1)
+        self.assertEqual(self.user.patients.get(internal_id=2).first_name, 'Markus')
+        sync_state.refresh_from_db()
+        self.assertEqual(
+            sync_state.updated_since,
+            datetime(2018, 6, 19, 12, 25, 32, tzinfo=timezone.utc)
+        )
+
+        sync_state.full_synced_at -= timedelta(days=2)
+        sync_state.save()
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+        self.assertTrue(migrator.is_full_sync)
+        self.assertEqual(migrator.stats['fetched'], 2)
+
+    @httpretty.activate
+    def test_watermark_stays_behind_sync_start_success(self):
+        future_updated_at = (timezone.now() + timedelta(days=1)).replace(microsecond=0)
+        future_updated_at = timezone.make_naive(future_updated_at, timezone.utc)
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [
+                    make_raw_patient(1, updated_at=future_updated_at.isoformat()),
+                ],
+            }),
+        })
+
+        skew = timedelta(seconds=settings.DRCHRONO_PATIENTS_WATERMARK_SKEW)
+        started_at = timezone.now()
+        PatientMigrator(self.user).sync_patients()
+
+        updated_since = PatientSync.objects.get(user=self.user).updated_since
+        self.assertGreaterEqual(updated_since, started_at - skew)
+        self.assertLessEqual(updated_since, timezone.now() - skew)
+
+    @httpretty.activate
+    def test_full_sync_unlinks_patients_removed_on_provider_success(self):
+        other_user = User.objects.create(username='otheruser', email='other@acme.test')
+        PatientBulkWriter(other_user).write([make_raw_patient(3)])
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [
+                    make_raw_patient(1), make_raw_patient(2), make_raw_patient(3),
+                ],
+            }),
+        })
+        PatientMigrator(self.user).sync_patients()
+        self.assertEqual(self.user.patients.count(), 3)
+
+        httpretty.reset()
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [make_raw_patient(1)],
+            }),
+        })
+        PatientSync.objects.filter(user=self.user).update(full_synced_at=None)
+
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+
+        self.assertEqual(migrator.stats['unlinked'], 2)
+        self.assertEqual(migrator.stats['deleted'], 1)
+        self.assertEqual(
+            list(self.user.patients.values_list('internal_id', flat=True)), [1]
+        )
+        self.assertEqual(
+            list(other_user.patients.values_list('internal_id', flat=True)), [3]
+        )
+        self.assertFalse(Patient.objects.filter(internal_id=2).exists())
+
+    @httpretty.activate
+    def test_initial_load_merges_staged_pages_success(self):
+        other_user = User.objects.create(username='otheruser', email='other@acme.test')
+        PatientBulkWriter(other_user).write([make_raw_patient(3)])
+        next_url = f'{self.patient_data_url}?page=2'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': next_url,
+                'previous': None,
+                'results': [make_raw_patient(1), make_raw_patient(2)],
+            }),
+            next_url: (200, {
+                'next': None,
+                'previous': self.patient_data_url,
+                'results': [
+                    make_raw_patient(2, first_name='Markus'), make_raw_patient(3),
+                ],
+            }),
+        })
+
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertTrue(is_ok)
+        self.assertEqual(migrator.stats['fetched'], 4)
+        self.assertEqual(migrator.stats['inserted'], 2)
+        self.assertEqual(migrator.stats['skipped'], 1)
+        self.assertEqual(migrator.stats['linked'], 3)
+        self.assertEqual(self.user.patients.count(), 3)
+        self.assertEqual(self.user.patients.get(internal_id=2).first_name, 'Markus')
+        self.assertEqual(other_user.patients.count(), 1)
+
+    @httpretty.activate
+    @override_settings(DRCHRONO_PATIENTS_INITIAL_LOAD_COPY=False)
+    def test_initial_load_without_copy_success(self):
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': None,
+                'previous': None,
+                'results': [make_raw_patient(1), make_raw_patient(2)],
+            }),
+        })
+
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+
+        self.assertEqual(migrator.stats['inserted'], 2)
+        self.assertEqual(self.user.patients.count(), 2)
+
+    @httpretty.activate
+    def test_interrupted_sync_resumes_from_checkpoint_success(self):
+        page_2_url = f'{self.patient_data_url}?page=2'
+        page_3_url = f'{self.patient_data_url}?page=3'
+        pages = {
+            self.patient_data_url: (200, {
+                'next': page_2_url,
+                'previous': None,
+                'results': [make_raw_patient(1), make_raw_patient(2)],
+            }),
+            page_2_url: (429, 'Over limit'),
+            page_3_url: (200, {
+                'next': None,
+                'previous': page_2_url,
+                'results': [make_raw_patient(4)],
+            }),
+        }
+        self.register_pages(pages)
+
+        migrator = PatientMigrator(self.user)
+        self.assertEqual(migrator.sync_patients(), (True, ''))
+        self.assertFalse(migrator.is_complete)
+        self.assertIsNone(PatientSync.objects.get(user=self.user).full_synced_at)
+
+        # resumed counters don't hide that this attempt fetched nothing
+        self.assertEqual(
+            PatientMigrator(self.user).sync_patients(), (False, 'Over limit')
+        )
+
+        pages[page_2_url] = (200, {
+            'next': page_3_url,
+            'previous': self.patient_data_url,
+            'results': [make_raw_patient(3)],
+        })
+        httpretty.reset()
+        self.register_pages(pages)
+        migrator = PatientMigrator(self.user)
+        is_ok, status_message = migrator.sync_patients()
+
+        self.assertTrue(is_ok)
+        self.assertTrue(migrator.is_complete)
+        self.assertEqual(
+            [request.path for request in httpretty.latest_requests()],
+            ['/api/patients?page=2', '/api/patients?page=3'],
+        )
+        # counters cover the whole crawl
+        self.assertEqual(migrator.stats['fetched'], 4)
+        self.assertEqual(migrator.stats['inserted'], 4)
+        self.assertEqual(self.user.patients.count(), 4)
+        sync_state = PatientSync.objects.get(user=self.user)
+        self.assertIsNotNone(sync_state.full_synced_at)
+        self.assertEqual(sync_state.generation, 1)
+        self.assertIsNone(SyncCheckpoint(self.user.pk, [sync_state]).load())
+
+    def test_checkpoint_does_not_depend_on_order_of_members_success(self):
+        member = User.objects.create(username='member', email='member@acme.test')
+        sync_states = [
+            PatientSync.objects.create(user=self.user),
+            PatientSync.objects.create(user=member),
+        ]
+        SyncCheckpoint(self.user.pk, sync_states).save(
+            self.patient_data_url, True, timezone.now(), None, [member.pk], {}, {}
+        )
+
+        state = SyncCheckpoint(self.user.pk, sync_states[::-1]).load()
+
+        self.assertEqual(state['url'], self.patient_data_url)
+        self.assertEqual(state['member_ids'], {member.pk})
+
+    @httpretty.activate
+    @override_settings(DRCHRONO_PATIENTS_SYNC_TIME_BUDGET=0)
+    def test_sync_stops_at_time_budget_success(self):
+        PatientBulkWriter(self.user, generation=0).write([make_raw_patient(9)])
+        PatientSync.objects.create(user=self.user, updated_since=timezone.now())
+        next_url = f'{self.patient_data_url}?page=2'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': next_url,
+                'previous': None,
+                'results': [make_raw_patient(1)],
+            }),
+            next_url: (200, {
+                'next': None,
+                'previous': self.patient_data_url,
+                'results': [make_raw_patient(2)],
+            }),
+        })
+
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+
+        self.assertFalse(migrator.is_complete)
+        self.assertEqual(migrator.stats['fetched'], 1)
+        # unseen patient is unlinked only after the whole crawl
+        self.assertEqual(
+            sorted(self.user.patients.values_list('internal_id', flat=True)), [1, 9]
+        )
+
+        migrator = PatientMigrator(self.user)
+        migrator.sync_patients()
+
+        self.assertTrue(migrator.is_complete)
+        self.assertEqual(migrator.stats['fetched'], 2)
+        self.assertEqual(migrator.stats['unlinked'], 1)
+        self.assertEqual(
+            sorted(self.user.patients.values_list('internal_id', flat=True)), [1, 2]
+        )
+        self.assertEqual(PatientSync.objects.get(user=self.user).generation, 1)
+
+    @httpretty.activate
+    @override_settings(DRCHRONO_PATIENTS_SYNC_TIME_BUDGET=0)
+    def test_incomplete_sync_is_queued_again_success(self):
+        next_url = f'{self.patient_data_url}?page=2'
+        self.register_pages({
+            self.patient_data_url: (200, {
+                'next': next_url,
+                'previous': None,
+                'results': [make_raw_patient(1)],
+            }),
+            next_url: (200, {
+                'next': None,
+                'previous': self.patient_data_url,
+                'results': [make_raw_patient(2)],
+            }),
+        })
+
+        status = run_patients_sync(self.user)
+
+        self.assertTrue(status['is_synced'])
+        self.assertFalse(status['is_complete'])
+        self.assertFalse(is_sync_fresh(self.user.pk))
+        self.assertTrue(is_sync_pending(self.user.pk))
+
+        self.assertEqual(process_sync_queue(timeout=1), self.user.pk)
+
+        self.assertTrue(is_sync_fresh(self.user.pk))
+        self.assertFalse(is_sync_pending(self.user.pk))
+        self.assertEqual(self.user.patients.count(), 2)
@@ -0,0 +1,96 @@
+import base64
+import json
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from application.apps.patients.models import Patient, PatientUser
+from application.apps.patients.pagination import InvalidCursor, KeysetPaginator
+
+User = get_user_model()
+
+
+class KeysetPaginatorTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='testuser', email='admin@acme.test')
+        last_names = ['Smith', 'Adams', 'Brown', 'Adams', 'Clark']
+        for patient_id, last_name in enumerate(last_names, 1):
+            patient = Patient.objects.create(
+                internal_id=patient_id,
+                first_name='Mark',
+                last_name=last_name,
+            )
+            PatientUser.objects.create(patient=patient, user=cls.user)
+
+    def walk(self, paginator):
+        pages = []
+        page = paginator.get_page()
+        pages.append([patient.internal_id for patient in page])
+        while page.has_next():
+            page = paginator.get_page(page.next_cursor)
+            pages.append([patient.internal_id for patient in page])
+        return pages, page
+
+    def test_pages_by_id_success(self):
+        paginator = KeysetPaginator(self.user.patients.all(), 2)
+
+        pages, last_page = self.walk(paginator)
+
+        self.assertEqual(pages, [[1, 2], [3, 4], [5]])
+        self.assertTrue(last_page.has_previous())
+
+        page = paginator.get_page(last_page.previous_cursor)
+        self.assertEqual([patient.internal_id for patient in page], [3, 4])
+        page = paginator.get_page(page.previous_cursor)
+        self.assertEqual([patient.internal_id for patient in page], [1, 2])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_pages_by_sort_field_success(self):
+        paginator = KeysetPaginator(self.user.patients.all(), 2, sort_field='last_name')
+
+        pages, _ = self.walk(paginator)
+
+        self.assertEqual(pages, [[2, 4], [3, 5], [1]])
+
+    def test_sort_field_pages_use_indexes_success(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('SET LOCAL enable_sort = off')
+            for sort_field in ('last_name', 'first_name'):
+                paginator = KeysetPaginator(
+                    Patient.objects.all(), 2, sort_field=sort_field
+                )
+                queryset = Patient.objects.filter(
+                    paginator._seek('Adams', 4, backwards=False)
+                ).order_by(*paginator._ordering(reverse=False))
+                self.assertIn(f'patient_{sort_field}_id_idx', queryset.explain())
+
+    def test_deep_page_is_single_query_success(self):
+        paginator = KeysetPaginator(self.user.patients.all(), 2)
+        cursor = paginator.get_page().next_cursor
+
+        with self.assertNumQueries(1):
+            page = paginator.get_page(cursor)
+
+        self.assertIsNone(page.count)
+
+    def test_invalid_cursor_returns_first_page_success(self):
+        page = KeysetPaginator(self.user.patients.all(), 2).get_page('not-a-cursor')
+
+        self.assertEqual([patient.internal_id for patient in page], [1, 2])
+
+    def test_decode_cursor_with_invalid_values_fail(self):
+        paginator = KeysetPaginator(self.user.patients.all(), 2, sort_field='last_name')
+        positions = [
+            {'key': 'Adams', 'id': '2', 'direction': 'next'},
+            {'key': 'Adams', 'id': 2, 'direction': 'sideways'},
+            {'key': {'$gt': ''}, 'id': 2, 'direction': 'next'},
+        ]
+        for position in positions:
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            with self.assertRaises(InvalidCursor):
+                paginator.decode_cursor(cursor)
@@ -0,0 +1,131 @@
+import json
+
+import fakeredis
+import httpretty
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from social_django.models import UserSocialAuth
+
+from application.apps.patients.bulk import PatientBulkWriter
+from application.apps.patients.handlers import PatientMigrator
+from application.apps.patients.tasks import (
+    get_sync_status, is_sync_fresh, run_patients_sync,
+)
+from application.apps.patients.tests.factories import make_raw_patient
+
+User = get_user_model()
+
+
+class PracticeSyncCoordinatorTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = cls.create_user(
+            'doctor', uid='1111', practice_group=243514, doctor=1
+        )
+        cls.assistant = cls.create_user(
+            'assistant', uid='2222', practice_group=243514, doctor=1
+        )
+        cls.colleague = cls.create_user(
+            'colleague', uid='3333', practice_group=243514, doctor=2
+        )
+        cls.stranger = cls.create_user(
+            'stranger', uid='4444', practice_group=100500, doctor=3
+        )
+
+    @classmethod
+    def create_user(cls, username, uid, practice_group, doctor):
+        user = User.objects.create(username=username, email=f'{username}@acme.test')
+        UserSocialAuth.objects.create(
+            user=user,
+            uid=uid,
+            provider='drchrono',
+            extra_data={
+                "auth_time": 1541322623,
+                "token_type": "Bearer",
+                "access_token": f"token-{uid}",
+                "practice_group": practice_group,
+                "doctor": doctor,
+                }
+            )
+        return user
+
+    def register_patients(self):
+        httpretty.register_uri(
+            httpretty.GET,
+            PatientMigrator.patients_data_url,
+            body=json.dumps({
+                'next': None,
+                'previous': None,
+                'results': [make_raw_patient(1), make_raw_patient(2)],
+            })
+        )
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def get_tokens(self) -> list:
+        return [
+            request.headers['Authorization'].split()[-1]
+            for request in httpretty.latest_requests()
+        ]
+
+    @httpretty.activate
+    def test_crawl_is_shared_by_users_of_the_same_doctor_success(self):
+        self.register_patients()
+
+        status = run_patients_sync(self.doctor)
+
+        self.assertEqual(status['status_message'], '')
+        self.assertTrue(status['is_synced'])
+        self.assertEqual(self.get_tokens(), ['token-1111'])
+        self.assertEqual(self.doctor.patients.count(), 2)
+        self.assertEqual(self.assistant.patients.count(), 2)
+        self.assertTrue(is_sync_fresh(self.assistant.pk))
+        self.assertEqual(
+            get_sync_status(self.assistant.pk), get_sync_status(self.doctor.pk)
+        )
+        # other doctor of the practice may see other patients
+        self.assertEqual(self.colleague.patients.count(), 0)
+        self.assertFalse(is_sync_fresh(self.colleague.pk))
+
+        run_patients_sync(self.colleague)
+        run_patients_sync(self.stranger)
+
+        self.assertEqual(self.get_tokens(), ['token-1111', 'token-3333', 'token-4444'])
+        self.assertEqual(self.colleague.patients.count(), 2)
+
+    @httpretty.activate
+    def test_crawl_never_unlinks_other_users_patients_success(self):
+        self.register_patients()
+
+        PatientBulkWriter(self.assistant).write([make_raw_patient(9)])
+
+        run_patients_sync(self.doctor)
+
+        self.assertEqual(
+            sorted(self.assistant.patients.values_list('internal_id', flat=True)),
+            [1, 2, 9],
+        )
+
+    @httpretty.activate
+    def test_reused_crawl_is_not_synced_success(self):
+        self.register_patients()
+
+        run_patients_sync(self.doctor)
+        cache.delete(
+            settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.assistant.pk)
+        )
+
+        status = run_patients_sync(self.assistant)
+
+        self.assertFalse(status['is_synced'])
+        self.assertFalse(is_sync_fresh(self.assistant.pk))
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+
+        status = run_patients_sync(self.assistant, force=True)
+
+        self.assertTrue(status['is_synced'])
+        self.assertEqual(self.get_tokens(), ['token-1111', 'token-2222'])
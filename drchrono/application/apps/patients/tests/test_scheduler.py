@@ -0,0 +1,104 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+import fakeredis
+import httpretty
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TransactionTestCase
+from django.utils import timezone
+from social_django.models import UserSocialAuth
+
+from application.apps.patients.handlers import PatientMigrator
+from application.apps.patients.models import PatientSync
+from application.apps.patients.scheduler import FleetSyncScheduler
+from application.apps.patients.tests.factories import make_raw_patient
+
+User = get_user_model()
+
+
+class FleetSyncSchedulerTest(TransactionTestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.never_synced = self.create_user(
+            'never_synced', last_login=now - timedelta(days=1)
+        )
+        self.synced_long_ago = self.create_user('synced_long_ago', last_login=now)
+        self.synced_recently = self.create_user('synced_recently', last_login=now)
+        self.inactive = self.create_user('inactive', last_login=now - timedelta(days=365))
+        self.fresh = self.create_user('fresh', last_login=now)
+
+        PatientSync.objects.create(user=self.synced_long_ago)
+        PatientSync.objects.filter(user=self.synced_long_ago).update(
+            modified=now - timedelta(days=2)
+        )
+        PatientSync.objects.create(user=self.synced_recently)
+        PatientSync.objects.filter(user=self.synced_recently).update(
+            modified=now - timedelta(hours=1)
+        )
+        cache.set(
+            settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.fresh.pk),
+            now.isoformat(),
+        )
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def create_user(self, username: str, last_login):
+        user = User.objects.create(username=username, last_login=last_login)
+        UserSocialAuth.objects.create(
+            user=user,
+            uid=username,
+            provider='drchrono',
+            extra_data={'access_token': username, 'token_type': 'Bearer'},
+        )
+        return user
+
+    def test_plan_orders_stale_users_success(self):
+        planned = FleetSyncScheduler(concurrency=2).plan()
+
+        self.assertEqual(planned, [
+            (self.never_synced.pk, f'user:{self.never_synced.pk}'),
+            (self.synced_long_ago.pk, f'user:{self.synced_long_ago.pk}'),
+            (self.synced_recently.pk, f'user:{self.synced_recently.pk}'),
+        ])
+
+    @httpretty.activate
+    def test_run_once_syncs_stale_users_success(self):
+        httpretty.register_uri(
+            httpretty.GET,
+            PatientMigrator.patients_data_url,
+            body=json.dumps({
+                'next': None,
+                'previous': None,
+                'results': [make_raw_patient(1)],
+            }),
+        )
+
+        stats = FleetSyncScheduler(concurrency=2).run_once()
+
+        self.assertEqual(stats, {'synced': 3})
+        for user in (self.never_synced, self.synced_long_ago, self.synced_recently):
+            self.assertEqual(user.patients.count(), 1)
+        self.assertEqual(self.inactive.patients.count(), 0)
+        self.assertEqual(FleetSyncScheduler(concurrency=2).plan(), [])
+
+    def test_run_forever_goes_on_after_failed_round_success(self):
+        scheduler = FleetSyncScheduler(concurrency=2)
+
+        plan_patch = patch.object(
+            scheduler, 'plan', side_effect=[DatabaseError('gone'), []]
+        )
+        sleep_patch = patch(
+            'application.apps.patients.scheduler.time.sleep',
+            side_effect=[None, KeyboardInterrupt],
+        )
+        with plan_patch as plan, sleep_patch:
+            with self.assertRaises(KeyboardInterrupt):
+                scheduler.run_forever(interval=0)
+
+        self.assertEqual(plan.call_count, 2)
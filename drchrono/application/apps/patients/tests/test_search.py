@@ -0,0 +1,114 @@
+import fakeredis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from application.apps.patients.bulk import PatientBulkWriter
+from application.apps.patients.models import Patient
+from application.apps.patients.search import PatientSearchForm, is_fuzzy_search_available
+from application.apps.patients.tests.factories import make_raw_patient
+
+User = get_user_model()
+
+
+class PatientSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.username = 'testuser'
+        cls.user = User.objects.create(username=cls.username, email='admin@acme.test')
+        cls.user.set_password('123')
+        cls.user.save()
+        other_user = User.objects.create(username='otheruser', email='other@acme.test')
+        PatientBulkWriter(cls.user).write([
+            make_raw_patient(
+                1, first_name='Mark', last_name='Adams', home_phone='(555) 123-4567'
+            ),
+            make_raw_patient(
+                2, first_name='Markus', last_name='Smith', date_of_birth='1990-01-12'
+            ),
+            make_raw_patient(
+                3, first_name='John', last_name='Marston', home_phone='555.987.6543'
+            ),
+        ])
+        PatientBulkWriter(other_user).write([make_raw_patient(4, first_name='Mark')])
+
+    def setUp(self):
+        self.client.login(username=self.username, password='123')
+        cache.set(
+            settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.user.pk),
+            timezone.now().isoformat(),
+            timeout=None,
+        )
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def search(self, **params) -> list:
+        search = PatientSearchForm(params)
+        patients = search.filter(self.user.patients.all())
+        return sorted(patients.values_list('internal_id', flat=True))
+
+    def test_search_by_name_prefix_success(self):
+        self.assertEqual(self.search(name='mar'), [1, 2, 3])
+        self.assertEqual(self.search(name='markus'), [2])
+        self.assertEqual(self.search(name='  mar   ad '), [1])
+
+    def test_search_by_birth_date_and_phone_success(self):
+        self.assertEqual(self.search(birth_date='1990-01-12'), [2])
+        self.assertEqual(self.search(phone='555-123'), [1])
+        self.assertEqual(self.search(phone='555'), [1, 3])
+        self.assertEqual(self.search(name='mark', phone='555'), [1])
+
+    def test_search_invalid_params_fail(self):
+        search = PatientSearchForm({'birth_date': '12/31/abc', 'phone': 'abc'})
+
+        self.assertFalse(search.has_filters())
+        self.assertEqual(set(search.errors), {'birth_date', 'phone'})
+        self.assertEqual(search.query_string, '')
+
+    def test_search_by_fuzzy_name_success(self):
+        if not is_fuzzy_search_available():
+            self.skipTest('pg_trgm is not installed')
+        self.assertEqual(self.search(name='smyth'), [])
+        self.assertEqual(self.search(name='smyth', fuzzy=True), [2])
+
+    def test_search_uses_indexes_success(self):
+        conditions = {
+            'patient_last_name_prefix_idx': {'name': 'smi'},
+            'patient_birth_date_idx': {'birth_date': '1990-01-12'},
+            'patient_phone_digits_prefix_idx': {'phone': '555'},
+        }
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for index, params in conditions.items():
+                queryset = PatientSearchForm(params).filter(Patient.objects.all())
+                self.assertIn(index, queryset.explain())
+
+    def test_search_page_success(self):
+        url = reverse('patient_list')
+
+        response = self.client.get(
+            url, {'name': 'mar', 'page_size': 2, 'order': 'last_name'}
+        )
+
+        page = response.context['patients']
+        self.assertEqual([patient['last_name'] for patient in page], ['Adams', 'Marston'])
+        self.assertIsNone(page.count)
+        self.assertContains(response, '&order=last_name&name=mar')
+        # search pages are not cached
+        self.assertEqual(cache.keys(f'drchrono_patients_page:{self.user.pk}:*'), [])
+
+        response = self.client.get(url, {
+            'name': 'mar',
+            'page_size': 2,
+            'order': 'last_name',
+            'cursor': page.next_cursor,
+        })
+
+        page = response.context['patients']
+        self.assertEqual([patient['last_name'] for patient in page], ['Smith'])
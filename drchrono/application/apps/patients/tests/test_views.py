@@ -1,4 +1,5 @@
 import json
+from datetime import datetime
 from unittest.mock import patch
 
 import fakeredis
@@ -6,17 +7,33 @@ import httpretty
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.dateparse import parse_date
 from social_django.models import UserSocialAuth
 
+from application.apps.patients.bulk import PatientBulkWriter
 from application.apps.patients.handlers import PatientMigrator
 from application.apps.patients.models import Patient
+from application.apps.patients.tasks import (
+    SYNC_LOCK_KEY, is_sync_pending, process_sync_queue,
+)
+from application.apps.patients.tests.factories import make_raw_patient
+from application.apps.patients.versions import bump_sync_version
+from application.locks import CacheLock
 
 User = get_user_model()
 
 
+def sync_completely(migrator):
+    migrator.is_complete = True
+    return True, ''
+
+
+@override_settings(DRCHRONO_PATIENTS_SYNC_IN_BACKGROUND=False)
 class AuthViewTest(TestCase):
 
     @classmethod
@@ -107,8 +124,11 @@ class AuthViewTest(TestCase):
         self.assertEqual(Patient.objects.all().count(), 1)
 
         patient = self.user.patients.first()
-        self.assertEqual(patient.internal_id, '1')
-        self.assertEqual(patient.internal_updated_at, '2018-03-19T12:25:32')
+        self.assertEqual(patient.internal_id, 1)
+        self.assertEqual(
+            patient.internal_updated_at,
+            datetime(2018, 3, 19, 12, 25, 32, tzinfo=timezone.utc)
+        )
         self.assertEqual(patient.first_name, 'Mark')
         self.assertEqual(patient.last_name, 'Adams')
         self.assertEqual(patient.birth_date, parse_date('1958-09-02'))
@@ -192,8 +212,11 @@ class AuthViewTest(TestCase):
         self.assertEqual(Patient.objects.all().count(), 2)
 
         first_patient = self.user.patients.first()
-        self.assertEqual(first_patient.internal_id, '1')
-        self.assertEqual(first_patient.internal_updated_at, '2018-03-19T12:25:32')
+        self.assertEqual(first_patient.internal_id, 1)
+        self.assertEqual(
+            first_patient.internal_updated_at,
+            datetime(2018, 3, 19, 12, 25, 32, tzinfo=timezone.utc)
+        )
         self.assertEqual(first_patient.first_name, 'Mark')
         self.assertEqual(first_patient.last_name, 'Adams')
         self.assertEqual(first_patient.birth_date, parse_date('1958-09-02'))
@@ -201,8 +224,11 @@ class AuthViewTest(TestCase):
         self.assertEqual(first_patient.photo, None)
 
         last_patient = self.user.patients.last()
-        self.assertEqual(last_patient.internal_id, '2')
-        self.assertEqual(last_patient.internal_updated_at, '2018-03-19T12:25:32')
+        self.assertEqual(last_patient.internal_id, 2)
+        self.assertEqual(
+            last_patient.internal_updated_at,
+            datetime(2018, 3, 19, 12, 25, 32, tzinfo=timezone.utc)
+        )
         self.assertEqual(last_patient.first_name, 'John')
         self.assertEqual(last_patient.last_name, 'Smith')
         self.assertEqual(last_patient.birth_date, parse_date('1990-01-12'))
@@ -252,8 +278,11 @@ class AuthViewTest(TestCase):
         self.assertEqual(Patient.objects.all().count(), 1)
 
         patient = self.user.patients.first()
-        self.assertEqual(patient.internal_id, '1')
-        self.assertEqual(patient.internal_updated_at, '2018-05-19T12:25:32')
+        self.assertEqual(patient.internal_id, 1)
+        self.assertEqual(
+            patient.internal_updated_at,
+            datetime(2018, 5, 19, 12, 25, 32, tzinfo=timezone.utc)
+        )
         self.assertEqual(patient.first_name, 'Markus')
         self.assertEqual(patient.last_name, 'Adams')
         self.assertEqual(patient.birth_date, parse_date('1958-09-02'))
@@ -275,21 +304,113 @@ class AuthViewTest(TestCase):
         self.assertEqual(self.user.patients.all().count(), 0)
         self.client.login(username=self.username, password='123')
 
-        with patch.object(PatientMigrator, 'sync_patients'):
-            PatientMigrator.sync_patients.return_value = (True, '')
+        with patch.object(
+            PatientMigrator, 'sync_patients', autospec=True, side_effect=sync_completely
+        ):
 
-            cached_at = cache.get(settings.DRCHRONO_PATIENTS_CACHE_KEY)
+            cached_at = cache.get(
+                settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.user.pk)
+            )
             self.assertIsNone(cached_at)
 
             self.client.get(self.url)
             PatientMigrator.sync_patients.assert_called_once()
-            cached_at = cache.get(settings.DRCHRONO_PATIENTS_CACHE_KEY)
+            cached_at = cache.get(
+                settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.user.pk)
+            )
             self.assertIsNotNone(cached_at)
 
             PatientMigrator.sync_patients.reset_mock()
             self.client.get(self.url)
             PatientMigrator.sync_patients.assert_not_called()
 
+            other_user = User.objects.create(
+                username='otheruser', email='other@acme.test'
+            )
+            other_user.set_password('123')
+            other_user.save()
+            self.client.login(username='otheruser', password='123')
+            self.client.get(self.url)
+            PatientMigrator.sync_patients.assert_called_once()
+
+    def test_get_list_is_served_from_cache_between_syncs_success(self):
+        raw_patient = {
+            'id': 1,
+            'first_name': 'Mark',
+            'last_name': 'Adams',
+            'date_of_birth': '1958-09-02',
+            'home_phone': '',
+            'photo': None,
+            'updated_at': '2018-03-19T12:25:32',
+        }
+        migrator = PatientMigrator(user=self.user)
+        migrator.add_new_patient(raw_patient)
+        self.client.login(username=self.username, password='123')
+
+        with patch.object(
+            PatientMigrator, 'sync_patients', autospec=True, side_effect=sync_completely
+        ):
+            self.client.get(self.url)
+
+            # session and user lookups only
+            with self.assertNumQueries(2):
+                response = self.client.get(self.url)
+            patients = response.context['patients']
+            self.assertEqual(patients.object_list[0]['first_name'], 'Mark')
+            self.assertEqual(response.context['patients'].count, 1)
+
+            raw_patient['first_name'] = 'Markus'
+            with patch('django.db.transaction.on_commit') as on_commit:
+                migrator.update_patient_info(raw_patient)
+            # cached page is served until the update commits
+            response = self.client.get(self.url)
+            patients = response.context['patients']
+            self.assertEqual(patients.object_list[0]['first_name'], 'Mark')
+
+            on_commit.call_args[0][0]()
+            response = self.client.get(self.url)
+            patients = response.context['patients']
+            self.assertEqual(patients.object_list[0]['first_name'], 'Markus')
+
+    def test_get_list_with_invalid_cursors_is_cached_once_success(self):
+        self.client.login(username=self.username, password='123')
+
+        with patch.object(
+            PatientMigrator, 'sync_patients', autospec=True, side_effect=sync_completely
+        ):
+            for cursor in ('', 'garbage', 'bm90IGpzb24=', 'eyJpZCI6ICIxIn0='):
+                response = self.client.get(self.url, {'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(len(cache.keys(f'drchrono_patients_page:{self.user.pk}:*')), 1)
+
+    def test_get_list_page_size_is_limited_success(self):
+        self.client.login(username=self.username, password='123')
+
+        with patch.object(PatientMigrator, 'sync_patients') as sync_patients:
+            sync_patients.return_value = (True, '')
+            response = self.client.get(self.url, {'page_size': 100000})
+            self.assertEqual(
+                response.context['page_size'], settings.DRCHRONO_PATIENTS_MAX_PAGE_SIZE
+            )
+
+            response = self.client.get(self.url, {'page_size': 'all'})
+            self.assertEqual(response.context['page_size'], 25)
+
+    def test_get_list_while_other_sync_is_running_success(self):
+        self.client.login(username=self.username, password='123')
+        lock = CacheLock(SYNC_LOCK_KEY.format(user_id=self.user.pk), lease=60)
+        self.assertTrue(lock.acquire())
+
+        with patch.object(PatientMigrator, 'sync_patients') as sync_patients, \
+                self.settings(DRCHRONO_PATIENTS_SYNC_WAIT_TIMEOUT=0):
+            response = self.client.get(self.url)
+            sync_patients.assert_not_called()
+
+        lock.release()
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['latest_sync_at'])
+
     @httpretty.activate
     def test_get_list_with_overlimit_api_call_success(self):
         raw_patient = {
@@ -324,3 +445,211 @@ class AuthViewTest(TestCase):
         self.assertEqual(context['status_message'], 'Over limit')
 
         self.assertEqual(self.user.patients.all().count(), 1)
+
+
+@override_settings(DRCHRONO_PATIENTS_SYNC_IN_BACKGROUND=True)
+class BackgroundSyncViewTest(TransactionTestCase):
+    # sync versions are bumped on commit, the worker commits its writes
+
+    def setUp(self):
+        self.username = 'testuser'
+        self.user = User.objects.create(username=self.username, email='admin@acme.test')
+        self.user.set_password('123')
+        self.user.save()
+        UserSocialAuth.objects.create(
+            user=self.user,
+            uid='1111',
+            provider='drchrono',
+            extra_data={
+                "auth_time": 1541322623,
+                "token_type": "Bearer",
+                "access_token": "HPcpYLicAHxiqhKPsQs6dmNPp8QmTR"
+                }
+            )
+        self.url = reverse('patient_list')
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    @httpretty.activate
+    def test_get_patient_list_enqueues_sync_success(self):
+        httpretty.register_uri(
+            httpretty.GET,
+            PatientMigrator.patients_data_url,
+            body=json.dumps({
+                'next': None,
+                'previous': None,
+                'results': [
+                    {
+                        'id': 1,
+                        'first_name': 'Mark',
+                        'last_name': 'Adams',
+                        'date_of_birth': '1958-09-02',
+                        'home_phone': '',
+                        'photo': None,
+                        'updated_at': '2018-03-19T12:25:32',
+                    }
+                ]
+            })
+        )
+        self.client.login(username=self.username, password='123')
+
+        with patch.object(PatientMigrator, 'sync_patients') as sync_patients:
+            response = self.client.get(self.url)
+            self.client.get(self.url)
+            sync_patients.assert_not_called()
+
+        context = response.context
+        self.assertEqual(len(context['patients'].object_list), 0)
+        self.assertIsNone(context['latest_sync_at'])
+        self.assertTrue(context['sync_in_progress'])
+
+        self.assertEqual(process_sync_queue(timeout=1), self.user.pk)
+        self.assertIsNone(process_sync_queue(timeout=1))
+
+        response = self.client.get(self.url)
+
+        context = response.context
+        self.assertEqual(len(context['patients'].object_list), 1)
+        self.assertTrue(context['latest_sync_at'])
+        self.assertFalse(context['sync_in_progress'])
+
+
+class PatientExportViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.username = 'testuser'
+        cls.user = User.objects.create(username=cls.username, email='admin@acme.test')
+        cls.user.set_password('123')
+        cls.user.save()
+        other_user = User.objects.create(username='otheruser', email='other@acme.test')
+        PatientBulkWriter(cls.user).write([
+            make_raw_patient(1, first_name='Mark', date_of_birth='1958-09-02'),
+            make_raw_patient(2, first_name='Markus', date_of_birth=None),
+        ])
+        PatientBulkWriter(other_user).write([make_raw_patient(3)])
+        cls.url = reverse('patient_export')
+
+    def setUp(self):
+        self.client.login(username=self.username, password='123')
+
+    def test_export_csv_success(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            lines[0], 'internal_id,first_name,last_name,birth_date,phone_number,photo'
+        )
+        self.assertTrue(lines[1].startswith('1,Mark,'))
+        self.assertIn('1958-09-02', lines[1])
+        self.assertTrue(lines[2].startswith('2,Markus,'))
+
+    def test_export_ndjson_success(self):
+        response = self.client.get(self.url, {'format': 'ndjson'})
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        content = b''.join(response.streaming_content)
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['internal_id'] for row in rows], [1, 2])
+        self.assertEqual(rows[0]['birth_date'], '1958-09-02')
+        self.assertIsNone(rows[1]['birth_date'])
+
+    def test_export_unknown_format_fail(self):
+        response = self.client.get(self.url, {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+
+class PatientApiViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.username = 'testuser'
+        cls.user = User.objects.create(username=cls.username, email='admin@acme.test')
+        cls.user.set_password('123')
+        cls.user.save()
+        other_user = User.objects.create(username='otheruser', email='other@acme.test')
+        PatientBulkWriter(cls.user).write([
+            make_raw_patient(1, first_name='Mark', last_name='Adams'),
+            make_raw_patient(
+                2, first_name='Markus', last_name='Smith', date_of_birth=None
+            ),
+            make_raw_patient(3, first_name='John', last_name='Marston'),
+        ])
+        PatientBulkWriter(other_user).write([make_raw_patient(4)])
+        cls.url = reverse('patient_api')
+
+    def setUp(self):
+        self.client.login(username=self.username, password='123')
+        cache.set(
+            settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.user.pk),
+            timezone.now().isoformat(),
+            timeout=None,
+        )
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def test_get_requested_fields_success(self):
+        response = self.client.get(
+            self.url, {'fields': 'last_name,birth_date', 'order': 'last_name'}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'fields': ['last_name', 'birth_date'],
+            'rows': [['Adams', '1958-09-02'], ['Marston', '1958-09-02'], ['Smith', None]],
+            'next': None,
+            'previous': None,
+        })
+        self.assertTrue(response['ETag'].startswith('"'))
+
+    def test_get_pages_with_search_success(self):
+        response = self.client.get(
+            self.url, {'fields': 'first_name', 'name': 'mar', 'page_size': 1}
+        )
+        data = response.json()
+        self.assertEqual(data['rows'], [['Mark']])
+
+        response = self.client.get(self.url, {
+            'fields': 'first_name', 'name': 'mar', 'page_size': 1, 'cursor': data['next'],
+        })
+        self.assertEqual(response.json()['rows'], [['Markus']])
+
+    def test_get_unknown_field_fail(self):
+        response = self.client.get(self.url, {'fields': 'first_name,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_anonymous_fail(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_get_not_modified_until_sync_success(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse([
+            query for query in queries if 'patients_patient' in query['sql']
+        ])
+
+        bump_sync_version(self.user.pk)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_stale_data_enqueues_sync_success(self):
+        cache.delete(settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=self.user.pk))
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(is_sync_pending(self.user.pk))
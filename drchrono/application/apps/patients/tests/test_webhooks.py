@@ -0,0 +1,206 @@
+import hashlib
+import hmac
+import json
+from unittest.mock import patch
+
+import fakeredis
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from social_django.models import UserSocialAuth
+
+from application.apps.patients.bulk import PatientBulkWriter
+from application.apps.patients.models import Patient
+from application.apps.patients.tests.factories import make_raw_patient
+from application.apps.patients.versions import get_sync_version
+from application.apps.patients.webhooks import (
+    EVENTS_FAILED_KEY, EVENTS_PROCESSING_KEY, PATIENT_CREATE, PATIENT_DELETE,
+    PATIENT_MODIFY, VERIFICATION_PREFIX, enqueue_patient_event, process_patient_events,
+)
+
+User = get_user_model()
+
+
+@override_settings(DRCHRONO_WEBHOOK_SECRET='webhook_secret')
+class PatientWebhookTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='testuser', email='admin@acme.test')
+        UserSocialAuth.objects.create(
+            user=cls.user,
+            uid='1111',
+            provider='drchrono',
+            extra_data={'access_token': 'HPcpYLicAHxiqhKPsQs6dmNPp8QmTR', 'doctor': 10},
+        )
+        cls.other_user = User.objects.create(
+            username='otheruser', email='other@acme.test'
+        )
+        UserSocialAuth.objects.create(
+            user=cls.other_user,
+            uid='2222',
+            provider='drchrono',
+            extra_data={'access_token': 'kP3fbrEyVxDTcNjYb8dSnXUSC5Qbe0', 'doctor': 11},
+        )
+        cls.url = reverse('drchrono_webhook')
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def post_event(self, event: str, patient: dict, secret: str = 'webhook_secret'):
+        body = json.dumps({'receiver': {}, 'object': patient}).encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post(
+            self.url,
+            body,
+            content_type='application/json',
+            HTTP_X_DRCHRONO_SIGNATURE=signature,
+            HTTP_X_DRCHRONO_EVENT=event,
+        )
+
+    def test_verification_success(self):
+        response = self.client.get(self.url, {'msg': 'hello'})
+
+        expected = hmac.new(
+            b'webhook_secret', VERIFICATION_PREFIX + b'hello', hashlib.sha256
+        ).hexdigest()
+        self.assertEqual(response.json(), {'secret_token': expected})
+
+    def test_verification_token_is_not_accepted_as_signature_fail(self):
+        body = json.dumps({'receiver': {}, 'object': make_raw_patient(1)})
+        token = self.client.get(self.url, {'msg': body}).json()['secret_token']
+
+        response = self.client.post(
+            self.url,
+            body,
+            content_type='application/json',
+            HTTP_X_DRCHRONO_SIGNATURE=token,
+            HTTP_X_DRCHRONO_EVENT=PATIENT_DELETE,
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(process_patient_events(timeout=1), {})
+
+        prefixed_body = VERIFICATION_PREFIX + body.encode()
+        response = self.client.post(
+            self.url,
+            prefixed_body,
+            content_type='application/json',
+            HTTP_X_DRCHRONO_SIGNATURE=hmac.new(
+                b'webhook_secret', prefixed_body, hashlib.sha256
+            ).hexdigest(),
+            HTTP_X_DRCHRONO_EVENT=PATIENT_DELETE,
+        )
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_invalid_signature_fail(self):
+        response = self.post_event(PATIENT_CREATE, make_raw_patient(1), secret='wrong')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(process_patient_events(timeout=1), {})
+
+    def test_events_are_coalesced_and_applied_success(self):
+        PatientBulkWriter(self.other_user).write([
+            make_raw_patient(2), make_raw_patient(3),
+        ])
+
+        response = self.post_event(PATIENT_CREATE, make_raw_patient(1, doctor=10))
+        self.assertEqual(response.status_code, 202)
+        self.post_event(
+            PATIENT_MODIFY, make_raw_patient(1, doctor=10, first_name='Markus')
+        )
+        self.post_event(
+            PATIENT_MODIFY, make_raw_patient(2, doctor=11, first_name='Markus')
+        )
+        self.post_event(PATIENT_DELETE, make_raw_patient(3, doctor=11))
+        response = self.post_event('APPOINTMENT_CREATE', {'id': 1})
+        self.assertEqual(response.status_code, 204)
+
+        stats = process_patient_events(timeout=1)
+
+        self.assertEqual(stats['received'], 4)
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['unlinked'], 1)
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(self.user.patients.get().first_name, 'Markus')
+        self.assertEqual(
+            list(self.other_user.patients.values_list('internal_id', 'first_name')),
+            [(2, 'Markus')]
+        )
+        self.assertFalse(Patient.objects.filter(internal_id=3).exists())
+
+    def test_deleted_patients_bump_versions_after_commit_success(self):
+        PatientBulkWriter(self.other_user).write([make_raw_patient(3)])
+        version = get_sync_version(self.other_user.pk)
+        enqueue_patient_event(PATIENT_DELETE, make_raw_patient(3, doctor=11))
+
+        with patch('django.db.transaction.on_commit') as on_commit:
+            process_patient_events(timeout=1)
+
+        self.assertFalse(Patient.objects.filter(internal_id=3).exists())
+        self.assertEqual(get_sync_version(self.other_user.pk), version)
+        on_commit.call_args[0][0]()
+        self.assertNotEqual(get_sync_version(self.other_user.pk), version)
+
+    def test_deleted_patient_is_unlinked_from_its_practice_only_success(self):
+        PatientBulkWriter(self.user).write([make_raw_patient(3)])
+        PatientBulkWriter(self.other_user).write([make_raw_patient(3)])
+        enqueue_patient_event(PATIENT_DELETE, make_raw_patient(3, doctor=11))
+
+        stats = process_patient_events(timeout=1)
+
+        self.assertEqual(stats['unlinked'], 1)
+        self.assertEqual(stats['deleted'], 0)
+        self.assertFalse(self.other_user.patients.exists())
+        self.assertEqual(self.user.patients.get().internal_id, 3)
+
+        # patient of other doctor is left as it is
+        enqueue_patient_event(PATIENT_DELETE, make_raw_patient(3, doctor=12))
+
+        self.assertEqual(process_patient_events(timeout=1)['unlinked'], 0)
+        self.assertEqual(self.user.patients.get().internal_id, 3)
+
+    def test_events_are_taken_in_batches_success(self):
+        for patient_id in range(1, 4):
+            enqueue_patient_event(PATIENT_CREATE, make_raw_patient(patient_id, doctor=10))
+
+        self.assertEqual(process_patient_events(timeout=1, batch_size=2)['inserted'], 2)
+        self.assertEqual(process_patient_events(timeout=1, batch_size=2)['inserted'], 1)
+        self.assertEqual(self.user.patients.count(), 3)
+
+    @override_settings(DRCHRONO_WEBHOOK_MAX_ATTEMPTS=2)
+    def test_failed_events_are_retried_fail(self):
+        enqueue_patient_event(PATIENT_CREATE, make_raw_patient(1, doctor=10))
+        redis = fakeredis.FakeStrictRedis()
+        write = 'application.apps.patients.webhooks.PatientBulkWriter.write'
+
+        with patch(write, side_effect=ValueError):
+            self.assertEqual(process_patient_events(timeout=1)['failed'], 1)
+            self.assertEqual(redis.llen(EVENTS_PROCESSING_KEY), 0)
+            self.assertEqual(self.user.patients.count(), 0)
+
+            self.assertEqual(process_patient_events(timeout=1)['failed'], 1)
+
+        self.assertEqual(process_patient_events(timeout=1), {})
+        failed = [
+            json.loads(raw_event) for raw_event in redis.lrange(EVENTS_FAILED_KEY, 0, -1)
+        ]
+        self.assertEqual(
+            [(event['object']['id'], event['attempts']) for event in failed], [(1, 2)]
+        )
+
+    def test_events_of_dead_worker_are_applied_success(self):
+        enqueue_patient_event(PATIENT_CREATE, make_raw_patient(1, doctor=10))
+        enqueue_patient_event(PATIENT_CREATE, make_raw_patient(2, doctor=10))
+        redis = fakeredis.FakeStrictRedis()
+        redis.rpoplpush('drchrono_patients_webhook_events', EVENTS_PROCESSING_KEY)
+
+        stats = process_patient_events(timeout=1, batch_size=1)
+
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(self.user.patients.get().internal_id, 1)
+        self.assertEqual(process_patient_events(timeout=1)['inserted'], 1)
+        self.assertEqual(redis.llen(EVENTS_PROCESSING_KEY), 0)
@@ -0,0 +1,42 @@
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+SYNC_VERSION_KEY = 'drchrono_patients_version:{user_id}'
+
+
+def get_sync_version(user_id: int) -> str:
+    '''
+    Returns version of user's patients data.
+    Versions are random, so an evicted version never comes back.
+    '''
+    key = SYNC_VERSION_KEY.format(user_id=user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_sync_version(*user_ids: int):
+    '''
+    Invalidates everything cached for users' patients data
+    '''
+    if user_ids:
+        cache.set_many(
+            {
+                SYNC_VERSION_KEY.format(user_id=user_id): uuid.uuid4().hex
+                for user_id in user_ids
+            },
+            timeout=None,
+        )
+
+
+def bump_sync_version_on_commit(*user_ids: int):
+    '''
+    Invalidates users' cached patients data once the current transaction commits,
+    pages read before the commit are not cached under the new version
+    '''
+    if user_ids:
+        transaction.on_commit(lambda: bump_sync_version(*user_ids))
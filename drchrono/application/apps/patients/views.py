@@ -1,51 +1,320 @@
-from datetime import datetime
+import csv
+import hashlib
+import hmac
+import json
 
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.cache import cache
 from django.core.paginator import Paginator
-from django.http import HttpResponseRedirect
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseRedirect,
+    JsonResponse, StreamingHttpResponse,
+)
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
 from django.utils.dateparse import parse_datetime
-from django.views.generic import TemplateView
+from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import TemplateView, View
 
-from application.apps.patients.handlers import PatientMigrator
+from application.apps.patients.pagination import KeysetPaginator
+from application.apps.patients.search import PatientSearchForm
+from application.apps.patients.tasks import (
+    enqueue_patients_sync, get_sync_status, is_sync_fresh, is_sync_pending,
+    run_patients_sync,
+)
+from application.apps.patients.versions import get_sync_version
+from application.apps.patients.webhooks import (
+    PATIENT_EVENTS, enqueue_patient_event, is_valid_signature, sign_verification
+)
+from application.metrics import render_metrics
 
 
 class PatientView(LoginRequiredMixin, TemplateView):
     login_url = '/login/'
     template_name = "patients/patients.html"
+    default_page_size = 25
+    sort_fields = ('id', 'last_name', 'first_name')
+    list_fields = ('id', 'photo', 'first_name', 'last_name', 'birth_date', 'phone_number')
 
     def handle_no_permission(self):
         if 'code' in self.request.GET and not self.request.user.is_authenticated:
             redirect_url = reverse('social:complete', args=['drchrono'])
-            return HttpResponseRedirect(f'{redirect_url}?{self.request.META["QUERY_STRING"]}')
+            query_string = self.request.META['QUERY_STRING']
+            return HttpResponseRedirect(f'{redirect_url}?{query_string}')
         else:
             return super().handle_no_permission()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        cached_at = cache.get(settings.DRCHRONO_PATIENTS_CACHE_KEY)
-        if not cached_at:
-            migrator = PatientMigrator(self.request.user)
-            is_ok, status_message = migrator.sync_patients()
-
-            if not is_ok:
-                context['status_message'] = status_message
-
-            cached_at = datetime.utcnow().isoformat()
-            cache.set(
-                settings.DRCHRONO_PATIENTS_CACHE_KEY,
-                cached_at,
-                timeout=settings.DRCHRONO_PATIENTS_CACHE_TTL
-                )
-
-        page_number = self.request.GET.get('page')
-        page_size = self.request.GET.get('page_size', 25)
-        paginator = Paginator(self.request.user.patients.all().order_by('id'), page_size)
-        patients = paginator.get_page(page_number)
+        user = self.request.user
+        sync_status = get_sync_status(user.pk)
+
+        if not is_sync_fresh(user.pk):
+            if settings.DRCHRONO_PATIENTS_SYNC_IN_BACKGROUND:
+                enqueue_patients_sync(user.pk)
+            else:
+                sync_status = run_patients_sync(user, wait=True, interactive=True)
+
+        if sync_status.get('status_message'):
+            context['status_message'] = sync_status['status_message']
+
+        page_size = self.get_page_size()
+        search = PatientSearchForm(self.request.GET)
+        if settings.DRCHRONO_PATIENTS_PAGINATION == 'keyset':
+            sort_field = self.request.GET.get('order')
+            if sort_field not in self.sort_fields:
+                sort_field = 'id'
+            patients = self.get_cached_page(user, page_size, sort_field, search)
+            context['order'] = sort_field
+        else:
+            paginator = Paginator(
+                search.filter(user.patients.all()).order_by('id'), page_size
+            )
+            patients = paginator.get_page(self.request.GET.get('page'))
+        context['search'] = search
+        context['pagination'] = settings.DRCHRONO_PATIENTS_PAGINATION
         context['patients'] = patients
         context['page_size'] = page_size
-        context['latest_sync_at'] = parse_datetime(cached_at)
+        context['latest_sync_at'] = (
+            parse_datetime(sync_status['synced_at'])
+            if sync_status.get('synced_at') else None
+        )
+        context['sync_in_progress'] = is_sync_pending(user.pk)
         return context
+
+    def get_cached_page(self, user, page_size: int, sort_field: str,
+                        search: PatientSearchForm):
+        '''
+        Pages and counts are cached under user's sync version,
+        so they are served without DB queries until the next sync changes data.
+        Search results are neither counted nor cached: every query would
+        fill the cache with pages that are rarely read again, they are served
+        by indexes (see PatientSearchForm).
+        '''
+        cursor = self.request.GET.get('cursor')
+        queryset = search.filter(user.patients.all()).values(*self.list_fields)
+        if search.has_filters():
+            paginator = KeysetPaginator(queryset, page_size, sort_field=sort_field)
+            return paginator.get_page(cursor)
+
+        version = get_sync_version(user.pk)
+        paginator = KeysetPaginator(
+            queryset,
+            page_size,
+            sort_field=sort_field,
+            count_cache_key=f'drchrono_patients_count:{user.pk}:{version}',
+            count_cache_ttl=settings.DRCHRONO_PATIENTS_PAGE_CACHE_TTL,
+        )
+        cursor_key = paginator.get_cursor_key(cursor)
+        return cache.get_or_set(
+            f'drchrono_patients_page:{user.pk}:{version}:'
+            f'{sort_field}:{page_size}:{cursor_key}',
+            lambda: paginator.get_page(cursor),
+            settings.DRCHRONO_PATIENTS_PAGE_CACHE_TTL,
+        )
+
+    def get_page_size(self) -> int:
+        return get_page_size(self.request, self.default_page_size)
+
+
+def get_page_size(request, default: int) -> int:
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except ValueError:
+        return default
+    return min(max(page_size, 1), settings.DRCHRONO_PATIENTS_MAX_PAGE_SIZE)
+
+
+def get_patients_etag(request) -> str:
+    '''
+    Strong ETag of user's patients response: sync version with the requested URL,
+    so it is computed without DB queries
+    '''
+    version = get_sync_version(request.user.pk)
+    signature = f'{version}:{request.get_full_path()}'.encode()
+    return quote_etag(hashlib.sha1(signature).hexdigest())
+
+
+class PatientApiView(LoginRequiredMixin, View):
+    '''
+    Compact JSON page of user's patients for polling clients:
+    {"fields": [...], "rows": [[...], ...], "next": "<cursor>", "previous": "<cursor>"}
+
+    `fields` (comma separated) selects the columns, rows are `values_list` tuples.
+    Accepts `cursor`, `page_size` and `order` of the patients page
+    and its search parameters.
+    Responses carry ETag of user's sync version, If-None-Match is answered
+    with 304 without reading patients until the next sync changes them.
+    '''
+    raise_exception = True
+    api_fields = (
+        'id', 'internal_id', 'first_name', 'last_name', 'birth_date', 'phone_number',
+        'photo',
+    )
+    default_fields = ('id', 'first_name', 'last_name', 'birth_date', 'phone_number')
+
+    def get(self, request, *args, **kwargs):
+        fields = self.get_fields()
+        if fields is None:
+            api_fields = ', '.join(self.api_fields)
+            return HttpResponseBadRequest(f'Fields must be some of: {api_fields}')
+        search = PatientSearchForm(request.GET)
+        if search.errors:
+            return JsonResponse({'errors': search.errors}, status=400)
+
+        if not is_sync_fresh(request.user.pk):
+            enqueue_patients_sync(request.user.pk)
+
+        etag = get_patients_etag(request)
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            response['ETag'] = etag
+            return response
+
+        sort_field = request.GET.get('order')
+        if sort_field not in PatientView.sort_fields:
+            sort_field = 'id'
+        # cursor needs id and sort field of the boundary row
+        columns = fields + tuple(
+            name for name in ('id', sort_field) if name not in fields
+        )
+        paginator = KeysetPaginator(
+            search.filter(request.user.patients.all()).values_list(*columns),
+            get_page_size(request, PatientView.default_page_size),
+            sort_field=sort_field,
+            fields=columns,
+        )
+        page = paginator.get_page(request.GET.get('cursor'))
+
+        response = JsonResponse(
+            {
+                'fields': fields,
+                'rows': [row[:len(fields)] for row in page],
+                'next': page.next_cursor,
+                'previous': page.previous_cursor,
+            },
+            json_dumps_params={'separators': (',', ':')},
+        )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def get_fields(self):
+        requested = self.request.GET.get('fields')
+        if not requested:
+            return self.default_fields
+        fields = tuple(dict.fromkeys(name.strip() for name in requested.split(',')))
+        if not set(fields) <= set(self.api_fields):
+            return None
+        return fields
+
+
+class Echo:
+    '''
+    File-like object for csv.writer which returns written line instead of buffering it
+    '''
+    def write(self, value):
+        return value
+
+
+class PatientExportView(LoginRequiredMixin, View):
+    '''
+    Streams all user's patients as CSV or NDJSON (?format=ndjson).
+    Rows are read with server-side cursor chunk by chunk as tuples,
+    so memory doesn't grow with number of patients.
+    '''
+    login_url = '/login/'
+    export_fields = (
+        'internal_id', 'first_name', 'last_name', 'birth_date', 'phone_number', 'photo',
+    )
+    content_types = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in self.content_types:
+            return HttpResponseBadRequest(f'Unknown export format: {export_format}')
+
+        rows = (
+            request.user.patients
+            .order_by('id')
+            .values_list(*self.export_fields)
+            .iterator(chunk_size=settings.DRCHRONO_PATIENTS_EXPORT_CHUNK_SIZE)
+        )
+        lines = self.iter_csv(rows) if export_format == 'csv' else self.iter_ndjson(rows)
+        response = StreamingHttpResponse(
+            lines, content_type=self.content_types[export_format]
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="patients.{export_format}"'
+        )
+        return response
+
+    def iter_csv(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.export_fields)
+        for row in rows:
+            yield writer.writerow(row)
+
+    def iter_ndjson(self, rows):
+        for row in rows:
+            patient = dict(zip(self.export_fields, row))
+            yield json.dumps(patient, cls=DjangoJSONEncoder) + '\n'
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class PatientWebhookView(View):
+    '''
+    Receives drchrono patient webhooks.
+    GET answers the verification request with `secret_token` signed
+    by DRCHRONO_WEBHOOK_SECRET under VERIFICATION_PREFIX.
+    POST must be signed with HMAC-SHA256 of the body in X-drchrono-signature header,
+    patient events are queued and applied in batches by the events worker.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        message = request.GET.get('msg')
+        if not message or not settings.DRCHRONO_WEBHOOK_SECRET:
+            return HttpResponseBadRequest('Nothing to verify')
+        return JsonResponse({'secret_token': sign_verification(message.encode())})
+
+    def post(self, request, *args, **kwargs):
+        signature = request.META.get('HTTP_X_DRCHRONO_SIGNATURE')
+        if not is_valid_signature(request.body, signature):
+            return HttpResponseForbidden('Invalid signature')
+
+        event = request.META.get('HTTP_X_DRCHRONO_EVENT')
+        if event not in PATIENT_EVENTS:
+            return HttpResponse(status=204)
+
+        try:
+            patient = json.loads(request.body)['object']
+            int(patient['id'])
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest('Invalid payload')
+
+        enqueue_patient_event(event, patient)
+        return HttpResponse(status=202)
+
+
+class MetricsView(View):
+    '''
+    Aggregated sync metrics in Prometheus text format, served only to scrapers
+    sending DRCHRONO_METRICS_TOKEN as bearer token
+    '''
+
+    def get(self, request, *args, **kwargs):
+        token = settings.DRCHRONO_METRICS_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if not token or not hmac.compare_digest(authorization, f'Bearer {token}'):
+            return HttpResponseForbidden('Invalid metrics token')
+        return HttpResponse(
+            render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
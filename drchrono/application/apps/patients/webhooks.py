@@ -0,0 +1,227 @@
+import hashlib
+import hmac
+import json
+import logging
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from application.apps.patients.bulk import PatientBulkWriter
+from application.apps.patients.models import Patient, PatientSync, PatientUser
+from application.apps.patients.versions import bump_sync_version_on_commit
+from application.locks import CacheLock
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+EVENTS_QUEUE_KEY = 'drchrono_patients_webhook_events'
+EVENTS_PROCESSING_KEY = 'drchrono_patients_webhook_events:processing'
+EVENTS_FAILED_KEY = 'drchrono_patients_webhook_events:failed'
+EVENTS_LOCK_KEY = 'drchrono_patients_webhook_events:lock'
+
+PATIENT_CREATE = 'PATIENT_CREATE'
+PATIENT_MODIFY = 'PATIENT_MODIFY'
+PATIENT_DELETE = 'PATIENT_DELETE'
+PATIENT_EVENTS = (PATIENT_CREATE, PATIENT_MODIFY, PATIENT_DELETE)
+
+VERIFICATION_PREFIX = b'drchrono-webhook-verification:'
+
+
+def sign(message: bytes) -> str:
+    return hmac.new(
+        settings.DRCHRONO_WEBHOOK_SECRET.encode(), message, hashlib.sha256
+    ).hexdigest()
+
+
+def sign_verification(message: bytes) -> str:
+    '''
+    Verification tokens are signed under their own prefix, so a token
+    is never a valid signature of a delivered body
+    '''
+    return sign(VERIFICATION_PREFIX + message)
+
+
+def is_valid_signature(body: bytes, signature: str) -> bool:
+    if not settings.DRCHRONO_WEBHOOK_SECRET or not signature:
+        return False
+    if body.startswith(VERIFICATION_PREFIX):
+        return False
+    return hmac.compare_digest(sign(body), signature)
+
+
+def enqueue_patient_event(event: str, patient: dict):
+    '''
+    Events are pushed to the head of the queue and taken from its tail
+    '''
+    get_redis_connection('default').lpush(
+        EVENTS_QUEUE_KEY, json.dumps({'event': event, 'object': patient})
+    )
+
+
+def process_patient_events(timeout: int = 0, batch_size: int = None) -> Counter:
+    '''
+    Waits for queued webhook events (up to `timeout` seconds, 0 - forever),
+    takes up to `batch_size` of them and applies them in one transaction.
+    Events of the same patient are coalesced, the latest one wins.
+    Returns counters of the applied batch, empty when the queue was empty.
+
+    Taken events are moved to the processing list and removed from it only
+    after the batch is committed, so events of a dead worker are applied
+    by the next batch. Failed batch is requeued, events which failed
+    DRCHRONO_WEBHOOK_MAX_ATTEMPTS times are moved to the failed list.
+    One worker applies batches at a time.
+    '''
+    batch_size = batch_size or settings.DRCHRONO_WEBHOOK_BATCH_SIZE
+    redis = get_redis_connection('default')
+    redis.brpoplpush(EVENTS_QUEUE_KEY, EVENTS_PROCESSING_KEY, timeout=timeout)
+
+    lock = CacheLock(EVENTS_LOCK_KEY, lease=settings.DRCHRONO_WEBHOOK_LOCK_TTL)
+    if not lock.acquire():
+        # taken event is applied by the lock holder with the rest of processing list
+        lock.wait(timeout=settings.DRCHRONO_WEBHOOK_LOCK_TTL)
+        return Counter()
+
+    try:
+        missing = batch_size - redis.llen(EVENTS_PROCESSING_KEY)
+        if missing > 0:
+            pipe = redis.pipeline()
+            for _ in range(missing):
+                pipe.rpoplpush(EVENTS_QUEUE_KEY, EVENTS_PROCESSING_KEY)
+            pipe.execute()
+
+        # the oldest events are at the tail
+        raw_events = redis.lrange(EVENTS_PROCESSING_KEY, -batch_size, -1)
+        if not raw_events:
+            return Counter()
+        events = [json.loads(raw_event) for raw_event in reversed(raw_events)]
+
+        latest = {}
+        for event in events:
+            latest[int(event['object']['id'])] = event
+
+        stats = Counter(received=len(events), coalesced=len(events) - len(latest))
+        try:
+            with transaction.atomic():
+                stats.update(apply_patient_events(list(latest.values())))
+        except Exception:
+            logger.exception(f'Failed to apply {len(latest)} patient events')
+            stats = Counter(failed=len(events))
+            retry_patient_events(redis, events)
+
+        redis.ltrim(EVENTS_PROCESSING_KEY, 0, -len(raw_events) - 1)
+        return stats
+    finally:
+        lock.release()
+
+
+def retry_patient_events(redis, events: list):
+    '''
+    Puts failed events back to the tail of the queue,
+    events out of attempts are kept in the failed list for investigation
+    '''
+    retried, failed = [], []
+    for event in events:
+        event['attempts'] = event.get('attempts', 0) + 1
+        if event['attempts'] < settings.DRCHRONO_WEBHOOK_MAX_ATTEMPTS:
+            retried.append(json.dumps(event))
+        else:
+            failed.append(json.dumps(event))
+
+    pipe = redis.pipeline()
+    if retried:
+        # the oldest event goes to the very tail
+        pipe.rpush(EVENTS_QUEUE_KEY, *reversed(retried))
+    if failed:
+        pipe.lpush(EVENTS_FAILED_KEY, *failed)
+    pipe.execute()
+    if failed:
+        logger.error(f'{len(failed)} patient events are moved to {EVENTS_FAILED_KEY}')
+
+
+def apply_patient_events(events: list) -> Counter:
+    '''
+    Created and modified patients are written with PatientBulkWriter for users
+    who already see the patient and users of the patient's doctor,
+    deleted ones are unlinked from users of the patient's doctor.
+    '''
+    stats = Counter()
+    deleted_patients = [
+        event['object'] for event in events if event['event'] == PATIENT_DELETE
+    ]
+    if deleted_patients:
+        stats.update(unlink_deleted_patients(deleted_patients))
+
+    patients = [event['object'] for event in events if event['event'] != PATIENT_DELETE]
+    if not patients:
+        return stats
+
+    patients_by_user = defaultdict(list)
+    linked = PatientUser.objects.filter(
+        patient__internal_id__in=[int(patient['id']) for patient in patients]
+    ).values_list('patient__internal_id', 'user_id')
+    users_by_patient = defaultdict(set)
+    for internal_id, user_id in linked:
+        users_by_patient[internal_id].add(user_id)
+    doctors = {patient.get('doctor') for patient in patients}
+    doctors_users = {doctor: get_doctor_users(doctor) for doctor in doctors}
+    for patient in patients:
+        user_ids = (
+            users_by_patient[int(patient['id'])] | doctors_users[patient.get('doctor')]
+        )
+        for user_id in user_ids:
+            patients_by_user[user_id].append(patient)
+
+    generations = dict(
+        PatientSync.objects
+        .filter(user_id__in=patients_by_user)
+        .values_list('user_id', 'generation')
+    )
+    for user in User.objects.filter(pk__in=patients_by_user):
+        writer = PatientBulkWriter(user, generation=generations.get(user.pk, 0))
+        stats.update(writer.write(patients_by_user[user.pk]))
+    return stats
+
+
+def unlink_deleted_patients(patients: list) -> Counter:
+    '''
+    Removes links of deleted patients to users of the patient's doctor only,
+    other practices keep seeing their copy. Patients which are left without
+    users are deleted, as PatientBulkWriter.unlink_unseen does.
+    Returns counters: unlinked, deleted
+    '''
+    internal_ids_by_doctor = defaultdict(list)
+    for patient in patients:
+        internal_ids_by_doctor[patient.get('doctor')].append(int(patient['id']))
+
+    stats = Counter()
+    user_ids, patient_ids = set(), set()
+    for doctor, internal_ids in internal_ids_by_doctor.items():
+        links = PatientUser.objects.filter(
+            patient__internal_id__in=internal_ids, user_id__in=get_doctor_users(doctor)
+        )
+        for user_id, patient_id in links.values_list('user_id', 'patient_id'):
+            user_ids.add(user_id)
+            patient_ids.add(patient_id)
+        _, unlinked = links.delete()
+        stats['unlinked'] += unlinked.get(PatientUser._meta.label, 0)
+
+    if patient_ids:
+        orphans = Patient.objects.filter(pk__in=patient_ids, user__isnull=True)
+        _, deleted = orphans.delete()
+        stats['deleted'] = deleted.get(Patient._meta.label, 0)
+        bump_sync_version_on_commit(*user_ids)
+    return stats
+
+
+def get_doctor_users(doctor) -> set:
+    if doctor is None:
+        return set()
+    return set(
+        User.objects
+        .filter(social_auth__provider='drchrono', social_auth__extra_data__doctor=doctor)
+        .values_list('pk', flat=True)
+    )
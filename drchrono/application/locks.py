@@ -0,0 +1,64 @@
+import time
+import uuid
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+
+class CacheLock:
+    '''
+    Lock with lease timeout kept in the default cache (Redis),
+    so it is shared by all uWSGI workers and hosts.
+    The lease expires by itself if the holder dies, so holders keep
+    their work shorter than the lease (see DRCHRONO_PATIENTS_SYNC_TIME_BUDGET).
+    '''
+
+    def __init__(self, key: str, lease: int):
+        self.key = cache.make_key(key)
+        self.lease = lease
+        self.token = uuid.uuid4().hex
+        self.redis = get_redis_connection('default')
+
+    def acquire(self) -> bool:
+        return bool(self.redis.set(self.key, self.token, nx=True, ex=self.lease))
+
+    def release(self) -> bool:
+        '''
+        Deletes the lock only while it is held with this token, checked
+        and deleted in one transaction, so a lease expired and taken
+        by other holder in the meantime is never released
+        '''
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) != self.token.encode():
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(self.key)
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def is_locked(self) -> bool:
+        return bool(self.redis.exists(self.key))
+
+    def wait(self, timeout: float, interval: float = 0.1) -> bool:
+        '''
+        Waits until the lock is released by its holder.
+        Returns False when it is still held after `timeout` seconds.
+        '''
+        deadline = time.monotonic() + timeout
+        while self.is_locked():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,110 @@
+import logging
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'drchrono_metrics'
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    'drchrono_sync_total': (COUNTER, 'Finished patients syncs'),
+    'drchrono_sync_pages_total': (COUNTER, 'Provider pages fetched by syncs'),
+    'drchrono_sync_bytes_total': (COUNTER, 'Bytes received from provider by syncs'),
+    'drchrono_sync_retries_total': (COUNTER, 'Provider requests retried by syncs'),
+    'drchrono_sync_rows_total': (COUNTER, 'Patient rows handled by syncs'),
+    'drchrono_sync_queries_total': (COUNTER, 'Database queries issued by syncs'),
+    'drchrono_sync_duration_seconds': (HISTOGRAM, 'Duration of patients syncs'),
+    'drchrono_sync_phase_seconds': (HISTOGRAM, 'Time spent by syncs in each phase'),
+    'drchrono_provider_request_seconds': (
+        HISTOGRAM, 'Duration of provider page requests'
+    ),
+}
+
+
+def format_labels(labels: dict) -> str:
+    return ','.join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def format_series(name: str, labels: str) -> str:
+    return f'{name}{{{labels}}}' if labels else name
+
+
+def join_labels(*labels: str) -> str:
+    return ','.join(filter(None, labels))
+
+
+class MetricsBatch:
+    '''
+    Collects metric updates and writes them to Redis in one pipeline.
+    Metrics of all workers are aggregated in one Redis hash,
+    histograms keep cumulative bucket counters like Prometheus does.
+    '''
+
+    def __init__(self):
+        self.counters = []
+        self.observations = []
+
+    def inc(self, name: str, value: int = 1, **labels):
+        self.counters.append((name, format_labels(labels), value))
+
+    def observe(self, name: str, value: float, **labels):
+        self.observations.append((name, format_labels(labels), value))
+
+    def commit(self):
+        pipe = get_redis_connection('default').pipeline(transaction=False)
+        for name, labels, value in self.counters:
+            pipe.hincrby(METRICS_KEY, format_series(name, labels), value)
+        for name, labels, value in self.observations:
+            for bucket in settings.DRCHRONO_METRICS_BUCKETS:
+                if value <= bucket:
+                    bucket_labels = join_labels(labels, f'le="{bucket}"')
+                    pipe.hincrby(
+                        METRICS_KEY, format_series(f'{name}_bucket', bucket_labels), 1
+                    )
+            pipe.hincrbyfloat(METRICS_KEY, format_series(f'{name}_sum', labels), value)
+            pipe.hincrby(METRICS_KEY, format_series(f'{name}_count', labels), 1)
+        try:
+            pipe.execute()
+        except Exception:
+            logger.warning('Failed to write metrics', exc_info=True)
+
+
+def render_metrics() -> str:
+    '''
+    Returns aggregated metrics in Prometheus text exposition format
+    '''
+    values = {
+        field.decode(): value.decode()
+        for field, value in get_redis_connection('default').hgetall(METRICS_KEY).items()
+    }
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == COUNTER:
+            for series in sorted(values):
+                if series == name or series.startswith(f'{name}{{'):
+                    lines.append(f'{series} {values[series]}')
+            continue
+
+        count_prefix = f'{name}_count'
+        for series in sorted(values):
+            if series != count_prefix and not series.startswith(f'{count_prefix}{{'):
+                continue
+            labels = series[len(count_prefix):].strip('{}')
+            for bucket in settings.DRCHRONO_METRICS_BUCKETS:
+                bucket_labels = join_labels(labels, f'le="{bucket}"')
+                bucket_series = format_series(f'{name}_bucket', bucket_labels)
+                lines.append(f'{bucket_series} {values.get(bucket_series, 0)}')
+            inf_series = format_series(f'{name}_bucket', join_labels(labels, 'le="+Inf"'))
+            lines.append(f'{inf_series} {values[series]}')
+            sum_series = format_series(f'{name}_sum', labels)
+            lines.append(f'{sum_series} {values.get(sum_series, 0)}')
+            lines.append(f'{series} {values[series]}')
+
+    return '\n'.join(lines) + '\n'
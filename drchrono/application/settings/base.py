@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'social_django',
 
     'application.apps.patients',
@@ -53,6 +54,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'application.apps.oauth.middlewares.CustomSocialAuthExceptionMiddleware',
+    'application.apps.patients.middlewares.QueryCountMiddleware',
 ]
 
 ROOT_URLCONF = 'application.urls'
@@ -101,7 +103,7 @@ DATABASES = {
 
 AUTH_PASSWORD_VALIDATORS = [
     {
-        'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
+        'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',  # noqa: E501
     },
     {
         'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator',
@@ -161,11 +163,84 @@ CACHES = {
     }
 }
 
+DRCHRONO_PATIENTS_API_URL = os.getenv(
+    'DRCHRONO_PATIENTS_API_URL', 'https://drchrono.com/api/patients'
+)
 DRCHRONO_PATIENTS_CACHE_TTL = 180
-DRCHRONO_PATIENTS_CACHE_KEY = 'drchrono_patients_sycned_at'
+DRCHRONO_PATIENTS_CACHE_KEY = 'drchrono_patients_sycned_at:{user_id}'
+# members of a practice reuse its crawl within this window
+DRCHRONO_PRACTICE_CRAWL_TTL = 180
+DRCHRONO_PATIENTS_SYNC_LOCK_TTL = 10 * 60
+DRCHRONO_PATIENTS_SYNC_WAIT_TIMEOUT = 20
+DRCHRONO_PATIENTS_PAGINATION = 'keyset'  # or 'offset' for numbered pages
+DRCHRONO_PATIENTS_MAX_PAGE_SIZE = 100
+# invalidated by sync version, TTL only bounds memory
+DRCHRONO_PATIENTS_PAGE_CACHE_TTL = 24 * 60 * 60
+DRCHRONO_PATIENTS_SYNC_IN_BACKGROUND = True  # False syncs inline in PatientView
+DRCHRONO_PATIENTS_SYNC_PENDING_TTL = 15 * 60
+DRCHRONO_PATIENTS_FULL_SYNC_INTERVAL = 24 * 60 * 60
+DRCHRONO_PATIENTS_WRITE_CHUNK_SIZE = 1000
+DRCHRONO_PATIENTS_PREFETCH_PAGES = 1
+DRCHRONO_PATIENTS_FETCH_CONCURRENCY = 1  # > 1 fetches predictable pages concurrently
+# rows fetched per server-side cursor round trip
+DRCHRONO_PATIENTS_EXPORT_CHUNK_SIZE = 2000
+# first sync of a user is COPY-ed into staging table
+DRCHRONO_PATIENTS_INITIAL_LOAD_COPY = True
+# crawl stops at a checkpoint before sync lock expires
+DRCHRONO_PATIENTS_SYNC_TIME_BUDGET = 8 * 60
+# interrupted crawls older than that start over
+DRCHRONO_PATIENTS_CHECKPOINT_TTL = 60 * 60
+# updated_since stays that far behind the crawl start
+DRCHRONO_PATIENTS_WATERMARK_SKEW = 5 * 60
+
+# syncs run by fleet scheduler at once, also its DB connections
+DRCHRONO_FLEET_CONCURRENCY = 16
+DRCHRONO_FLEET_PER_USER_CONCURRENCY = 1  # syncs of one user or practice at once
+DRCHRONO_FLEET_BATCH_SIZE = 1000  # users planned per round
+DRCHRONO_FLEET_INTERVAL = 60  # seconds between rounds
+# users who didn't log in longer are synced by page views only
+DRCHRONO_FLEET_INACTIVE_DAYS = 30
+
+DRCHRONO_WEBHOOK_SECRET = os.getenv('DRCHRONO_WEBHOOK_SECRET')
+DRCHRONO_WEBHOOK_BATCH_SIZE = 500
+DRCHRONO_WEBHOOK_MAX_ATTEMPTS = 5  # failed events are moved to the failed list after that
+DRCHRONO_WEBHOOK_LOCK_TTL = 5 * 60  # longer than applying of a batch
+# replaces DRCHRONO_PATIENTS_CACHE_TTL when webhooks are on
+DRCHRONO_WEBHOOK_RECONCILE_TTL = 6 * 60 * 60
+
+DRCHRONO_TOKEN_REFRESH_MARGIN = 5 * 60  # tokens expiring sooner are refreshed ahead
+DRCHRONO_TOKEN_REFRESH_LOCK_TTL = 30
+DRCHRONO_TOKEN_CACHE_TTL = 60 * 60  # for tokens with unknown expiry
+
+# for load tests
+DRCHRONO_QUERY_COUNT_HEADER = bool(os.getenv('DRCHRONO_QUERY_COUNT_HEADER'))
+# seconds
+DRCHRONO_METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# /metrics/ is closed without it
+DRCHRONO_METRICS_TOKEN = os.getenv('DRCHRONO_METRICS_TOKEN')
+
+DRCHRONO_RATE_LIMIT_ENABLED = True
+# requests per second, burst of the whole OAuth application
+DRCHRONO_RATE_LIMIT_APP = (20, 100)
+DRCHRONO_RATE_LIMIT_TOKEN = (5, 20)  # requests per second, burst of one access token
+# part of the burst only interactive syncs may use
+DRCHRONO_RATE_LIMIT_INTERACTIVE_RESERVE = 0.25
+DRCHRONO_RATE_LIMIT_MAX_WAIT = 30
+DRCHRONO_RATE_LIMIT_CLOCK = 'redis'  # or 'local' for Redis without TIME command
+
+DRCHRONO_HTTP_POOL_CONNECTIONS = 4
+DRCHRONO_HTTP_POOL_MAXSIZE = 16
+DRCHRONO_HTTP_TIMEOUT = (3.05, 30)  # connect, read
+DRCHRONO_HTTP_MAX_RETRIES = 3
+DRCHRONO_HTTP_BACKOFF_FACTOR = 0.5
+DRCHRONO_HTTP_BACKOFF_MAX = 30
+DRCHRONO_HTTP_RETRY_AFTER_MAX = 60
 
 
 TESTING = 'test' in sys.argv or 'jenkins' in sys.argv
 
 if TESTING:
+    INSTALLED_APPS += ['benchmarks']
     CACHES['default']['OPTIONS']['REDIS_CLIENT_CLASS'] = 'fakeredis.FakeStrictRedis'
+    DRCHRONO_RATE_LIMIT_CLOCK = 'local'
+    DRCHRONO_HTTP_BACKOFF_FACTOR = 0
@@ -0,0 +1,4 @@
+from .local_dev import *
+
+# sync benchmark and load test harness with their commands
+INSTALLED_APPS += ['benchmarks']
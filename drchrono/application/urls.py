@@ -20,10 +20,16 @@ from django.urls import include, path
 from django.views.generic import TemplateView
 
 from application.apps.oauth.views import AuthView
-from application.apps.patients.views import PatientView
+from application.apps.patients.views import (
+    MetricsView, PatientApiView, PatientExportView, PatientView, PatientWebhookView
+)
 
 urlpatterns = [
     path('', PatientView.as_view(), name='patient_list'),
+    path('export/', PatientExportView.as_view(), name='patient_export'),
+    path('api/patients/', PatientApiView.as_view(), name='patient_api'),
+    path('webhooks/drchrono/', PatientWebhookView.as_view(), name='drchrono_webhook'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('login/', AuthView.as_view(), name='login'),
     path('error/', TemplateView.as_view(template_name="error.html"), name='error_info'),
 
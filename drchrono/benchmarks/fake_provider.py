@@ -0,0 +1,152 @@
+import json
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from application.apps.patients.bulk import (
+    format_provider_datetime, parse_provider_datetime,
+)
+
+PATIENTS_PATH = '/api/patients'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeProvider:
+    '''
+    Local stand-in of drchrono patients API for benchmarks and load tests.
+    Serves `patients` generated patients by `page_size` pages (`page` param)
+    and supports `since` filter. Every response is delayed by `latency` seconds,
+    `error_rate` of responses are 503 errors.
+
+    with FakeProvider(patients=10000) as provider:
+        PatientMigrator.patients_data_url = provider.url
+    '''
+    started_at = datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self, patients: int = 1000, page_size: int = 250, latency: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 0, host: str = '127.0.0.1',
+                 port: int = 0):
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.revisions = [0] * patients
+        self.updated_at = [self.started_at] * patients
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.address = (host, port)
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{PATIENTS_PATH}'
+
+    def start(self):
+        self.server = ThreadingHTTPServer(self.address, self._make_handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def change(self, ratio: float) -> int:
+        '''
+        Modifies `ratio` of patients, returns number of modified patients
+        '''
+        count = int(len(self.revisions) * ratio)
+        updated_at = max(self.updated_at) + timedelta(seconds=1)
+        with self._lock:
+            for index in self.random.sample(range(len(self.revisions)), count):
+                self.revisions[index] += 1
+                self.updated_at[index] = updated_at
+        return count
+
+    def patient(self, index: int) -> dict:
+        revision = self.revisions[index]
+        return {
+            'id': index + 1,
+            'first_name': f'First{index} r{revision}' if revision else f'First{index}',
+            'last_name': f'Last{index}',
+            'date_of_birth': date_of_birth(index).isoformat(),
+            'home_phone': f'555-{index % 10000:04d}',
+            'patient_photo': None,
+            'doctor': 1,
+            'updated_at': format_provider_datetime(self.updated_at[index]),
+        }
+
+    def page(self, query: dict) -> dict:
+        indexes = range(len(self.revisions))
+        since = parse_provider_datetime(query.get('since'))
+        if since is not None:
+            indexes = [index for index in indexes if self.updated_at[index] > since]
+
+        page = int(query.get('page', 1))
+        start = (page - 1) * self.page_size
+        results = [self.patient(index) for index in indexes[start:start + self.page_size]]
+        next_url = None
+        if start + self.page_size < len(indexes):
+            next_url = f'{self.url}?{urlencode(dict(query, page=page + 1))}'
+        return {'next': next_url, 'previous': None, 'results': results}
+
+    def _make_handler(self):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if provider.latency:
+                    time.sleep(provider.latency)
+
+                parsed = urlparse(self.path)
+                with provider._lock:
+                    provider.requests += 1
+                    is_error = provider.random.random() < provider.error_rate
+                    if is_error:
+                        provider.errors += 1
+
+                if parsed.path != PATIENTS_PATH:
+                    return self.respond(404, b'Not found')
+                if is_error:
+                    return self.respond(503, b'Service unavailable')
+
+                query = {
+                    name: values[-1] for name, values in parse_qs(parsed.query).items()
+                }
+                body = json.dumps(provider.page(query)).encode()
+                with provider._lock:
+                    provider.bytes_sent += len(body)
+                self.respond(200, body, 'application/json')
+
+            def respond(self, status: int, body: bytes, content_type: str = 'text/plain'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def date_of_birth(index: int):
+    return date(1940, 1, 1) + timedelta(days=index % 25000)
@@ -0,0 +1,170 @@
+import itertools
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model,
+)
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.utils import timezone
+from social_django.models import UserSocialAuth
+
+from application.apps.patients.bulk import PatientBulkWriter, chunked
+from application.apps.patients.models import PatientSync
+from benchmarks.fake_provider import FakeProvider
+
+User = get_user_model()
+
+AUTH_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+def seed_users(users: int, patients: int, prefix: str = 'loadtest',
+               fresh: bool = False) -> list:
+    '''
+    Creates `users` logged in users sharing the first `patients` patients
+    of FakeProvider, so their syncs against the stand-in don't change data.
+    With `fresh` users' data is marked as recently synced.
+    Returns session keys of the users.
+    '''
+    User.objects.filter(username__startswith=f'{prefix}_').delete()
+    provider = FakeProvider(patients=patients)
+    pages = list(chunked([provider.patient(index) for index in range(patients)], 1000))
+
+    session_keys = []
+    for number in range(users):
+        user = User.objects.create(username=f'{prefix}_{number}')
+        UserSocialAuth.objects.create(
+            user=user,
+            uid=f'{prefix}_{number}',
+            provider='drchrono',
+            extra_data={'access_token': f'{prefix}_{number}', 'token_type': 'Bearer'},
+        )
+        writer = PatientBulkWriter(user)
+        for page in pages:
+            writer.write(page)
+        PatientSync.objects.create(
+            user=user,
+            updated_since=FakeProvider.started_at,
+            full_synced_at=timezone.now(),
+        )
+        if fresh:
+            cache.set(
+                settings.DRCHRONO_PATIENTS_CACHE_KEY.format(user_id=user.pk),
+                timezone.now().isoformat(),
+                timeout=None,
+            )
+        session_keys.append(login(user))
+    return session_keys
+
+
+def login(user) -> str:
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = AUTH_BACKEND
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def percentile(values: list, percent: float):
+    '''
+    Nearest-rank percentile of sorted `values`
+    '''
+    if not values:
+        return None
+    rank = math.ceil(percent / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class PageLoadTest:
+    '''
+    Loads `url` `requests` times from `concurrency` threads,
+    requests are authenticated with given session keys in turn.
+    Query counts are taken from X-Query-Count header
+    (server must run with DRCHRONO_QUERY_COUNT_HEADER).
+    '''
+
+    def __init__(self, url: str, session_keys: list, concurrency: int,
+                 requests_count: int, params: dict = None, timeout: float = 60):
+        self.url = url
+        self.session_keys = session_keys
+        self.concurrency = concurrency
+        self.requests_count = requests_count
+        self.params = params or {}
+        self.timeout = timeout
+        self._numbers = itertools.count()
+        self._lock = threading.Lock()
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            samples = list(itertools.chain.from_iterable(
+                executor.map(lambda _: self._load(), range(self.concurrency))
+            ))
+        duration = time.perf_counter() - started
+        return self.report(samples, duration)
+
+    def _load(self) -> list:
+        samples = []
+        session = requests.Session()
+        while True:
+            with self._lock:
+                number = next(self._numbers)
+            if number >= self.requests_count:
+                return samples
+
+            session_key = self.session_keys[number % len(self.session_keys)]
+            request_started = time.perf_counter()
+            try:
+                response = session.get(
+                    self.url,
+                    params=self.params,
+                    cookies={settings.SESSION_COOKIE_NAME: session_key},
+                    allow_redirects=False,
+                    timeout=self.timeout,
+                )
+            except requests.RequestException:
+                samples.append((time.perf_counter() - request_started, 'error', None))
+                continue
+            queries = response.headers.get('X-Query-Count')
+            samples.append((
+                time.perf_counter() - request_started,
+                response.status_code,
+                int(queries) if queries is not None else None,
+            ))
+
+    def report(self, samples: list, duration: float) -> dict:
+        latencies = sorted(latency * 1000 for latency, _, _ in samples)
+        queries = sorted(count for _, _, count in samples if count is not None)
+        statuses = Counter(str(status) for _, status, _ in samples)
+        return {
+            'url': self.url,
+            'concurrency': self.concurrency,
+            'users': len(self.session_keys),
+            'requests': len(samples),
+            'failed': len(samples) - statuses['200'],
+            'statuses': dict(statuses),
+            'duration': round(duration, 3),
+            'throughput': round(len(samples) / duration, 1) if duration else None,
+            'latency_ms': {
+                'p50': round_or_none(percentile(latencies, 50)),
+                'p95': round_or_none(percentile(latencies, 95)),
+                'p99': round_or_none(percentile(latencies, 99)),
+                'max': round_or_none(latencies[-1] if latencies else None),
+            },
+            'queries_per_request': {
+                'mean': round(sum(queries) / len(queries), 2) if queries else None,
+                'p95': percentile(queries, 95),
+                'max': queries[-1] if queries else None,
+            },
+        }
+
+
+def round_or_none(value, digits: int = 1):
+    return None if value is None else round(value, digits)
@@ -0,0 +1,83 @@
+import json
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from benchmarks.sync import SyncBenchmark, get_environment
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks patients sync against local drchrono stand-in. '
+        'Runs in a separate test database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patients', nargs='+', type=int, default=[1000, 10000, 100000],
+            help='Numbers of provider patients to benchmark with',
+        )
+        parser.add_argument('--page-size', type=int, default=250)
+        parser.add_argument(
+            '--change-ratio', type=float, default=0.1,
+            help='Part of patients modified before incremental sync',
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.0, help='Provider latency, seconds'
+        )
+        parser.add_argument(
+            '--error-rate', type=float, default=0.0, help='Part of 503 responses'
+        )
+        parser.add_argument('--fetch-concurrency', type=int, default=None)
+        parser.add_argument(
+            '--no-memory', action='store_true',
+            help="Don't trace peak memory, tracing slows the sync down",
+        )
+        parser.add_argument(
+            '--keepdb', action='store_true', help='Keep the test database'
+        )
+        parser.add_argument('--output', help='JSON file for results, stdout by default')
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['fetch_concurrency']:
+            fetch_concurrency = options['fetch_concurrency']
+            overrides['DRCHRONO_PATIENTS_FETCH_CONCURRENCY'] = fetch_concurrency
+
+        keepdb = options['keepdb']
+        old_name = connection.creation.create_test_db(verbosity=0, keepdb=keepdb)
+        try:
+            with override_settings(**overrides):
+                results = []
+                for patients in options['patients']:
+                    benchmark = SyncBenchmark(
+                        patients,
+                        page_size=options['page_size'],
+                        change_ratio=options['change_ratio'],
+                        latency=options['latency'],
+                        error_rate=options['error_rate'],
+                        trace_memory=not options['no_memory'],
+                    )
+                    for result in benchmark.run():
+                        self.stderr.write(
+                            f'{patients} patients, {result["scenario"]}: '
+                            f'{result["wall_time"]}s, '
+                            f'{result["queries"]} queries, {result["requests"]} requests'
+                        )
+                        results.append(result)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+        report = json.dumps({
+            'created_at': datetime.utcnow().isoformat(),
+            'environment': get_environment(),
+            'settings': overrides,
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
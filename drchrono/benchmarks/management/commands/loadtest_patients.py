@@ -0,0 +1,141 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.fake_provider import FakeProvider
+from benchmarks.loadtest import PageLoadTest, seed_users
+
+
+class Command(BaseCommand):
+    help = (
+        'Load tests patients page: seeds users and patients in the configured database, '
+        'serves drchrono stand-in and loads the page concurrently under uWSGI '
+        'with every given processes x threads configuration '
+        '(or a running server with --url)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument(
+            '--patients', type=int, default=1000, help='Patients of every user'
+        )
+        parser.add_argument('--concurrency', nargs='+', type=int, default=[10, 50])
+        parser.add_argument('--requests', type=int, default=1000, help='Requests per run')
+        parser.add_argument(
+            '--server', nargs='+', default=['4x12'],
+            help='uWSGI configurations to start as <processes>x<threads>',
+        )
+        parser.add_argument(
+            '--url', help='Load already running server instead of starting uWSGI'
+        )
+        parser.add_argument(
+            '--port', type=int, default=8765, help='Port of started uWSGI'
+        )
+        parser.add_argument(
+            '--fresh', action='store_true', help="Seeded data doesn't need sync"
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.0, help='Provider latency, seconds'
+        )
+        parser.add_argument('--page-size', type=int, default=None)
+        parser.add_argument('--output', help='JSON file for results, stdout by default')
+
+    def handle(self, *args, **options):
+        self.stderr.write(
+            f'Seeding {options["users"]} users with {options["patients"]} patients...'
+        )
+        session_keys = seed_users(
+            options['users'], options['patients'], fresh=options['fresh']
+        )
+        params = {'page_size': options['page_size']} if options['page_size'] else {}
+
+        results = []
+        provider = FakeProvider(patients=options['patients'], latency=options['latency'])
+        with provider:
+            servers = [None] if options['url'] else options['server']
+            for server in servers:
+                process = None
+                url = options['url']
+                if url is None:
+                    process, url = self.start_uwsgi(server, options['port'], provider.url)
+                try:
+                    for concurrency in options['concurrency']:
+                        result = PageLoadTest(
+                            url, session_keys, concurrency, options['requests'],
+                            params=params,
+                        ).run()
+                        result['server'] = server
+                        result['provider_requests'] = provider.requests
+                        self.stderr.write(
+                            f'{server or url}, {concurrency} clients: '
+                            f'{result["throughput"]} rps, '
+                            f'p50 {result["latency_ms"]["p50"]}ms, '
+                            f'p99 {result["latency_ms"]["p99"]}ms, '
+                            f'{result["queries_per_request"]["mean"]} queries/request'
+                        )
+                        results.append(result)
+                finally:
+                    if process is not None:
+                        process.terminate()
+                        process.wait()
+
+        report = json.dumps({
+            'created_at': datetime.utcnow().isoformat(),
+            'users': options['users'],
+            'patients': options['patients'],
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+    def start_uwsgi(self, server: str, port: int, provider_url: str):
+        try:
+            processes, threads = (int(value) for value in server.split('x'))
+        except ValueError:
+            raise CommandError(
+                f'Invalid server configuration {server}, expected <processes>x<threads>'
+            )
+
+        env = dict(
+            os.environ,
+            DRCHRONO_PATIENTS_API_URL=provider_url,
+            DRCHRONO_QUERY_COUNT_HEADER='1',
+        )
+        process = subprocess.Popen(
+            [
+                'uwsgi',
+                '--http', f'127.0.0.1:{port}',
+                '--module', 'application.wsgi:application',
+                '--processes', str(processes),
+                '--threads', str(threads),
+                '--enable-threads',
+                '--master',
+                '--die-on-term',
+                '--disable-logging',
+                '--listen', '128',
+            ],
+            cwd=os.path.dirname(settings.BASE_DIR),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=sys.stderr,
+        )
+        url = f'http://127.0.0.1:{port}/'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                requests.get(url, allow_redirects=False, timeout=1)
+                return process, url
+            except requests.RequestException:
+                time.sleep(0.2)
+        process.terminate()
+        raise CommandError(f'uWSGI {server} did not start on port {port}')
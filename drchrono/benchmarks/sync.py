@@ -0,0 +1,141 @@
+import platform
+import time
+import tracemalloc
+from unittest import mock
+
+import django
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+from social_django.models import UserSocialAuth
+
+from application.apps.patients.handlers import PatientMigrator
+from application.apps.patients.models import Patient, PatientSync
+from benchmarks.fake_provider import FakeProvider
+
+User = get_user_model()
+
+SCENARIOS = ('full', 'no_change', 'incremental')
+
+
+class SyncBenchmark:
+    '''
+    Measures PatientMigrator against local FakeProvider:
+    full - the first sync of a user,
+    no_change - full sync when nothing has changed on provider,
+    incremental - sync of `change_ratio` patients modified since the previous sync.
+    Every scenario reports wall time, DB queries, peak Python memory,
+    provider requests and sync telemetry.
+    Removes all patients of the current database, so it runs only on a test database.
+    '''
+
+    def __init__(self, patients: int, page_size: int = 250, change_ratio: float = 0.1,
+                 latency: float = 0.0, error_rate: float = 0.0,
+                 trace_memory: bool = True):
+        self.patients = patients
+        self.page_size = page_size
+        self.change_ratio = change_ratio
+        self.latency = latency
+        self.error_rate = error_rate
+        self.trace_memory = trace_memory
+
+    @property
+    def params(self) -> dict:
+        return {
+            'patients': self.patients,
+            'page_size': self.page_size,
+            'change_ratio': self.change_ratio,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+        }
+
+    def run(self) -> list:
+        if not is_test_database():
+            raise RuntimeError(
+                f'Sync benchmark removes all patients, '
+                f'{connection.settings_dict["NAME"]} is not a test database'
+            )
+        Patient.objects.all().delete()
+        user = self._create_user()
+        provider = FakeProvider(
+            patients=self.patients,
+            page_size=self.page_size,
+            latency=self.latency,
+            error_rate=self.error_rate,
+        )
+        results = []
+        try:
+            # the provider is started first, its url is known once it listens
+            with provider, mock.patch.object(
+                PatientMigrator, 'patients_data_url', provider.url
+            ):
+                for scenario in SCENARIOS:
+                    if scenario == 'no_change':
+                        PatientSync.objects.filter(user=user).update(full_synced_at=None)
+                    elif scenario == 'incremental':
+                        provider.change(self.change_ratio)
+                    results.append(self._measure(scenario, user, provider))
+        finally:
+            user.delete()
+            Patient.objects.all().delete()
+        return results
+
+    def _measure(self, scenario: str, user, provider: FakeProvider) -> dict:
+        requests_before = provider.requests
+        errors_before = provider.errors
+        migrator = PatientMigrator(user)
+
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            is_ok, status_message = migrator.sync_patients()
+            wall_time = time.perf_counter() - started
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+
+        telemetry = migrator.telemetry.as_dict(migrator.stats)
+        return dict(
+            self.params,
+            scenario=scenario,
+            is_ok=is_ok,
+            status_message=status_message,
+            wall_time=round(wall_time, 4),
+            queries=telemetry['queries'],
+            peak_memory=peak_memory,
+            requests=provider.requests - requests_before,
+            provider_errors=provider.errors - errors_before,
+            patients_per_second=(
+                round(telemetry['fetched'] / wall_time, 1) if wall_time else None
+            ),
+            telemetry=telemetry,
+        )
+
+    def _create_user(self):
+        user = User.objects.create(username=f'benchmark_{self.patients}')
+        UserSocialAuth.objects.create(
+            user=user,
+            uid=f'benchmark_{self.patients}',
+            provider='drchrono',
+            extra_data={'access_token': 'benchmark', 'token_type': 'Bearer'},
+        )
+        return user
+
+
+def is_test_database() -> bool:
+    name = connection.settings_dict['NAME']
+    test_name = connection.settings_dict['TEST'].get('NAME')
+    return name == test_name or name.startswith(TEST_DATABASE_PREFIX)
+
+
+def get_environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'machine': platform.machine(),
+    }
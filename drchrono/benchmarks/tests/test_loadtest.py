@@ -0,0 +1,39 @@
+import fakeredis
+from django.test import LiveServerTestCase, SimpleTestCase, override_settings
+from django.urls import reverse
+
+from benchmarks.loadtest import PageLoadTest, percentile, seed_users
+
+
+class PercentileTest(SimpleTestCase):
+
+    def test_percentile_success(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+
+@override_settings(DRCHRONO_QUERY_COUNT_HEADER=True)
+class PageLoadTestTest(LiveServerTestCase):
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def test_load_seeded_users_success(self):
+        session_keys = seed_users(users=3, patients=30, fresh=True)
+
+        result = PageLoadTest(
+            f'{self.live_server_url}{reverse("patient_list")}',
+            session_keys,
+            concurrency=3,
+            requests_count=9,
+            params={'page_size': 10},
+        ).run()
+
+        self.assertEqual(result['requests'], 9)
+        self.assertEqual(result['failed'], 0)
+        self.assertEqual(result['users'], 3)
+        self.assertIsNotNone(result['latency_ms']['p99'])
+        self.assertGreater(result['queries_per_request']['mean'], 0)
@@ -0,0 +1,43 @@
+from unittest.mock import patch
+
+import fakeredis
+from django.db import connection
+from django.test import TestCase
+
+from benchmarks.sync import SyncBenchmark
+
+
+class SyncBenchmarkTest(TestCase):
+
+    def tearDown(self):
+        fakeredis.FakeStrictRedis().flushall()
+
+    def test_benchmark_scenarios_success(self):
+        results = SyncBenchmark(patients=45, page_size=10, change_ratio=0.2).run()
+
+        scenarios = [result['scenario'] for result in results]
+        self.assertEqual(scenarios, ['full', 'no_change', 'incremental'])
+        full, no_change, incremental = results
+        self.assertTrue(all(result['is_ok'] for result in results))
+        self.assertEqual(full['requests'], 5)
+        self.assertEqual(full['telemetry']['rows']['inserted'], 45)
+        self.assertEqual(no_change['telemetry']['rows']['skipped'], 45)
+        self.assertEqual(incremental['requests'], 1)
+        self.assertEqual(incremental['telemetry']['rows']['updated'], 9)
+        self.assertGreater(full['queries'], 0)
+        self.assertGreater(full['peak_memory'], 0)
+
+    def test_benchmark_with_provider_errors_success(self):
+        results = SyncBenchmark(
+            patients=45, page_size=10, error_rate=0.3, trace_memory=False
+        ).run()
+
+        full = results[0]
+        self.assertGreater(full['provider_errors'], 0)
+        self.assertEqual(full['telemetry']['retries'], full['provider_errors'])
+        self.assertIsNone(full['peak_memory'])
+
+    def test_benchmark_refuses_non_test_database_fail(self):
+        with patch.dict(connection.settings_dict, NAME='drchrono'):
+            with self.assertRaises(RuntimeError):
+                SyncBenchmark(patients=1).run()